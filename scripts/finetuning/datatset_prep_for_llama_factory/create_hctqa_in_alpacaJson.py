@@ -1,7 +1,26 @@
+import os
+import sys
 import json
 import argparse
-import pandas as pd
-from datasets import load_dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "inference_experiments"))
+from local_dataset import DEFAULT_CACHE_FILE, load_local_dataset, add_local_dataset_arguments
+
+ROW_COLUMNS = ["dataset_type", "prompt", "answer"]
+
+def iter_split_rows(dataset, split, dataset_type = None):
+    """
+    Yields the rows of one split, of one dataset type or all of them, from the Hugging Face
+    dataset or the local dataset source, without converting the split to pandas.
+    """
+    if isinstance(dataset, dict):
+        batches = dataset[split].select_columns(ROW_COLUMNS).iter(batch_size=1000)
+    else:
+        batches = dataset.iter_batches(split, dataset_type, ROW_COLUMNS)
+    for columns in batches:
+        for j in range(len(columns["prompt"])):
+            if dataset_type is None or columns["dataset_type"][j] == dataset_type:
+                yield {column: columns[column][j] for column in ROW_COLUMNS}
 
 def create_json_entries(path_to_datasets_json_file, data_file_paths):
     # example path: ~/LLaMA-Factory/data/dataset_info.json
@@ -44,26 +63,21 @@ def create_json_entries(path_to_datasets_json_file, data_file_paths):
     print(f"Updated {path_to_datasets_json_file} with new dataset entries.")
     return 
 
-def convert_parquet_to_json(path_to_main_llama_factory_folder):
-    dataset = load_dataset("qcri-ai/HCTQA")
-    
-    # Convert each split to a pandas DataFrame
-    full_train_df = pd.DataFrame(dataset['train'])
-    full_test_df = pd.DataFrame(dataset['test'])
+def convert_parquet_to_json(path_to_main_llama_factory_folder, dataset_source = "hf", local_cache = DEFAULT_CACHE_FILE, split_file = None):
+    if dataset_source == "local":
+        # Offline, from the prompts files of the repo (the train/test splits come from split_file)
+        dataset = load_local_dataset(local_cache, split_file=split_file)
+    else:
+        from datasets import load_dataset
+        dataset = load_dataset("qcri-ai/HCTQA")
 
     data = []
     ret_path_dict = {}
-    # Filter real world datasets
-    real_only_train_df = full_train_df[full_train_df["dataset_type"] == "realWorldHCTs"]
-    real_only_test_df = full_test_df[full_test_df["dataset_type"] == "realWorldHCTs"]
-
     for variation in ["real_only", "real_and_synthetic"]:
-        if variation == "real_only":
-            train_df = real_only_train_df
-            test_df = real_only_test_df
-        else:
-            train_df = full_train_df
-            test_df = full_test_df
+        # Filter real world datasets
+        dataset_type = "realWorldHCTs" if variation == "real_only" else None
+        train_df = iter_split_rows(dataset, "train", dataset_type)
+        test_df = iter_split_rows(dataset, "test", dataset_type)
         
         # Make output paths
         train_json_file = os.path.join(path_to_main_llama_factory_folder, f"/data/hctqa_{variation}_train.json")
@@ -71,7 +85,7 @@ def convert_parquet_to_json(path_to_main_llama_factory_folder):
 
         def data_frame_to_json(df, json_file):
             data = []
-            for _, row in df.iterrows():
+            for row in df:
                 prompt_list = eval(row["prompt"])
                 system_prompt = prompt_list[0]["content"]
                 user_prompt = prompt_list[1]["content"]
@@ -115,13 +129,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Create JSON entries for LLaMA-Factory datasets.")
     parser.add_argument("--path_to_datasets_json_file", type=str, required=True, help="Path to the datasets JSON file.")
     parser.add_argument("--path_to_main_llama_factory_folder", type=str, required=True, help="Path to the main LLaMA-Factory folder.")
+    add_local_dataset_arguments(parser)
     args = parser.parse_args()
 
     # Create JSON entries
-    data_file_paths = convert_parquet_to_json(args.path_to_main_llama_factory_folder)
+    data_file_paths = convert_parquet_to_json(args.path_to_main_llama_factory_folder, args.dataset_source, args.local_cache, args.split_file)
     create_json_entries(args.path_to_datasets_json_file, data_file_paths)
 
     
 # Example usage:
 # python create_hctqa_in_alpacaJson.py --path_to_datasets_json_file ~/LLaMA-Factory/data/dataset_info.json --path_to_main_llama_factory_folder ~/LLaMA-Factory
-
+# Offline: python create_hctqa_in_alpacaJson.py --path_to_datasets_json_file ~/LLaMA-Factory/data/dataset_info.json --path_to_main_llama_factory_folder ~/LLaMA-Factory --dataset_source local --split_file hctqa_splits.json
@@ -0,0 +1,348 @@
+import math
+import os
+import time
+
+from request_ordering import PrefixReuseTracker
+
+####################################################################################################################
+############################################# INFERENCE BACKENDS ###################################################
+####################################################################################################################
+# llm_inf.py and vlm_inf.py talk to the model through one of these backends instead of vllm.LLM
+# directly, so the batching, ordering and output writing around them can be run and profiled on
+# a CPU box with the mock engine. Sampling parameters are plain dicts ({"temperature": 0.0,
+# "max_tokens": 128}) that each backend converts to what its engine expects.
+
+BACKEND_NAMES = ["vllm", "mock", "openai"]
+
+
+def percentiles(values, qs):
+    """
+    Nearest rank percentiles of values, one per q in qs (0 to 100).
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return [None for _ in qs]
+    return [ordered[max(math.ceil(q / 100 * len(ordered)), 1) - 1] for q in qs]
+
+
+class Completion:
+    """
+    One finished request: the generated text and its token counts. Backends that can time their
+    requests also set ttft (seconds to the first token), latency (seconds from submission to the
+    last token) and batch_occupancy (requests served alongside it, itself included, when it got
+    its first token). Responses from the response cache have cached=True and no timings.
+    """
+
+    def __init__(self, text, prompt_tokens=0, generated_tokens=0, ttft=None, latency=None, batch_occupancy=None):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.generated_tokens = generated_tokens
+        self.ttft = ttft
+        self.latency = latency
+        self.batch_occupancy = batch_occupancy
+        self.cached = False
+
+
+class InferenceBackend:
+    """
+    Interface of the inference backends. Prompts are either chat messages (chat, stream_chat) or
+    engine prompts (generate): a string, {"prompt": ..., "multi_modal_data": ...} or
+    {"prompt_token_ids": [...]}. Results come back as Completions in the order of the prompts.
+    """
+
+    name = None
+
+    def chat(self, prompts, sampling_params, use_tqdm=False):
+        raise NotImplementedError
+
+    def generate(self, prompts, sampling_params, use_tqdm=False):
+        raise NotImplementedError
+
+    def stream_chat(self, requests, sampling_params, max_in_flight=256):
+        """
+        Takes an iterator of (tag, messages) and yields (tag, Completion) as soon as each request
+        finishes, with at most max_in_flight requests queued in the engine at once.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        # One line summary of the requests served, if the backend keeps one
+        return None
+
+    def close(self):
+        pass
+
+
+##########################
+######### VLLM
+##########################
+
+class VLLMBackend(InferenceBackend):
+    name = "vllm"
+
+    def __init__(self, model, **engine_kwargs):
+        import vllm
+        self.vllm = vllm
+        self.model = model
+        self.llm = vllm.LLM(model=model, **engine_kwargs)
+        self._sampling_params = {}
+
+    def sampling(self, sampling_params):
+        key = tuple(sorted(sampling_params.items()))
+        if key not in self._sampling_params:
+            self._sampling_params[key] = self.vllm.SamplingParams(**sampling_params)
+        return self._sampling_params[key]
+
+    @staticmethod
+    def to_completion(output):
+        return Completion(output.outputs[0].text, len(output.prompt_token_ids or []), len(output.outputs[0].token_ids))
+
+    def max_num_seqs(self):
+        try:
+            return self.llm.llm_engine.vllm_config.scheduler_config.max_num_seqs
+        except AttributeError:
+            return None
+
+    def timed_completions(self, outputs, start, end):
+        # Timings from the engine's request metrics when it keeps them, else the batch wall time.
+        # The engine decodes up to max_num_seqs of the batch at once.
+        occupancy = min(len(outputs), self.max_num_seqs() or len(outputs))
+        completions = []
+        for output in outputs:
+            completion = self.to_completion(output)
+            metrics = getattr(output, "metrics", None)
+            if metrics is not None and getattr(metrics, "first_token_time", None) is not None:
+                completion.ttft = metrics.first_token_time - metrics.arrival_time
+                completion.latency = (getattr(metrics, "finished_time", None) or metrics.last_token_time) - metrics.arrival_time
+            else:
+                completion.latency = end - start
+            completion.batch_occupancy = occupancy
+            completions.append(completion)
+        return completions
+
+    def chat(self, prompts, sampling_params, use_tqdm=False):
+        start = time.time()
+        outputs = self.llm.chat(prompts, sampling_params=self.sampling(sampling_params), use_tqdm=use_tqdm)
+        return self.timed_completions(outputs, start, time.time())
+
+    def generate(self, prompts, sampling_params, use_tqdm=False):
+        start = time.time()
+        outputs = self.llm.generate(prompts, sampling_params=self.sampling(sampling_params), use_tqdm=use_tqdm)
+        return self.timed_completions(outputs, start, time.time())
+
+    def stream_chat(self, requests, sampling_params, max_in_flight=256):
+        # Feeds the engine directly so its scheduler always has the next requests at hand instead
+        # of draining at the end of every chat() batch
+        engine = self.llm.llm_engine
+        tokenizer = self.llm.get_tokenizer()
+        sampling = self.sampling(sampling_params)
+        requests = iter(requests)
+        in_flight = {}
+        next_request_id = 0
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                    break
+                tag, messages = request
+                request_id = str(next_request_id)
+                next_request_id += 1
+                prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                engine.add_request(request_id, prompt, sampling)
+                # tag, submission time, first token time, batch occupancy at the first token
+                in_flight[request_id] = [tag, time.perf_counter(), None, None]
+            if not in_flight:
+                return
+            outputs = engine.step()
+            now = time.perf_counter()
+            for output in outputs:
+                request = in_flight[output.request_id]
+                if request[2] is None and output.outputs and output.outputs[0].token_ids:
+                    request[2] = now
+                    request[3] = len(outputs)
+                if output.finished:
+                    tag, submitted, first_token, occupancy = in_flight.pop(output.request_id)
+                    completion = self.to_completion(output)
+                    completion.ttft = (first_token or now) - submitted
+                    completion.latency = now - submitted
+                    completion.batch_occupancy = occupancy or len(outputs)
+                    yield tag, completion
+
+
+##########################
+######### MOCK ENGINE
+##########################
+
+def prompt_text(prompt):
+    """
+    Text of a chat prompt or an engine prompt, images and token ids left out.
+    """
+    if isinstance(prompt, str):
+        return prompt
+    if isinstance(prompt, dict):
+        if "prompt" in prompt:
+            return prompt["prompt"]
+        return " ".join(str(t) for t in prompt.get("prompt_token_ids", []))
+    texts = []
+    for message in prompt:
+        content = message["content"]
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part["text"] for part in content if part.get("type") == "text")
+    return "\n".join(texts)
+
+
+class MockBackend(InferenceBackend):
+    """
+    Deterministic CPU stand-in for an engine. Each request answers with `response`, or when
+    response is "echo" with the question of its prompt (the last line if there is no
+    "Question:"), cut to max_tokens whitespace tokens.
+    Decoding is simulated like a batching engine: up to max_num_seqs requests run at once and
+    every step adds one token to each of them and takes token_latency seconds. Starting a request
+    takes prefill_latency seconds per prompt token that is not in its simulated prefix cache.
+    """
+
+    name = "mock"
+
+    def __init__(self, model="mock", response="echo", token_latency=0.0, max_num_seqs=256, prefill_latency=0.0):
+        self.model = model
+        self.response = response
+        self.token_latency = token_latency
+        self.max_num_seqs = max_num_seqs
+        self.prefill_latency = prefill_latency
+        self.prefix_cache = PrefixReuseTracker()
+
+    def complete(self, prompt, sampling_params):
+        text = prompt_text(prompt)
+        if self.response == "echo":
+            if "Question:" in text:
+                response = text.split("Question:")[-1]
+            else:
+                lines = text.strip().splitlines()
+                response = lines[-1] if lines else ""
+        else:
+            response = self.response
+        tokens = response.split()[:sampling_params.get("max_tokens", 16)]
+        return Completion(" ".join(tokens), len(text.split()), len(tokens))
+
+    def _run(self, requests, sampling_params, max_in_flight=None):
+        # Yields (tag, Completion) in finishing order, taking new requests when slots free up
+        requests = iter(requests)
+        waiting = []
+        running = []
+        exhausted = False
+        while True:
+            while not exhausted and (max_in_flight is None or len(waiting) + len(running) < max_in_flight):
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                    break
+                tag, prompt = request
+                completion = self.complete(prompt, sampling_params)
+                waiting.append([tag, completion, max(completion.generated_tokens, 1), prompt_text(prompt), time.perf_counter()])
+            prefill_tokens = 0
+            while waiting and len(running) < self.max_num_seqs:
+                request = waiting.pop(0)
+                running.append(request)
+                if self.prefill_latency:
+                    text = request[3]
+                    prefill_tokens += len(text[self.prefix_cache.add(text):].split())
+            if not running:
+                return
+            if prefill_tokens:
+                time.sleep(self.prefill_latency * prefill_tokens)
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            now = time.perf_counter()
+            still_running = []
+            for request in running:
+                completion = request[1]
+                if completion.ttft is None:
+                    completion.ttft = now - request[4]
+                    completion.batch_occupancy = len(running)
+                request[2] -= 1
+                if request[2] > 0:
+                    still_running.append(request)
+                else:
+                    completion.latency = now - request[4]
+                    yield request[0], completion
+            running = still_running
+
+    def _run_batch(self, prompts, sampling_params):
+        completions = [None] * len(prompts)
+        for position, completion in self._run(enumerate(prompts), sampling_params):
+            completions[position] = completion
+        return completions
+
+    def chat(self, prompts, sampling_params, use_tqdm=False):
+        return self._run_batch(prompts, sampling_params)
+
+    def generate(self, prompts, sampling_params, use_tqdm=False):
+        if isinstance(prompts, (str, dict)):
+            prompts = [prompts]
+        return self._run_batch(prompts, sampling_params)
+
+    def stream_chat(self, requests, sampling_params, max_in_flight=256):
+        yield from self._run(requests, sampling_params, max_in_flight)
+
+
+##########################
+######### HUGGING FACE HUB
+##########################
+
+HF_LOGGED_IN = False
+
+
+def huggingface_login():
+    """
+    Logs in with $HUGGINGFACE_TOKEN once per process. Called right before something is fetched
+    from the hub, so --help, dry runs and offline runs never touch the network.
+    """
+    global HF_LOGGED_IN
+    if not HF_LOGGED_IN and os.getenv("HUGGINGFACE_TOKEN"):
+        from huggingface_hub import login
+        login(token=os.getenv("HUGGINGFACE_TOKEN"))
+    HF_LOGGED_IN = True
+
+
+def build_backend(backend_name, model, engine_kwargs=None, mock_response="echo", mock_token_latency=0.0, mock_max_num_seqs=256, mock_prefill_latency=0.0,
+                  api_base_url=None, api_key=None, max_concurrency=64, max_retries=5):
+    engine_kwargs = engine_kwargs or {}
+    if backend_name == "vllm":
+        return VLLMBackend(model, **engine_kwargs)
+    if backend_name == "openai":
+        from openai_backend import OpenAIHTTPBackend, DEFAULT_BASE_URL
+        return OpenAIHTTPBackend(model, api_base_url or DEFAULT_BASE_URL, api_key, max_concurrency, max_retries)
+    if backend_name == "mock":
+        return MockBackend(model, mock_response, mock_token_latency, engine_kwargs.get("max_num_seqs", mock_max_num_seqs), mock_prefill_latency)
+    raise ValueError(f"Invalid backend. Choose from {BACKEND_NAMES}.")
+
+
+def add_backend_arguments(parser):
+    parser.add_argument("--backend", type=str, default="vllm", choices=BACKEND_NAMES, help="Inference engine: vllm in process, openai for a model served behind an OpenAI compatible endpoint, mock for a deterministic CPU stand-in to test and profile the pipeline.")
+    parser.add_argument("--api_base_url", type=str, default=None, help="Base URL of the OpenAI compatible server of the openai backend (default http://localhost:8000/v1).")
+    parser.add_argument("--api_key", type=str, default=None, help="API key of the openai backend (default $OPENAI_API_KEY).")
+    parser.add_argument("--max_concurrency", type=int, default=64, help="Concurrent HTTP requests of the openai backend.")
+    parser.add_argument("--max_retries", type=int, default=5, help="Retries of a failed HTTP request, with exponential backoff.")
+    parser.add_argument("--mock_response", type=str, default="echo", help="Response of every mock request, 'echo' returns the question of the prompt.")
+    parser.add_argument("--mock_token_latency", type=float, default=0.0, help="Seconds per decoding step of the mock engine.")
+    parser.add_argument("--mock_max_num_seqs", type=int, default=256, help="Requests decoded at once by the mock engine.")
+    parser.add_argument("--mock_prefill_latency", type=float, default=0.0, help="Seconds per prompt token of the mock engine that misses its simulated prefix cache.")
+
+
+def backend_options_from_args(args):
+    # Keyword arguments of build_backend besides the engine arguments
+    return {
+        "mock_response": args.mock_response,
+        "mock_token_latency": args.mock_token_latency,
+        "mock_max_num_seqs": args.mock_max_num_seqs,
+        "mock_prefill_latency": args.mock_prefill_latency,
+        "api_base_url": args.api_base_url,
+        "api_key": args.api_key,
+        "max_concurrency": args.max_concurrency,
+        "max_retries": args.max_retries,
+    }
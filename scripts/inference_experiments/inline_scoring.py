@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+
+####################################################################################################################
+############################################# INLINE SCORING #######################################################
+####################################################################################################################
+# Scores every response as soon as it is generated, with the per record functions of
+# score_model_responses/score_responses.py (same normalization as post_process_response /
+# clean_gt_val, same metrics), so a sweep gets its scores without a second pass over the results
+# files. Per question scores and the report of a results file go to a scores/ folder next to it,
+# where the name filters of score_responses.py do not pick them up. The report is the one
+# score_responses.py writes for that file alone.
+
+SCORER_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "score_model_responses"))
+SCORING_MODES = ["real", "synthetic", "vision"]
+
+
+def import_scorer():
+    # The scorer is imported on first use, runs without --score do not load it
+    if SCORER_DIR not in sys.path:
+        sys.path.insert(0, SCORER_DIR)
+    import score_responses
+    return score_responses
+
+
+def scores_files_for(results_file):
+    """
+    Per question scores (.jsonl) and report (.txt) of a results file.
+    """
+    folder, fname = os.path.split(results_file)
+    root = os.path.join(folder, "scores", os.path.splitext(fname)[0])
+    return f"{root}--scores.jsonl", f"{root}--scores.txt"
+
+
+class InlineScorer:
+    """
+    Scores records ({"id", "response"} plus "gt" for text) one at a time and keeps running means.
+    mode is "real" (per dataset report), "synthetic" (overall report) or "vision" (GTs from the
+    vision reference file of the scorer, responses whose id is not there are skipped).
+    """
+
+    def __init__(self, mode):
+        if mode not in SCORING_MODES:
+            raise ValueError(f"Invalid scoring mode. Choose from {SCORING_MODES}.")
+        self.scorer = import_scorer()
+        self.mode = mode
+        self.metric_names = self.scorer.VISION_METRICS if mode == "vision" else self.scorer.TEXT_METRICS
+        self.ids_to_gts = None
+        if mode == "vision":
+            from gt_index import load_gt_index
+            reference_file = os.path.join(SCORER_DIR, os.path.basename(self.scorer.VISION_GT_REFERENCE_FILE))
+            self.ids_to_gts = load_gt_index(reference_file, self.scorer.SCORER_VERSION)
+        self.scores = {}
+        self.missing_ids = 0
+        self.running = self.scorer.DatasetMetricsAccumulator(self.metric_names)
+
+    def score(self, record):
+        """
+        Scores one record and returns its metrics, or None if it has no reference GT.
+        """
+        if self.mode == "vision":
+            values = self.scorer.score_vision_record(record, self.ids_to_gts)
+        else:
+            values = self.scorer.score_text_record(record)
+        if values is None:
+            self.missing_ids += 1
+            return None
+        self.scores[record["id"]] = values
+        self.running.add(record["id"], values)
+        return values
+
+    def progress(self):
+        if not self.scores:
+            return "no scores yet"
+        means = self.running.results()["ALL"]
+        return f"running {', '.join(f'{m} {means[m]:.4f}' for m in self.metric_names)} over {len(self.scores)} questions"
+
+    def write(self, results_file, ids=None):
+        """
+        Writes the per question scores of ids (default: in scoring order) and the report of the
+        results file, and returns the report. Per dataset means are summed in the order of ids,
+        which should be the order of the results file for the report to match score_responses.py.
+        """
+        scores_file, report_file = scores_files_for(results_file)
+        os.makedirs(os.path.dirname(scores_file), exist_ok=True)
+        ids = [question_id for question_id in (self.scores if ids is None else ids) if question_id in self.scores]
+
+        accumulator = self.scorer.DatasetMetricsAccumulator(self.metric_names)
+        with open(scores_file, "w") as f:
+            for question_id in ids:
+                values = self.scores[question_id]
+                accumulator.add(question_id, values)
+                f.write(json.dumps({"id": question_id, "dataset": question_id.split("--")[0], **values}) + "\n")
+
+        fname = os.path.basename(results_file)
+        if not ids:
+            report = f"{fname}\nNo scored responses\n"
+        elif self.mode == "vision":
+            report = self.scorer.format_vision_results(fname.split("--")[0], accumulator.results())
+        elif self.mode == "synthetic":
+            report = self.scorer.format_synthetic_results(fname, {"ALL": accumulator.results()["ALL"]})
+        else:
+            report = self.scorer.format_text_results(fname.split("--")[0], fname.split("--")[1], accumulator.results())
+        with open(report_file, "w") as f:
+            f.write(report)
+        if self.missing_ids:
+            print(f"{fname}: skipped {self.missing_ids} responses whose id has no reference GT")
+        print(f"Scores saved to {scores_file} and {report_file}")
+        return report
+
+
+def score_results_file(results_file, mode):
+    """
+    Scores a finished results file (JSON or JSONL), e.g. the merged file of a sharded run.
+    """
+    scorer = InlineScorer(mode)
+    ids = []
+    for record in scorer.scorer.iter_result_records(results_file):
+        scorer.score(record)
+        ids.append(record["id"])
+    return scorer.write(results_file, ids)
+
+
+def add_scoring_arguments(parser):
+    parser.add_argument("--score", action="store_true", help="Score each response as it is generated, with the normalization and metrics of score_responses.py, and write per question scores and the report to a scores/ folder next to the results.")
@@ -1,112 +1,362 @@
-import pandas as pd
-import json, time, os, argparse
-from datasets import load_dataset
-from vllm import LLM, SamplingParams
+import json, time, os, sys, argparse, ast
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from inference_backends import build_backend, add_backend_arguments, backend_options_from_args, prompt_text, huggingface_login
+from sharding import shard_index_of, shard_output_file, check_shard_args, merge_shards, add_shard_arguments
+from request_ordering import REQUEST_ORDERS, PrefixReuseTracker, order_rows_by_table
+from response_cache import ResponseCache, with_response_cache, add_response_cache_arguments
+from local_dataset import DEFAULT_CACHE_FILE, LocalHCTQADataset, load_local_dataset, add_local_dataset_arguments
+from telemetry import MetricsRecorder, format_summary, add_metrics_arguments
+from inline_scoring import InlineScorer, score_results_file, add_scoring_arguments
 
 # load env file
 import dotenv
 dotenv.load_dotenv()
 
-# login to huggingface
-from huggingface_hub import login
-login(token=os.getenv("HUGGINGFACE_TOKEN"))
+SPLIT_NAMES = ["train", "validation", "test"]
+DATASET_TYPES = {"real": "realWorldHCTs", "synthetic": "syntheticHCTs", "all": None}
+ROW_COLUMNS = ["question_id", "dataset_type", "prompt", "prompt_without_system", "answer"]
+READ_BATCH_SIZE = 1000
+
+def parse_prompt(prompt_str):
+    """
+    Parses a serialized chat prompt (a python literal list of messages) without eval().
+    """
+    try:
+        return ast.literal_eval(prompt_str)
+    except (ValueError, SyntaxError):
+        return json.loads(prompt_str)
+
+def load_hctqa(dataset_options = None):
+    """
+    The HCT-QA dataset from Hugging Face, or from the prompts files of the repo with
+    dataset_options {"dataset_source": "local", "local_cache": ..., "split_file": ...}.
+    """
+    dataset_options = dataset_options or {}
+    if dataset_options.get("dataset_source", "hf") == "local":
+        return load_local_dataset(dataset_options.get("local_cache") or DEFAULT_CACHE_FILE, split_file=dataset_options.get("split_file"))
+    huggingface_login()
+    from datasets import load_dataset
+    return load_dataset("qcri-ai/HCTQA")
+
+def dataset_options_from_args(args):
+    return {"dataset_source": args.dataset_source, "local_cache": args.local_cache, "split_file": args.split_file}
+
+def question_from_prompt(prompt):
+    return prompt[-1]["content"].split("Question:")[-1].split("?`")[0].strip() + "?"
 
-def do_llm_inference(model_name_or_path, output_folder = "../../results/model_responses/llms/", data_source_type = "real", split_name = "all", batch_size = 32, num_gpus = 1, use_system_prompt = True):
-    dataset = load_dataset("qcri-ai/HCTQA")
-    
-    # Convert each split to a pandas DataFrame
-    train_df = pd.DataFrame(dataset['train'])
-    val_df = pd.DataFrame(dataset['validation'])
-    test_df = pd.DataFrame(dataset['test'])
+def model_supports_system_prompt(model_name):
+    # gemma and gemma2 models do not support system prompts
+    return not ("gemma" in model_name and "gemma-3" not in model_name)
 
-    # Choose the split based on the split_name argument
+def iter_question_rows(dataset, split_name = "all", data_source_type = "real"):
+    """
+    Yields the rows of the chosen split(s) of the given dataset type one by one, reading the
+    splits in column batches instead of converting them to pandas.
+    """
     if split_name == "all":
-        # Concatenate the DataFrames
-        final_df = pd.concat([train_df, val_df, test_df], axis=0)
-        final_df = final_df.reset_index(drop=True)
-    elif split_name == "train":
-        final_df = train_df
-    elif split_name == "validation":
-        final_df = val_df
-    elif split_name == "test":
-        final_df = test_df
+        split_names = SPLIT_NAMES
+    elif split_name in SPLIT_NAMES:
+        split_names = [split_name]
     else:
         raise ValueError("Invalid split name. Choose from 'train', 'validation', 'test', or 'all'.")
+    if data_source_type not in DATASET_TYPES:
+        raise ValueError("Invalid data source type. Choose from 'real', 'synthetic', or 'all'.")
+    dataset_type = DATASET_TYPES[data_source_type]
 
-    # If the data source type is "real", filter the DataFrame
-    if data_source_type == "real":
-        final_df = final_df[final_df["dataset_type"] == "realWorldHCTs"]
-    elif data_source_type == "synthetic":
-        final_df = final_df[final_df["dataset_type"] == "syntheticHCTs"]
-    elif data_source_type == "all":
-        pass
+    if isinstance(dataset, LocalHCTQADataset):
+        # The local source reads only the batches of the wanted split and dataset type
+        batches = dataset.iter_batches(split_name, dataset_type, ROW_COLUMNS)
     else:
-        raise ValueError("Invalid data source type. Choose from 'real', 'synthetic', or 'all'.")
+        batches = (columns for split in split_names
+                   for columns in dataset[split].select_columns(ROW_COLUMNS).iter(batch_size=READ_BATCH_SIZE))
+    for columns in batches:
+        for j in range(len(columns["question_id"])):
+            if dataset_type is not None and columns["dataset_type"][j] != dataset_type:
+                continue
+            yield {column: columns[column][j] for column in ROW_COLUMNS}
+
+def prompt_column_for(use_system_prompt = True):
+    return "prompt" if use_system_prompt else "prompt_without_system"
 
-    # Make batches
-    batch_counter = 0
-    test_batches = {}
-    for i in range(0, final_df.shape[0], batch_size):
-        test_batches[batch_counter] = {
-            "ids" : [],
-            "prompts": [],
-            "prompts_without_system": [],
-            "gts": []
+def iter_prompt_items(rows, use_system_prompt = True):
+    """
+    Yields one parsed request per row. Only the prompt variant that will be sent (with or
+    without the system prompt) is parsed, right before it is needed.
+    """
+    prompt_column = prompt_column_for(use_system_prompt)
+    for row in rows:
+        prompt = parse_prompt(row[prompt_column])
+        yield {
+            "id": row["question_id"],
+            "prompt": prompt,
+            "question": question_from_prompt(prompt),
+            "gt": row["answer"]
         }
-        for j in range(i, min(i + batch_size, len(final_df))):
-            row = final_df.iloc[j]
-            test_batches[batch_counter]["ids"].append(row['question_id'])
-            test_batches[batch_counter]["prompts"].append(eval(row['prompt']))
-            test_batches[batch_counter]["prompts_without_system"].append(eval(row['prompt_without_system']))
-            test_batches[batch_counter]["gts"].append(row['answer'])
 
-        batch_counter += 1
+def track_prefix_reuse(items, prefix_reuse):
+    for item in items:
+        prefix_reuse.add(prompt_text(item["prompt"]))
+        yield item
+
+def iter_prompt_batches(items, batch_size = 32):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def count_tokens(completions):
+    prompt_tokens = sum(c.prompt_tokens for c in completions)
+    generated_tokens = sum(c.generated_tokens for c in completions)
+    return prompt_tokens, generated_tokens
+
+def print_throughput(num_questions, prompt_tokens, generated_tokens, seconds):
+    seconds = max(seconds, 1e-9)
+    print(f"{num_questions} questions in {seconds:.1f} seconds: {num_questions / seconds:.2f} questions/s, "
+          f"{generated_tokens / seconds:.1f} generated tokens/s, {(prompt_tokens + generated_tokens) / seconds:.1f} total tokens/s")
+
+##########################
+######### CHECKPOINTS
+##########################
+# Responses are appended to `checkpoints/<results file>.partial.jsonl` next to the results file
+# as they complete, so an interrupted run loses at most the requests in flight. A restarted run
+# skips the question ids found there and the finished run rewrites them, in dataset order, as the
+# usual JSON results file. The checkpoints/ folder keeps them out of the name filters of
+# score_responses.py, like shards/ and scores/.
+
+CHECKPOINT_FLUSH_EVERY = 256
+
+def checkpoint_path(output_file):
+    folder, fname = os.path.split(output_file)
+    checkpoint_file = os.path.join(folder, "checkpoints", f"{fname}.partial.jsonl")
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    # Checkpoints of runs from before the checkpoints/ folder are moved there to resume from
+    if not os.path.exists(checkpoint_file) and os.path.exists(f"{output_file}.partial.jsonl"):
+        os.replace(f"{output_file}.partial.jsonl", checkpoint_file)
+    return checkpoint_file
+
+def read_checkpoint(checkpoint_file):
+    """
+    Returns {question id: response record} of a checkpoint. A last line cut by a crash is
+    dropped from the file, so that appending to it again keeps it valid JSONL.
+    """
+    records = {}
+    if not os.path.exists(checkpoint_file):
+        return records
+    with open(checkpoint_file, "rb+") as f:
+        data = f.read()
+        complete_size = data.rfind(b"\n") + 1
+        if complete_size < len(data):
+            f.truncate(complete_size)
+    for line in data[:complete_size].splitlines():
+        if line.strip():
+            record = json.loads(line)
+            records[record["id"]] = record
+    return records
+
+def prepare_checkpoint(checkpoint_file, output_file):
+    """
+    Returns the question ids already answered by an earlier run, from its checkpoint or, if that
+    run was finalized, from its results file (which then seeds a new checkpoint).
+    """
+    if not os.path.exists(checkpoint_file) and os.path.exists(output_file):
+        with open(output_file) as f:
+            model_responses = json.load(f)
+        with open(checkpoint_file, "w") as f:
+            for record in model_responses:
+                f.write(json.dumps(record) + "\n")
+    return set(read_checkpoint(checkpoint_file))
+
+def iter_shard_rows(rows, num_shards = 1, shard_index = None):
+    for row in rows:
+        if shard_index is None or shard_index_of(row["question_id"], num_shards) == shard_index:
+            yield row
+
+def iter_pending_rows(rows, done_ids, question_ids):
+    # Records every question id in order (for the final file) and skips the ones already done
+    for row in rows:
+        question_ids.append(row["question_id"])
+        if row["question_id"] not in done_ids:
+            yield row
+
+def write_checkpoint_record(checkpoint, item, completion):
+    record = {
+        "id" : item["id"],
+        "question" : item["question"],
+        "gt" : item["gt"],
+        "response" : completion.text
+    }
+    checkpoint.write(json.dumps(record) + "\n")
+    return record
+
+def finalize_results(checkpoint_file, output_file, question_ids):
+    """
+    Writes the checkpointed responses of question_ids, in that order, to the JSON results file
+    (through a temporary file and an atomic rename) and removes the checkpoint.
+    """
+    records = read_checkpoint(checkpoint_file)
+    missing_ids = [question_id for question_id in question_ids if question_id not in records]
+    if missing_ids:
+        print(f"{len(missing_ids)} questions have no response, keeping {checkpoint_file} to resume from")
+        return False
+
+    tmp_output_file = f"{output_file}.tmp"
+    with open(tmp_output_file, "w") as f:
+        json.dump([records[question_id] for question_id in question_ids], f)
+    os.replace(tmp_output_file, output_file)
+    os.remove(checkpoint_file)
+    return True
+
+def results_file_name(output_folder, model_name, data_source_type):
+    return os.path.join(output_folder, f"{model_name.split('/')[-1]}--{data_source_type}HCTs--results.json")
+
+def scoring_mode_for(data_source_type):
+    # Like score_responses.py: synthetic results get an overall report, the others one per dataset
+    return "synthetic" if data_source_type == "synthetic" else "real"
+
+def merge_llm_shards(model_name_or_path, output_folder = "../../results/model_responses/llms/", data_source_type = "real", split_name = "all", num_shards = 1, dataset_options = None, score = False):
+    dataset = load_hctqa(dataset_options)
+    expected_ids = [row["question_id"] for row in iter_question_rows(dataset, split_name, data_source_type)]
+    output_file = merge_shards(results_file_name(output_folder, model_name_or_path, data_source_type), num_shards, expected_ids)
+    if score:
+        print(score_results_file(output_file, scoring_mode_for(data_source_type)))
+    return output_file
+
+def do_llm_inference(model_name_or_path, output_folder = "../../results/model_responses/llms/", data_source_type = "real", split_name = "all", batch_size = 32, num_gpus = 1, use_system_prompt = True, submission_mode = "chunked", max_in_flight = 256, resume = True, backend_name = "vllm", backend_options = None, num_shards = 1, shard_index = None, request_order = "dataset", response_cache = None, model_revision = None, dataset_options = None, metrics_file = None, gpu_memory_utilization = 0.9, max_num_seqs = None, score = False):
+    model_name = model_name_or_path
+    check_shard_args(num_shards, shard_index)
+    dataset = load_hctqa(dataset_options)
+
+    output_file = results_file_name(output_folder, model_name, data_source_type)
+    if shard_index is not None:
+        output_file = shard_output_file(output_file, shard_index, num_shards)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    checkpoint_file = checkpoint_path(output_file)
+    if resume:
+        done_ids = prepare_checkpoint(checkpoint_file, output_file)
+        if done_ids:
+            print(f"Resuming from {checkpoint_file}: {len(done_ids)} questions already done")
+    else:
+        done_ids = set()
+        open(checkpoint_file, "w").close()
+
+    # Responses of an earlier run are scored from the checkpoint, the new ones as they come in
+    scorer = None
+    if score:
+        scorer = InlineScorer(scoring_mode_for(data_source_type))
+        for record in read_checkpoint(checkpoint_file).values():
+            scorer.score(record)
+
+    use_system_prompt = use_system_prompt and model_supports_system_prompt(model_name)
+    question_ids = []
+    rows = iter_shard_rows(iter_question_rows(dataset, split_name, data_source_type), num_shards, shard_index)
+    rows = iter_pending_rows(rows, done_ids, question_ids)
+    if request_order == "table":
+        # Questions on the same table back to back, question_ids keeps the dataset order for the output
+        rows = order_rows_by_table(rows, prompt_column_for(use_system_prompt))
+    prefix_reuse = PrefixReuseTracker()
+    items = track_prefix_reuse(iter_prompt_items(rows, use_system_prompt), prefix_reuse)
 
-    
     # Initialize the LLM
     # special case for gemma-3
-    try:
-        if "gemma-3" in model_name:
-            llm_model = LLM(model=model_name, gpu_memory_utilization=0.9, tensor_parallel_size=num_gpus, dtype="bfloat16")
-        else:
-            llm_model = LLM(model=model_name, gpu_memory_utilization=0.9, tensor_parallel_size=num_gpus)
-    except Exception as e:
-        raise RuntimeError(f"Failed to initialize model using VLLM (ensure enough GPU RAM and it is a VLLM supported model): {e}")
+    engine_kwargs = {"gpu_memory_utilization": gpu_memory_utilization, "tensor_parallel_size": num_gpus}
+    if max_num_seqs is not None:
+        engine_kwargs["max_num_seqs"] = max_num_seqs
+    if "gemma-3" in model_name:
+        engine_kwargs["dtype"] = "bfloat16"
+    if request_order == "table":
+        engine_kwargs["enable_prefix_caching"] = True
+    if model_revision is not None:
+        engine_kwargs["revision"] = model_revision
+
+    def make_backend():
+        if backend_name == "vllm" and not os.path.isdir(model_name):
+            huggingface_login()
+        try:
+            return build_backend(backend_name, model_name, engine_kwargs, **(backend_options or {}))
+        except Exception as e:
+            raise RuntimeError(f"Failed to initialize model using VLLM (ensure enough GPU RAM and it is a VLLM supported model): {e}")
+
+    # With a response cache the engine is only built if some request is not cached
+    backend = with_response_cache(make_backend, response_cache, model_name, model_revision, backend_name)
 
     # Initialize the sampling parameters
-    sampling_params = SamplingParams(
-        temperature=0.0,
-        max_tokens=128
-    )
-
-    model_responses = []
-    print("Total Batches: ", len(test_batches))
-    for i in range(0, len(test_batches), 1):
-        s_time = time.time()
-        if (use_system_prompt == False) or ("gemma" in model_name and "gemma-3" not in model_name): # gemma and gemm2 models do not support system prompts
-            outputs = llm_model.chat(test_batches[i]["prompts_without_system"],
-                    sampling_params=sampling_params,
-                    use_tqdm=True)
+    sampling_params = {
+        "temperature": 0.0,
+        "max_tokens": 128
+    }
+
+    metrics = None
+    if metrics_file is not None:
+        if shard_index is not None:
+            metrics_file = shard_output_file(metrics_file, shard_index, num_shards)
+        run_settings = dict(engine_kwargs, backend=backend_name, submission_mode=submission_mode, batch_size=batch_size, max_in_flight=max_in_flight, request_order=request_order)
+        metrics = MetricsRecorder(metrics_file, model_name, run_settings)
+
+    prompt_tokens, generated_tokens = 0, 0
+    num_done = 0
+    start_time = time.time()
+    with open(checkpoint_file, "a") as checkpoint:
+        if submission_mode == "continuous":
+            requests = ((item, item["prompt"]) for item in items)
+            for item, completion in backend.stream_chat(requests, sampling_params, max_in_flight):
+                record = write_checkpoint_record(checkpoint, item, completion)
+                if metrics is not None:
+                    metrics.record(item["id"], completion)
+                if scorer is not None:
+                    scorer.score(record)
+                request_prompt_tokens, request_generated_tokens = count_tokens([completion])
+                prompt_tokens += request_prompt_tokens
+                generated_tokens += request_generated_tokens
+                num_done += 1
+                if num_done % CHECKPOINT_FLUSH_EVERY == 0:
+                    checkpoint.flush()
+                if num_done % 1000 == 0:
+                    print(f"{num_done} questions done in {time.time() - start_time} seconds")
+                    if scorer is not None:
+                        print(scorer.progress())
         else:
-            outputs = llm_model.chat(test_batches[i]["prompts"],
-                    sampling_params=sampling_params,
-                    use_tqdm=True)
-
-        print(f"Batch {i} done of {len(test_batches)} in {time.time() - s_time} seconds")
-        
-        for j in range(len(outputs)):
-            model_responses.append({
-                "id" : test_batches[i]["ids"][j],
-                "question" : test_batches[i]["prompts"][j][-1]["content"].split("Question:")[-1].split("?`")[0].strip() + "?",   
-                "gt" : test_batches[i]["gts"][j],
-                "response" : outputs[j].outputs[0].text
-            })
-
-    # Save the model responses to a JSON file
-    with open(os.path.join(output_folder, f"{model_name.split('/')[-1]}--{data_source_type}HCTs--results.json"), 'w') as f:
-        json.dump(model_responses, f)
+            for i, batch in enumerate(iter_prompt_batches(items, batch_size)):
+                s_time = time.time()
+                outputs = backend.chat([item["prompt"] for item in batch],
+                        sampling_params=sampling_params,
+                        use_tqdm=True)
 
-    return True
+                for item, output in zip(batch, outputs):
+                    record = write_checkpoint_record(checkpoint, item, output)
+                    if metrics is not None:
+                        metrics.record(item["id"], output)
+                    if scorer is not None:
+                        scorer.score(record)
+                checkpoint.flush()
+                num_done += len(outputs)
+                print(f"Batch {i} done ({num_done} questions so far) in {time.time() - s_time} seconds")
+                if scorer is not None:
+                    print(scorer.progress())
+
+                batch_prompt_tokens, batch_generated_tokens = count_tokens(outputs)
+                prompt_tokens += batch_prompt_tokens
+                generated_tokens += batch_generated_tokens
+    print_throughput(num_done, prompt_tokens, generated_tokens, time.time() - start_time)
+    print(f"Estimated prefix cache hit ratio ({request_order} order): {prefix_reuse.hit_ratio():.1%} of prompt characters")
+    if backend.stats() is not None:
+        print(backend.stats())
+    backend.close()
+    if metrics is not None:
+        print(format_summary(metrics.close()))
+
+    # Save the model responses to a JSON file, in dataset order
+    finalized = finalize_results(checkpoint_file, output_file, question_ids)
+    if scorer is not None:
+        if finalized:
+            print(scorer.write(output_file, question_ids))
+        else:
+            print(scorer.progress())
+    return finalized
 
 if __name__ == "__main__":
 
@@ -144,16 +394,46 @@ if __name__ == "__main__":
     parser.add_argument("--split_name", type=str, default="all", choices=["train", "validation", "test", "all"], help="Split name to use for inference.")
     parser.add_argument("--batch_size", type=int, default=32, help="Batch size for inference.")
     parser.add_argument("--num_gpus", type=int, default=1, help="Number of GPUs to use for inference.")
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.9, help="Share of GPU memory vllm may use for the model and its KV cache.")
+    parser.add_argument("--max_num_seqs", type=int, default=None, help="Requests vllm decodes at once (engine default if not set).")
+    parser.add_argument("--submission_mode", type=str, default="chunked", choices=["chunked", "continuous"], help="chunked sends batch_size prompts per chat call, continuous keeps up to max_in_flight requests queued in the engine.")
+    parser.add_argument("--max_in_flight", type=int, default=256, help="Requests queued in the engine at once in continuous submission mode.")
+    parser.add_argument("--no_resume", action="store_true", help="Start over instead of skipping the questions already answered in the checkpoint or results file.")
     parser.add_argument("--use_system_prompt", type=bool, default=True, help="Whether to use the system prompt or not.")
+    add_backend_arguments(parser)
+    parser.add_argument("--request_order", type=str, default="dataset", choices=REQUEST_ORDERS, help="table sends the questions on the same table back to back so the engine can reuse their cached prompt prefix. Results keep the dataset order.")
+    add_shard_arguments(parser)
+    add_response_cache_arguments(parser)
+    add_local_dataset_arguments(parser)
+    add_metrics_arguments(parser)
+    add_scoring_arguments(parser)
     args = parser.parse_args()
+    backend_options = backend_options_from_args(args)
+    dataset_options = dataset_options_from_args(args)
 
-    if args.model_name_or_path == "all":
-        for model_name in models_for_exps:
-            do_llm_inference(model_name, args.output_folder, args.data_source_type, args.split_name, args.batch_size, args.num_gpus, args.use_system_prompt)
-    else:
-        do_llm_inference(args.model_name_or_path, args.output_folder, args.data_source_type, args.split_name, args.batch_size, args.num_gpus, args.use_system_prompt)
+    if args.shard_index is not None and args.merge_shards:
+        parser.error("--merge_shards is run once after all shards are done, without --shard_index")
+    if args.num_shards > 1 and args.shard_index is None and not args.merge_shards:
+        parser.error("--num_shards needs --shard_index (or --merge_shards)")
+    model_names = models_for_exps if args.model_name_or_path == "all" else [args.model_name_or_path]
+    response_cache = None if args.response_cache is None else ResponseCache(args.response_cache, args.response_cache_max_mb)
 
-    
+    for model_name in model_names:
+        if args.merge_shards:
+            merge_llm_shards(model_name, args.output_folder, args.data_source_type, args.split_name, args.num_shards, dataset_options, args.score)
+        else:
+            do_llm_inference(model_name, args.output_folder, args.data_source_type, args.split_name, args.batch_size, args.num_gpus, args.use_system_prompt, args.submission_mode, args.max_in_flight, not args.no_resume, args.backend, backend_options,
+                             num_shards=args.num_shards, shard_index=args.shard_index, request_order=args.request_order,
+                             response_cache=response_cache, model_revision=args.model_revision, dataset_options=dataset_options,
+                             metrics_file=args.metrics_file, gpu_memory_utilization=args.gpu_memory_utilization, max_num_seqs=args.max_num_seqs, score=args.score)
 
+    if response_cache is not None:
+        evicted = response_cache.close()
+        print(f"{response_cache.stats()}, {evicted} entries evicted")
 
+# Data parallel run on one 8 GPU node, then merge:
+# for i in $(seq 0 7); do CUDA_VISIBLE_DEVICES=$i python llm_inf.py --model_name_or_path "Qwen/Qwen2.5-7B-Instruct" --num_shards 8 --shard_index $i & done; wait
+# python llm_inf.py --model_name_or_path "Qwen/Qwen2.5-7B-Instruct" --num_shards 8 --merge_shards
 
+# Offline, from the prompts files of the repo (splits other than "all" need a split file, see local_dataset.py):
+# python llm_inf.py --model_name_or_path "/models/Qwen2.5-7B-Instruct" --dataset_source local --split_name test --split_file ../hctqa_splits.json
@@ -0,0 +1,152 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import llm_inf
+from inference_backends import MockBackend
+from local_dataset import load_local_dataset
+
+##########################
+######### CHECKPOINT AND RESUME
+##########################
+# do_llm_inference on the mock backend and a small local dataset: a crashed run keeps its
+# answered questions in checkpoints/, a restarted run only sends the others, and the final
+# results file holds each question id of the dataset exactly once, in dataset order.
+# Run with: python -m pytest -q test_llm_checkpoints.py
+
+NUM_QUESTIONS = 10
+MODEL = "mock-model"
+
+
+class CountingBackend(MockBackend):
+    """
+    Mock engine that records the questions it was asked and fails after crash_after of them.
+    """
+
+    def __init__(self, crash_after=None):
+        super().__init__(MODEL)
+        self.crash_after = crash_after
+        self.asked = []
+
+    def complete(self, prompt, sampling_params):
+        if self.crash_after is not None and len(self.asked) == self.crash_after:
+            raise RuntimeError("engine crashed")
+        self.asked.append(llm_inf.question_from_prompt(prompt))
+        return super().complete(prompt, sampling_params)
+
+
+def question_id(i):
+    return f"arxiv--1--{i // 3}--M{i % 3}"
+
+
+def question(i):
+    # As question_from_prompt reads it from the prompt, backtick included
+    return f"`What is value {i}?"
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    prompts_file = tmp_path / "prompts.jsonl"
+    with open(prompts_file, "w") as f:
+        for i in range(NUM_QUESTIONS):
+            prompt = [{"role": "system", "content": "Answer from the table."},
+                      {"role": "user", "content": f"Table {i // 3}\n\nQuestion: \n`What is value {i}?`\n# OUTPUT: \n`Answer:"}]
+            f.write(json.dumps({"qa_id": question_id(i), "prompt": prompt, "gt": str(i)}) + "\n")
+    dataset = load_local_dataset(str(tmp_path / "cache.arrow"), {"realWorldHCTs": str(prompts_file)})
+    monkeypatch.setattr(llm_inf, "load_hctqa", lambda dataset_options=None: dataset)
+    output_folder = str(tmp_path / "results")
+    os.makedirs(output_folder)
+
+    def run_inference(backend, resume=True, **kwargs):
+        monkeypatch.setattr(llm_inf, "build_backend", lambda *args, **backend_kwargs: backend)
+        return llm_inf.do_llm_inference(MODEL, output_folder, backend_name="mock", batch_size=3, resume=resume, **kwargs)
+
+    run_inference.output_file = llm_inf.results_file_name(output_folder, MODEL, "real")
+    run_inference.checkpoint_file = os.path.join(output_folder, "checkpoints", os.path.basename(run_inference.output_file) + ".partial.jsonl")
+    return run_inference
+
+
+def read_results(output_file):
+    with open(output_file) as f:
+        return json.load(f)
+
+
+def write_checkpoint(checkpoint_file, ids, response="from checkpoint", tail=""):
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    with open(checkpoint_file, "w") as f:
+        for i in ids:
+            f.write(json.dumps({"id": question_id(i), "question": question(i), "gt": str(i), "response": response}) + "\n")
+        f.write(tail)
+
+
+def check_complete(output_file):
+    records = read_results(output_file)
+    assert [record["id"] for record in records] == [question_id(i) for i in range(NUM_QUESTIONS)]
+    return records
+
+
+def test_resume_after_a_crash_sends_only_the_rest(run):
+    crashed = CountingBackend(crash_after=4)
+    with pytest.raises(RuntimeError):
+        run(crashed)
+    assert not os.path.exists(run.output_file)
+    # Chunked mode checkpoints whole batches of 3, the 4 answers before the crash leave one batch
+    with open(run.checkpoint_file) as f:
+        assert len(f.readlines()) == 3
+
+    resumed = CountingBackend()
+    assert run(resumed)
+    assert resumed.asked == [question(i) for i in range(3, NUM_QUESTIONS)]
+    check_complete(run.output_file)
+    assert not os.path.exists(run.checkpoint_file)
+
+
+@pytest.mark.parametrize("submission_mode", ["chunked", "continuous"])
+def test_truncated_last_line_is_answered_again(run, submission_mode):
+    cut_line = json.dumps({"id": question_id(2), "response": "cut"})[:20]
+    write_checkpoint(run.checkpoint_file, [0, 1], tail=cut_line)
+    backend = CountingBackend()
+    assert run(backend, submission_mode=submission_mode)
+    assert sorted(backend.asked) == sorted(question(i) for i in range(2, NUM_QUESTIONS))
+    records = check_complete(run.output_file)
+    assert [record["response"] for record in records[:2]] == ["from checkpoint"] * 2
+    assert records[2]["response"] != "from checkpoint"
+
+
+def test_no_resume_answers_everything_again(run):
+    write_checkpoint(run.checkpoint_file, range(5))
+    backend = CountingBackend()
+    assert run(backend, resume=False)
+    assert len(backend.asked) == NUM_QUESTIONS
+    assert all(record["response"] != "from checkpoint" for record in check_complete(run.output_file))
+
+
+def test_finished_run_is_resumed_from_its_results_file(run):
+    assert run(CountingBackend())
+    backend = CountingBackend()
+    assert run(backend)
+    assert backend.asked == []
+    check_complete(run.output_file)
+
+
+def test_finalize_writes_exactly_the_question_ids(tmp_path):
+    checkpoint_file = str(tmp_path / "checkpoints" / "out.json.partial.jsonl")
+    output_file = str(tmp_path / "out.json")
+    # Out of order, answered twice, and one id the run did not ask for
+    write_checkpoint(checkpoint_file, [3, 1, 0, 2, 1, 7])
+    question_ids = [question_id(i) for i in range(4)]
+    assert llm_inf.finalize_results(checkpoint_file, output_file, question_ids)
+    assert [record["id"] for record in read_results(output_file)] == question_ids
+    assert not os.path.exists(checkpoint_file)
+
+
+def test_finalize_keeps_the_checkpoint_when_ids_are_missing(tmp_path):
+    checkpoint_file = str(tmp_path / "checkpoints" / "out.json.partial.jsonl")
+    output_file = str(tmp_path / "out.json")
+    write_checkpoint(checkpoint_file, [0, 1])
+    assert not llm_inf.finalize_results(checkpoint_file, output_file, [question_id(i) for i in range(3)])
+    assert not os.path.exists(output_file)
+    assert os.path.exists(checkpoint_file)
@@ -0,0 +1,235 @@
+import argparse
+import gzip
+import json
+import os
+
+####################################################################################################################
+############################################# LOCAL DATASET ########################################################
+####################################################################################################################
+# Offline stand-in for load_dataset("qcri-ai/HCTQA") built from the prompts files shipped with the
+# repo. The first use converts them into one Arrow IPC file that is memory mapped afterwards. Every
+# record batch of that file holds rows of a single (dataset_type, split), so reading one split of
+# one dataset type only touches the pages of its own batches. The cache is rebuilt when a source
+# file changes.
+#
+# The prompts files carry no split. Splits come from a "split" key in the records or from a split
+# file ({question_id: split}, written once from the Hugging Face dataset with --export_split_file).
+# Without either, only split "all" is available.
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+DEFAULT_PROMPT_FILES = {
+    "realWorldHCTs": os.path.join(REPO_ROOT, "datasets", "realWorld_datasets", "prompts", "realWorld_HCT-all_prompts.jsonl.gz"),
+    "syntheticHCTs": os.path.join(REPO_ROOT, "synthetic_data_generator", "prompts", "synthetic_HCT-text_based-all_prompts.jsonl.gz"),
+}
+DEFAULT_CACHE_FILE = os.path.join(REPO_ROOT, "datasets", ".cache", "hctqa_prompts.arrow")
+SPLIT_NAMES = ["train", "validation", "test"]
+COLUMNS = ["question_id", "table_id", "dataset_type", "split", "prompt", "prompt_without_system", "answer"]
+BATCH_ROWS = 1000
+NO_SPLIT = ""
+
+
+def import_pyarrow():
+    # Imported on first use, so the scripts that only take the options of this module start fast
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("The local dataset source needs pyarrow (pip install pyarrow).")
+    return pyarrow
+
+
+def find_prompt_file(path):
+    # format_files.sh inflates the .jsonl.gz files next to themselves, either one will do
+    for candidate in (path, path[:-len(".gz")] if path.endswith(".gz") else path + ".gz"):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def iter_prompt_records(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_split_file(split_file):
+    if split_file is None:
+        return {}
+    with open(split_file, "r") as f:
+        return json.load(f)
+
+
+def source_signature(prompt_files, split_file):
+    signature = []
+    for path in sorted(prompt_files.values()) + ([split_file] if split_file else []):
+        stat = os.stat(path)
+        signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+    return json.dumps(signature)
+
+
+def row_of(record, dataset_type, split_map):
+    prompt = record["prompt"]
+    if isinstance(prompt, str):
+        prompt = json.loads(prompt)
+    question_id = record.get("qa_id", record.get("question_id"))
+    return {
+        "question_id": question_id,
+        "table_id": record.get("table_id", question_id.rsplit("--", 1)[0]),
+        "dataset_type": dataset_type,
+        "split": record.get("split") or split_map.get(question_id, NO_SPLIT),
+        "prompt": json.dumps(prompt),
+        "prompt_without_system": json.dumps([message for message in prompt if message["role"] != "system"]),
+        "answer": record.get("gt", record.get("answer")),
+    }
+
+
+def build_cache(cache_file, prompt_files, split_file=None):
+    """
+    Converts the prompts files into the Arrow cache file, one dataset type at a time, flushing
+    a record batch whenever a (dataset_type, split) group has BATCH_ROWS rows.
+    """
+    pa = import_pyarrow()
+    split_map = read_split_file(split_file)
+    schema = pa.schema([(column, pa.string()) for column in COLUMNS], metadata={"sources": source_signature(prompt_files, split_file)})
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    tmp_file = f"{cache_file}.tmp-{os.getpid()}"
+    num_rows = 0
+    with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        def flush(rows):
+            writer.write_batch(pa.RecordBatch.from_pydict({column: [row[column] for row in rows] for column in COLUMNS}, schema=schema))
+
+        for dataset_type, path in prompt_files.items():
+            groups = {}
+            for record in iter_prompt_records(path):
+                row = row_of(record, dataset_type, split_map)
+                group = groups.setdefault(row["split"], [])
+                group.append(row)
+                num_rows += 1
+                if len(group) == BATCH_ROWS:
+                    flush(group)
+                    groups[row["split"]] = []
+            for group in groups.values():
+                if group:
+                    flush(group)
+    # Parallel shards may build at the same time, the last complete file wins
+    os.replace(tmp_file, cache_file)
+    return num_rows
+
+
+class LocalHCTQADataset:
+    """
+    Memory mapped view of the cache file. iter_batches(split, dataset_type, columns) yields
+    {column: list} batches like datasets' Dataset.iter, reading only the batches of that group.
+    """
+
+    def __init__(self, cache_file):
+        pa = import_pyarrow()
+        self.cache_file = cache_file
+        self.reader = pa.ipc.open_file(pa.memory_map(cache_file, "r"))
+        self.groups = []
+        for i in range(self.reader.num_record_batches):
+            batch = self.reader.get_batch(i)
+            self.groups.append((batch.column(COLUMNS.index("dataset_type"))[0].as_py(), batch.column(COLUMNS.index("split"))[0].as_py()))
+
+    def dataset_types(self):
+        return sorted({dataset_type for dataset_type, _ in self.groups})
+
+    def splits(self):
+        return sorted({split for _, split in self.groups if split != NO_SPLIT})
+
+    def iter_batches(self, split="all", dataset_type=None, columns=COLUMNS):
+        if dataset_type is not None and dataset_type not in self.dataset_types():
+            raise ValueError(f"No {dataset_type} rows in {self.cache_file}. Is its prompts file missing?")
+        if split == "all":
+            # Known splits in the usual order, then the rows without a split
+            wanted = SPLIT_NAMES + [s for s in self.splits() if s not in SPLIT_NAMES] + [NO_SPLIT]
+        elif split in self.splits():
+            wanted = [split]
+        else:
+            raise ValueError(f"No '{split}' split in {self.cache_file}. The prompts files carry no splits, pass a split file "
+                             f"(written with local_dataset.py --export_split_file) or use split 'all'.")
+        for wanted_split in wanted:
+            for i, (group_type, group_split) in enumerate(self.groups):
+                if group_split == wanted_split and (dataset_type is None or group_type == dataset_type):
+                    batch = self.reader.get_batch(i)
+                    yield {column: batch.column(COLUMNS.index(column)).to_pylist() for column in columns}
+
+    def iter_rows(self, split="all", dataset_type=None, columns=COLUMNS):
+        for batch in self.iter_batches(split, dataset_type, columns):
+            for j in range(len(batch[columns[0]])):
+                yield {column: batch[column][j] for column in columns}
+
+
+def load_local_dataset(cache_file=DEFAULT_CACHE_FILE, prompt_files=None, split_file=None, rebuild=False):
+    """
+    Opens the local dataset, (re)building its cache first if it is missing, older than its
+    sources or was built from other files. Needs no network.
+    """
+    pa = import_pyarrow()
+    prompt_files = {dataset_type: find_prompt_file(path) for dataset_type, path in (prompt_files or DEFAULT_PROMPT_FILES).items()}
+    missing = [dataset_type for dataset_type, path in prompt_files.items() if path is None]
+    prompt_files = {dataset_type: path for dataset_type, path in prompt_files.items() if path is not None}
+    if not prompt_files:
+        raise FileNotFoundError("None of the prompts files exist. Run from the repository or pass the prompts files.")
+
+    signature = source_signature(prompt_files, split_file)
+    if not rebuild and os.path.exists(cache_file):
+        metadata = pa.ipc.open_file(pa.memory_map(cache_file, "r")).schema.metadata or {}
+        rebuild = metadata.get(b"sources", b"").decode("utf-8") != signature
+    else:
+        rebuild = True
+    if rebuild:
+        print(f"Building local dataset cache {cache_file}")
+        for dataset_type in missing:
+            print(f"No prompts file for {dataset_type}, the local dataset has none of its rows")
+        num_rows = build_cache(cache_file, prompt_files, split_file)
+        print(f"Cached {num_rows} questions")
+    return LocalHCTQADataset(cache_file)
+
+
+def export_split_file(split_file, dataset_name="qcri-ai/HCTQA"):
+    """
+    Writes {question_id: split} of the Hugging Face dataset, to carry its splits to offline machines.
+    """
+    from datasets import load_dataset
+    dataset = load_dataset(dataset_name)
+    split_map = {}
+    for split in dataset:
+        for batch in dataset[split].select_columns(["question_id"]).iter(batch_size=BATCH_ROWS):
+            split_map.update((question_id, split) for question_id in batch["question_id"])
+    with open(split_file, "w") as f:
+        json.dump(split_map, f)
+    return len(split_map)
+
+
+def add_local_dataset_arguments(parser):
+    parser.add_argument("--dataset_source", type=str, default="hf", choices=["hf", "local"], help="hf loads qcri-ai/HCTQA from Hugging Face, local reads the prompts files of the repo through a memory mapped cache, without network.")
+    parser.add_argument("--local_cache", type=str, default=DEFAULT_CACHE_FILE, help="Arrow cache file of the local dataset source, built on first use.")
+    parser.add_argument("--split_file", type=str, default=None, help="JSON {question_id: split} giving the splits of the local dataset source (see local_dataset.py --export_split_file).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the local HCT-QA dataset cache or export the Hugging Face splits for it.")
+    parser.add_argument("--local_cache", type=str, default=DEFAULT_CACHE_FILE, help="Arrow cache file to build.")
+    parser.add_argument("--split_file", type=str, default=None, help="JSON {question_id: split} to build the cache with.")
+    parser.add_argument("--export_split_file", type=str, default=None, help="Write the splits of the Hugging Face dataset to this JSON file (needs network) instead of building.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the cache even if it is up to date.")
+    args = parser.parse_args()
+
+    if args.export_split_file:
+        print(f"Wrote the split of {export_split_file(args.export_split_file)} questions to {args.export_split_file}")
+    else:
+        dataset = load_local_dataset(args.local_cache, split_file=args.split_file, rebuild=args.rebuild)
+        for dataset_type in dataset.dataset_types():
+            counts = {}
+            for batch in dataset.iter_batches("all", dataset_type, ["split"]):
+                for split in batch["split"]:
+                    counts[split or "no split"] = counts.get(split or "no split", 0) + 1
+            print(f"{dataset_type}: {counts}")
+
+# Example usage:
+# python local_dataset.py --export_split_file hctqa_splits.json   (once, on a machine with network)
+# python local_dataset.py --split_file hctqa_splits.json
+# cd llm_inference && python llm_inf.py --model_name_or_path "Qwen/Qwen2.5-7B-Instruct" --dataset_source local --split_file ../hctqa_splits.json
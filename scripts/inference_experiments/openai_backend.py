@@ -0,0 +1,169 @@
+import asyncio
+import os
+import random
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from inference_backends import InferenceBackend, Completion, percentiles
+
+##########################
+######### OPENAI COMPATIBLE HTTP BACKEND
+##########################
+# For models served behind an OpenAI compatible endpoint (vllm serve, TGI, ...) instead of loaded
+# in process. Requests go out concurrently from one asyncio event loop over a pooled aiohttp
+# session, at most max_concurrency at a time, and failed requests (connection errors, 429, 5xx)
+# are retried with exponential backoff. Results come back through the same Completion interface
+# as the in process backends, so the output files are unchanged.
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+DEFAULT_BASE_URL = "http://localhost:8000/v1"
+
+
+class HTTPRequestError(Exception):
+    pass
+
+
+class OpenAIHTTPBackend(InferenceBackend):
+    name = "openai"
+
+    def __init__(self, model, base_url=DEFAULT_BASE_URL, api_key=None, max_concurrency=64, max_retries=5, backoff=0.5, timeout=600):
+        if aiohttp is None:
+            raise ImportError("The openai backend needs aiohttp (pip install aiohttp).")
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key if api_key is not None else os.getenv("OPENAI_API_KEY", "EMPTY")
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.semaphore = None
+        self.latencies = []
+        self.in_flight = 0
+        self.retries = 0
+        self.first_request_time = None
+        self.last_response_time = None
+
+    async def _open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @staticmethod
+    def request_body(prompt, sampling_params, model):
+        if isinstance(prompt, list):
+            return "chat/completions", dict(sampling_params, model=model, messages=prompt)
+        if isinstance(prompt, str):
+            return "completions", dict(sampling_params, model=model, prompt=prompt)
+        if isinstance(prompt, dict) and "prompt_token_ids" in prompt:
+            return "completions", dict(sampling_params, model=model, prompt=prompt["prompt_token_ids"])
+        raise ValueError("The openai backend takes chat messages, text prompts or token ids. Send images as image_url parts of chat messages.")
+
+    async def _post(self, prompt, sampling_params):
+        endpoint, body = self.request_body(prompt, sampling_params, self.model)
+        url = f"{self.base_url}/{endpoint}"
+        async with self.semaphore:
+            # Latency of a request includes its retries
+            start = time.perf_counter()
+            if self.first_request_time is None:
+                self.first_request_time = start
+            self.in_flight += 1
+            occupancy = self.in_flight
+            try:
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        async with self.session.post(url, json=body) as response:
+                            if response.status == 200:
+                                result = await response.json()
+                                break
+                            error = f"HTTP {response.status}: {(await response.text())[:200]}"
+                            if response.status not in RETRY_STATUSES:
+                                raise HTTPRequestError(error)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        error = repr(e)
+                    if attempt == self.max_retries:
+                        raise HTTPRequestError(f"{url} failed after {self.max_retries + 1} attempts: {error}")
+                    self.retries += 1
+                    await asyncio.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+            finally:
+                # Failed and cancelled requests leave the count too
+                self.in_flight -= 1
+
+        end = time.perf_counter()
+        self.latencies.append(end - start)
+        self.last_response_time = end
+        choice = result["choices"][0]
+        text = choice["message"]["content"] if "message" in choice else choice["text"]
+        usage = result.get("usage") or {}
+        # Responses are not streamed, so there is no time to first token
+        return Completion(text or "", usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), latency=end - start, batch_occupancy=occupancy)
+
+    async def _gather(self, prompts, sampling_params):
+        await self._open()
+        tasks = [asyncio.ensure_future(self._post(prompt, sampling_params)) for prompt in prompts]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # After a failed request the rest of the batch would stay pending in the loop until
+            # the next call, counted as in flight. Cancel them instead.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def chat(self, prompts, sampling_params, use_tqdm=False):
+        return self.loop.run_until_complete(self._gather(prompts, sampling_params))
+
+    def generate(self, prompts, sampling_params, use_tqdm=False):
+        if isinstance(prompts, (str, dict)):
+            prompts = [prompts]
+        return self.loop.run_until_complete(self._gather(prompts, sampling_params))
+
+    def stream_chat(self, requests, sampling_params, max_in_flight=256):
+        self.loop.run_until_complete(self._open())
+        requests = iter(requests)
+        in_flight = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                    break
+                tag, messages = request
+                in_flight[self.loop.create_task(self._post(messages, sampling_params))] = tag
+            if not in_flight:
+                return
+            try:
+                done, _ = self.loop.run_until_complete(asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield in_flight.pop(task), task.result()
+            except BaseException:
+                # A failed request or a caller that stops early cancels the requests still in flight
+                for task in in_flight:
+                    task.cancel()
+                self.loop.run_until_complete(asyncio.gather(*in_flight, return_exceptions=True))
+                raise
+
+    def stats(self):
+        if not self.latencies:
+            return None
+        p50, p95, p99 = percentiles(self.latencies, [50, 95, 99])
+        seconds = max(self.last_response_time - self.first_request_time, 1e-9)
+        return (f"HTTP backend: {len(self.latencies)} requests, {len(self.latencies) / seconds:.2f} requests/s, {self.retries} retries, "
+                f"latency p50 {p50:.3f}s p95 {p95:.3f}s p99 {p99:.3f}s")
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.session = None
+        self.loop.close()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from inference_backends import MockBackend
+
+##########################
+######### OPENAI COMPATIBLE STUB SERVER
+##########################
+# A local stand-in for an OpenAI compatible model server, to run the openai backend of
+# llm_inf.py / vlm_inf.py without GPUs. Answers /v1/chat/completions and /v1/completions like the
+# mock engine (echo or a canned response) after a fixed latency, and fails a share of the requests
+# with 503 so the retry path is exercised.
+
+
+def make_handler(mock, latency, failure_rate, rng):
+    rng_lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client cancelled the request or gave up waiting
+                self.close_connection = True
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.endswith(("/chat/completions", "/completions")):
+                self._reply(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+                return
+            with rng_lock:
+                fail = rng.random() < failure_rate
+            time.sleep(latency)
+            if fail:
+                self._reply(503, {"error": {"message": "Stub server overloaded"}})
+                return
+
+            chat = "messages" in request
+            sampling_params = {"max_tokens": request.get("max_tokens", 16)}
+            completion = mock.complete(request["messages"] if chat else request.get("prompt", ""), sampling_params)
+            choice = {"index": 0, "finish_reason": "stop"}
+            if chat:
+                choice["message"] = {"role": "assistant", "content": completion.text}
+            else:
+                choice["text"] = completion.text
+            self._reply(200, {
+                "object": "chat.completion" if chat else "text_completion",
+                "model": request.get("model"),
+                "choices": [choice],
+                "usage": {"prompt_tokens": completion.prompt_tokens, "completion_tokens": completion.generated_tokens,
+                          "total_tokens": completion.prompt_tokens + completion.generated_tokens},
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def serve(host="127.0.0.1", port=8000, response="echo", latency=0.0, failure_rate=0.0, seed=0):
+    """
+    Starts the stub server in a background thread and returns it (server.shutdown() stops it).
+    """
+    handler = make_handler(MockBackend(response=response), latency, failure_rate, random.Random(seed))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI compatible stub server answering like the mock engine")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--response", type=str, default="echo", help="Response of every request, 'echo' returns the question of the prompt")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of requests answered with HTTP 503")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the failures")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.response, args.latency, args.failure_rate, args.seed)
+    print(f"Stub server on http://{args.host}:{args.port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+# Example usage:
+# python openai_stub_server.py --port 8000 --latency 0.05 --failure_rate 0.02
+# cd llm_inference && python llm_inf.py --model_name_or_path "Qwen/Qwen2.5-7B-Instruct" --backend openai --api_base_url http://127.0.0.1:8000/v1
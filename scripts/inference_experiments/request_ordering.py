@@ -0,0 +1,81 @@
+from collections import OrderedDict
+
+from sharding import table_id_of
+
+####################################################################################################################
+############################################# PREFIX AWARE ORDERING ################################################
+####################################################################################################################
+# HCT-QA prompts are laid out as system prompt, instructions, serialized table and only then the
+# question, so every question on a table shares a long prompt prefix. The engine's automatic
+# prefix caching can only reuse it while that prefix is still cached, which in dataset order it
+# rarely is. Ordering the requests by system prompt and table id sends the questions of a table
+# back to back. The results are still written in dataset order by the callers.
+
+REQUEST_ORDERS = ["dataset", "table"]
+DEFAULT_CACHED_PREFIXES = 64
+
+
+def shared_prefix_of(prompt_text):
+    # Everything before the question: system prompt, instructions and table
+    cut = prompt_text.rfind("Question:")
+    return prompt_text if cut < 0 else prompt_text[:cut]
+
+
+def order_rows_by_table(rows, prompt_column):
+    """
+    Returns the rows sorted by (system prompt and instructions, table id), keeping dataset order
+    within a table. Only the raw prompt strings are looked at, nothing is parsed.
+    """
+    def key(row):
+        prompt = row[prompt_column]
+        cut = prompt.find("Table:")
+        return (prompt if cut < 0 else prompt[:cut], table_id_of(row["question_id"]))
+    return sorted(rows, key=key)
+
+
+def common_prefix_length(a, b):
+    # Binary search on slice comparisons, which run in C, instead of a per character loop
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class PrefixReuseTracker:
+    """
+    Estimates how much of each prompt an LRU prefix cache holding the prefixes of the last
+    max_prefixes tables could reuse: the longest common prefix with the previous prompt or with
+    the last prompt that had the same table prefix. The ratio is over prompt characters.
+    """
+
+    def __init__(self, max_prefixes=DEFAULT_CACHED_PREFIXES):
+        self.max_prefixes = max_prefixes
+        self.cached = OrderedDict()
+        self.previous = ""
+        self.prompt_chars = 0
+        self.reused_chars = 0
+
+    def add(self, prompt_text):
+        """
+        Records a prompt sent to the engine and returns the number of its characters that hit the cache.
+        """
+        prefix = shared_prefix_of(prompt_text)
+        reused = common_prefix_length(prompt_text, self.previous)
+        if prefix in self.cached:
+            reused = max(reused, common_prefix_length(prompt_text, self.cached[prefix]))
+            self.cached.move_to_end(prefix)
+        self.cached[prefix] = prompt_text
+        if len(self.cached) > self.max_prefixes:
+            self.cached.popitem(last=False)
+        self.previous = prompt_text
+
+        self.prompt_chars += len(prompt_text)
+        self.reused_chars += reused
+        return reused
+
+    def hit_ratio(self):
+        return self.reused_chars / self.prompt_chars if self.prompt_chars else 0.0
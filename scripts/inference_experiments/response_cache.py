@@ -0,0 +1,241 @@
+import collections
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+
+from inference_backends import InferenceBackend, Completion
+
+####################################################################################################################
+############################################# RESPONSE CACHE #######################################################
+####################################################################################################################
+# The same models are run on the same prompts again and again (new scorer versions, re-splits,
+# sweeps that die halfway), so responses are kept in an SQLite file keyed by the backend, the
+# model (id and revision), a hash of the exact prompt and the sampling parameters. CachedBackend
+# answers the requests it finds there without touching the engine, which is only built on the
+# first miss.
+
+DEFAULT_CACHE_MAX_MB = 1024
+# Backends whose responses are never read from or written to the cache: mock answers are not
+# model answers
+UNCACHED_BACKENDS = ["mock"]
+# last_used of cache hits is kept in memory and written in one short transaction this often,
+# reads never hold the write lock of a file shared by parallel shards
+TOUCH_FLUSH_EVERY = 1000
+# Seconds a connection waits for the write lock of another process
+LOCK_TIMEOUT = 60
+ROW_OVERHEAD_BYTES = 128
+
+
+def _encode(value):
+    # Images and other non JSON values of a prompt are hashed by content
+    if hasattr(value, "tobytes"):
+        return {"bytes_sha256": hashlib.sha256(value.tobytes()).hexdigest(), "size": list(getattr(value, "size", []))}
+    return repr(value)
+
+
+def model_fingerprint(model, revision=None, backend="vllm"):
+    """
+    Backend, model id and revision. The backend is part of it since an openai endpoint may serve
+    another build or quantization of the model than the in process engine. Local models without a
+    revision are identified by the modification time of their config, so retrained checkpoints
+    saved to the same folder do not hit old entries.
+    """
+    if revision is None and os.path.isdir(model):
+        config_file = os.path.join(model, "config.json")
+        if os.path.exists(config_file):
+            revision = f"mtime-{os.path.getmtime(config_file)}"
+    return f"{backend}:{model}@{revision or 'main'}"
+
+
+class ResponseCache:
+    """
+    Completions stored by request key in SQLite, evicted least recently used first once the
+    stored responses take more than max_size_mb.
+    """
+
+    def __init__(self, path, max_size_mb=DEFAULT_CACHE_MAX_MB):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        # Shards running in parallel may share the file, wait for their writes instead of failing.
+        # Every write is committed at once, so the write lock is only held for one statement.
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, text TEXT, "
+            "prompt_tokens INTEGER, generated_tokens INTEGER, size INTEGER, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.hits = 0
+        self.misses = 0
+        self.touched = {}
+
+    @staticmethod
+    def key_for(model_fingerprint, prompt, sampling_params):
+        payload = json.dumps([model_fingerprint, prompt, sampling_params], sort_keys=True, default=_encode)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT text, prompt_tokens, generated_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched[key] = time.time()
+        if len(self.touched) >= TOUCH_FLUSH_EVERY:
+            self.flush_touched()
+        completion = Completion(*row)
+        completion.cached = True
+        return completion
+
+    def put(self, key, model, completion):
+        self.put_many([(key, model, completion)])
+
+    def put_many(self, entries):
+        """
+        Stores (key, model, completion) entries in one transaction, committed at once.
+        """
+        now = time.time()
+        rows = [(key, model, completion.text, completion.prompt_tokens, completion.generated_tokens,
+                 len(completion.text.encode("utf-8")) + len(key) + ROW_OVERHEAD_BYTES, now)
+                for key, model, completion in entries]
+        if rows:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def flush_touched(self):
+        # Writes the last_used times of the hits since the last flush
+        if self.touched:
+            with self.db:
+                self.db.executemany("UPDATE responses SET last_used = ? WHERE key = ?", [(t, key) for key, t in self.touched.items()])
+            self.touched = {}
+
+    def evict(self):
+        """
+        Deletes least recently used responses until the cache fits in max_size_mb, returns how many.
+        """
+        self.flush_touched()
+        total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = 0
+        if total_size > self.max_size_bytes:
+            to_delete = []
+            for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                if total_size <= self.max_size_bytes:
+                    break
+                to_delete.append((key,))
+                total_size -= size
+            with self.db:
+                self.db.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+            evicted = len(to_delete)
+        if evicted:
+            # Give the space back to the file system
+            self.db.execute("VACUUM")
+        return evicted
+
+    def close(self):
+        evicted = self.evict()
+        self.db.close()
+        return evicted
+
+    def stats(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return f"Response cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)"
+
+
+class CachedBackend(InferenceBackend):
+    """
+    Answers requests from a ResponseCache and sends only the misses to the backend built by
+    backend_factory, which is called the first time a request misses.
+    """
+
+    def __init__(self, backend_factory, cache, model, revision=None, backend_name="vllm"):
+        if backend_name in UNCACHED_BACKENDS:
+            raise ValueError(f"The {backend_name} backend is not cached.")
+        self.backend_factory = backend_factory
+        self._backend = None
+        self.cache = cache
+        self.model = model
+        self.fingerprint = model_fingerprint(model, revision, backend_name)
+        self.name = "cached"
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = self.backend_factory()
+        return self._backend
+
+    def _cached_batch(self, prompts, sampling_params, send):
+        keys = [self.cache.key_for(self.fingerprint, prompt, sampling_params) for prompt in prompts]
+        completions = [self.cache.get(key) for key in keys]
+        missing = [i for i, completion in enumerate(completions) if completion is None]
+        if missing:
+            for i, completion in zip(missing, send([prompts[i] for i in missing])):
+                completions[i] = completion
+            self.cache.put_many([(keys[i], self.model, completions[i]) for i in missing])
+        return completions
+
+    def chat(self, prompts, sampling_params, use_tqdm=False):
+        return self._cached_batch(prompts, sampling_params, lambda misses: self.backend.chat(misses, sampling_params, use_tqdm))
+
+    def generate(self, prompts, sampling_params, use_tqdm=False):
+        if isinstance(prompts, (str, dict)):
+            prompts = [prompts]
+        return self._cached_batch(prompts, sampling_params, lambda misses: self.backend.generate(misses, sampling_params, use_tqdm))
+
+    def stats(self):
+        return None if self._backend is None else self._backend.stats()
+
+    def close(self):
+        if self._backend is not None:
+            self._backend.close()
+
+    def stream_chat(self, requests, sampling_params, max_in_flight=256):
+        hits = collections.deque()
+
+        def misses():
+            for tag, messages in requests:
+                key = self.cache.key_for(self.fingerprint, messages, sampling_params)
+                completion = self.cache.get(key)
+                if completion is None:
+                    yield (tag, key), messages
+                else:
+                    hits.append((tag, completion))
+
+        pending = misses()
+        first_miss = next(pending, None)
+        while hits:
+            yield hits.popleft()
+        if first_miss is None:
+            return
+        for (tag, key), completion in self.backend.stream_chat(itertools.chain([first_miss], pending), sampling_params, max_in_flight):
+            self.cache.put(key, self.model, completion)
+            while hits:
+                yield hits.popleft()
+            yield tag, completion
+        while hits:
+            yield hits.popleft()
+
+
+def with_response_cache(backend_factory, cache, model, revision=None, backend_name="vllm"):
+    """
+    CachedBackend over backend_factory, or the backend itself when there is no cache or the
+    backend is not cached.
+    """
+    if cache is None:
+        return backend_factory()
+    if backend_name in UNCACHED_BACKENDS:
+        print(f"The response cache is not used with the {backend_name} backend")
+        return backend_factory()
+    return CachedBackend(backend_factory, cache, model, revision, backend_name)
+
+
+def add_response_cache_arguments(parser):
+    parser.add_argument("--response_cache", type=str, default=None, help="SQLite file of cached responses. Requests already answered by the same model with the same prompt and sampling parameters are not sent to the engine.")
+    parser.add_argument("--response_cache_max_mb", type=float, default=DEFAULT_CACHE_MAX_MB, help="Size limit of the response cache, least recently used responses are evicted first.")
+    parser.add_argument("--model_revision", type=str, default=None, help="Model revision recorded in the response cache keys.")
@@ -0,0 +1,96 @@
+import json
+import os
+import zlib
+
+####################################################################################################################
+############################################# DATA PARALLEL SHARDS #################################################
+####################################################################################################################
+# A run can be split into num_shards independent processes (e.g. one model replica per GPU with
+# CUDA_VISIBLE_DEVICES=i ... --num_shards 8 --shard_index i). Questions are assigned to shards by a
+# stable hash of their table id, so every shard gets the same questions on every run and node, and
+# all questions of a table stay in one shard. Each shard writes its own file under
+# <output_folder>/shards/, and the merge step checks them and writes the canonical results file.
+#
+# llm_inf.py shards resume from their checkpoint after a crash. vlm_inf.py shards do not: a shard
+# run again appends its answers to the shard file a second time, and the merge refuses the file
+# for its duplicate ids. Remove the shard file of a crashed vlm shard before running it again.
+
+
+def table_id_of(question_id):
+    # "arxiv--1--1118--M0" -> "arxiv--1--1118"
+    return question_id.rsplit("--", 1)[0]
+
+
+def shard_index_of(question_id, num_shards):
+    return zlib.crc32(table_id_of(question_id).encode("utf-8")) % num_shards
+
+
+def check_shard_args(num_shards, shard_index):
+    if num_shards < 1:
+        raise ValueError("num_shards must be at least 1.")
+    if shard_index is not None and not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be between 0 and {num_shards - 1}.")
+
+
+def shard_output_file(output_file, shard_index, num_shards):
+    # ".../m--realHCTs--results.json" -> ".../shards/m--realHCTs--results.shard-3-of-8.json"
+    folder, fname = os.path.split(output_file)
+    root, ext = os.path.splitext(fname)
+    return os.path.join(folder, "shards", f"{root}.shard-{shard_index}-of-{num_shards}{ext}")
+
+
+def read_result_records(fname):
+    with open(fname) as f:
+        if fname.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def merge_shards(output_file, num_shards, expected_ids):
+    """
+    Merges the shard files of output_file into output_file, with the records in the order of
+    expected_ids. Raises a ValueError, without writing anything, when a shard file is missing,
+    an id is answered twice or an expected id is not answered.
+    """
+    shard_files = [shard_output_file(output_file, i, num_shards) for i in range(num_shards)]
+    missing_shards = [f for f in shard_files if not os.path.exists(f)]
+    if missing_shards:
+        raise ValueError(f"Missing shard files: {missing_shards}")
+
+    records = {}
+    duplicate_ids = []
+    for shard_file in shard_files:
+        for record in read_result_records(shard_file):
+            if record["id"] in records:
+                duplicate_ids.append(record["id"])
+            records[record["id"]] = record
+
+    expected_ids = list(expected_ids)
+    missing_ids = [question_id for question_id in expected_ids if question_id not in records]
+    unexpected_ids = set(records) - set(expected_ids)
+    problems = []
+    if duplicate_ids:
+        problems.append(f"{len(duplicate_ids)} duplicate ids (e.g. {duplicate_ids[:5]}, a vlm shard run twice appends to its file, remove it and run the shard again)")
+    if missing_ids:
+        problems.append(f"{len(missing_ids)} missing ids (e.g. {missing_ids[:5]})")
+    if unexpected_ids:
+        problems.append(f"{len(unexpected_ids)} ids that are not in the question set (e.g. {sorted(unexpected_ids)[:5]})")
+    if problems:
+        raise ValueError(f"Cannot merge the shards of {output_file}: " + ", ".join(problems))
+
+    tmp_output_file = f"{output_file}.tmp"
+    with open(tmp_output_file, "w") as f:
+        if output_file.endswith(".jsonl"):
+            for question_id in expected_ids:
+                f.write(json.dumps(records[question_id]) + "\n")
+        else:
+            json.dump([records[question_id] for question_id in expected_ids], f)
+    os.replace(tmp_output_file, output_file)
+    print(f"Merged {num_shards} shards ({len(expected_ids)} questions) into {output_file}")
+    return output_file
+
+
+def add_shard_arguments(parser):
+    parser.add_argument("--num_shards", type=int, default=1, help="Split the questions into this many shards, each run by its own process.")
+    parser.add_argument("--shard_index", type=int, default=None, help="Shard run by this process (0 to num_shards - 1).")
+    parser.add_argument("--merge_shards", action="store_true", help="Check the num_shards shard files and merge them into the results file instead of running inference.")
@@ -0,0 +1,120 @@
+import csv
+import json
+import os
+import time
+
+from inference_backends import percentiles
+
+####################################################################################################################
+############################################# TELEMETRY ############################################################
+####################################################################################################################
+# Per request metrics of an inference run, to compare engine settings (gpu_memory_utilization,
+# max_num_seqs, submission mode, ...) with numbers. Every finished request is written to the
+# metrics file (CSV if its name ends in .csv, JSONL otherwise) and at the end of the run a summary
+# with p50/p95/p99 per metric is appended to `<metrics file root>.summary.jsonl`. Runs are
+# appended, the run column tells them apart.
+
+METRIC_FIELDS = ["model", "run", "id", "prompt_tokens", "generated_tokens", "ttft", "latency", "tokens_per_s", "batch_occupancy", "cached"]
+SUMMARY_METRICS = ["ttft", "latency", "tokens_per_s", "prompt_tokens", "generated_tokens", "batch_occupancy"]
+SUMMARY_QUANTILES = [50, 95, 99]
+
+
+def summary_file_for(metrics_file):
+    return f"{os.path.splitext(metrics_file)[0]}.summary.jsonl"
+
+
+class MetricsRecorder:
+    """
+    Records the Completion of each finished request. Timings the backend could not measure are
+    left empty, and responses from the response cache are kept out of the percentiles.
+    """
+
+    def __init__(self, metrics_file, model, engine_settings=None):
+        if os.path.dirname(metrics_file):
+            os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+        self.metrics_file = metrics_file
+        self.model = model
+        self.engine_settings = engine_settings or {}
+        self.run = time.strftime("%Y%m%d-%H%M%S")
+        new_file = not os.path.exists(metrics_file) or os.path.getsize(metrics_file) == 0
+        self.file = open(metrics_file, "a", newline="")
+        self.writer = None
+        if metrics_file.endswith(".csv"):
+            self.writer = csv.DictWriter(self.file, METRIC_FIELDS)
+            if new_file:
+                self.writer.writeheader()
+        self.values = {metric: [] for metric in SUMMARY_METRICS}
+        self.num_requests = 0
+        self.num_cached = 0
+        self.generated_tokens = 0
+        self.start_time = time.perf_counter()
+
+    def record(self, request_id, completion):
+        latency = completion.latency
+        record = {
+            "model": self.model,
+            "run": self.run,
+            "id": request_id,
+            "prompt_tokens": completion.prompt_tokens,
+            "generated_tokens": completion.generated_tokens,
+            "ttft": None if completion.ttft is None else round(completion.ttft, 6),
+            "latency": None if latency is None else round(latency, 6),
+            "tokens_per_s": round(completion.generated_tokens / latency, 3) if latency else None,
+            "batch_occupancy": completion.batch_occupancy,
+            "cached": completion.cached,
+        }
+        if self.writer is not None:
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record) + "\n")
+
+        self.num_requests += 1
+        self.generated_tokens += completion.generated_tokens
+        if completion.cached:
+            self.num_cached += 1
+            return
+        for metric in SUMMARY_METRICS:
+            if record[metric] is not None:
+                self.values[metric].append(record[metric])
+
+    def summary(self):
+        seconds = max(time.perf_counter() - self.start_time, 1e-9)
+        summary = {
+            "model": self.model,
+            "run": self.run,
+            "engine": self.engine_settings,
+            "requests": self.num_requests,
+            "cached": self.num_cached,
+            "seconds": round(seconds, 3),
+            "requests_per_s": round(self.num_requests / seconds, 3),
+            "generated_tokens_per_s": round(self.generated_tokens / seconds, 3),
+        }
+        for metric in SUMMARY_METRICS:
+            for q, value in zip(SUMMARY_QUANTILES, percentiles(self.values[metric], SUMMARY_QUANTILES)):
+                summary[f"{metric}_p{q}"] = value
+        return summary
+
+    def close(self):
+        """
+        Closes the metrics file, appends the summary of the run to the summary file and returns it.
+        """
+        self.file.close()
+        summary = self.summary()
+        with open(summary_file_for(self.metrics_file), "a") as f:
+            f.write(json.dumps(summary, default=str) + "\n")
+        return summary
+
+
+def format_summary(summary):
+    def p(metric, unit=""):
+        values = [summary[f"{metric}_p{q}"] for q in SUMMARY_QUANTILES]
+        if values[0] is None:
+            return f"{metric} n/a"
+        return f"{metric} " + "/".join(f"{value:g}" for value in values) + unit
+    return (f"Metrics of {summary['model']}: {summary['requests']} requests ({summary['cached']} cached), "
+            f"{summary['requests_per_s']} requests/s, p50/p95/p99 {p('ttft', 's')}, {p('latency', 's')}, "
+            f"{p('tokens_per_s')}, {p('batch_occupancy')}")
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics_file", type=str, default=None, help="Write per request metrics (tokens, time to first token, latency, tokens/s, batch occupancy) to this .jsonl or .csv file, and p50/p95/p99 summaries per model to <file>.summary.jsonl.")
@@ -0,0 +1,119 @@
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from openai_backend import OpenAIHTTPBackend, HTTPRequestError
+from openai_stub_server import serve
+
+##########################
+######### OPENAI HTTP BACKEND
+##########################
+# The backend against the stub server on a free local port: 503s are retried until they pass,
+# stream_chat hands every completion back with its own tag, and no failed, exhausted or
+# cancelled request stays counted in flight.
+# Run with: python -m pytest -q test_openai_backend.py
+
+SAMPLING = {"temperature": 0.0, "max_tokens": 16}
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        server = serve(port=0, **kwargs)
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def backends():
+    opened = []
+
+    def make(base_url, **kwargs):
+        backend = OpenAIHTTPBackend("stub-model", base_url, api_key="test", backoff=0.0, **kwargs)
+        opened.append(backend)
+        return backend
+
+    yield make
+    for backend in opened:
+        backend.close()
+
+
+def prompt(i):
+    return [{"role": "user", "content": f"Question: question {i}"}]
+
+
+def test_chat_retries_503s_and_keeps_the_prompt_order(stub, backends):
+    backend = backends(stub(failure_rate=0.3, seed=1), max_concurrency=8, max_retries=20)
+    completions = backend.chat([prompt(i) for i in range(40)], SAMPLING)
+    assert [c.text for c in completions] == [f"question {i}" for i in range(40)]
+    assert backend.retries > 0
+    assert backend.in_flight == 0
+    assert "40 requests" in backend.stats()
+
+
+def test_text_prompts_use_the_completions_endpoint(stub, backends):
+    backend = backends(stub())
+    assert [c.text for c in backend.generate(["first line\nlast line", "only"], SAMPLING)] == ["last line", "only"]
+
+
+def test_exhausted_retries_raise_and_release_in_flight(stub, backends):
+    backend = backends(stub(failure_rate=1.0), max_retries=2)
+    with pytest.raises(HTTPRequestError, match="after 3 attempts"):
+        backend.chat([prompt(i) for i in range(5)], SAMPLING)
+    assert backend.in_flight == 0
+    assert backend.retries >= 2
+
+
+def test_connection_errors_are_retried_then_raised(backends):
+    # Nothing listens on the port of a stopped server
+    server = serve(port=0)
+    port = server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    backend = backends(f"http://127.0.0.1:{port}/v1", max_retries=1)
+    with pytest.raises(HTTPRequestError, match="after 2 attempts"):
+        backend.chat([prompt(0)], SAMPLING)
+    assert backend.in_flight == 0 and backend.retries == 1
+
+
+def test_failed_request_cancels_the_rest_of_the_batch(stub, backends):
+    backend = backends(stub(failure_rate=0.5, latency=0.05, seed=3), max_concurrency=4, max_retries=0)
+    with pytest.raises(HTTPRequestError):
+        backend.chat([prompt(i) for i in range(20)], SAMPLING)
+    assert backend.in_flight == 0
+
+
+def test_stream_chat_pairs_every_tag_with_its_completion(stub, backends):
+    backend = backends(stub(latency=0.01, failure_rate=0.2, seed=2), max_concurrency=16, max_retries=20)
+    requests = ((f"tag {i}", prompt(i)) for i in range(50))
+    results = list(backend.stream_chat(requests, SAMPLING, max_in_flight=6))
+    assert sorted(tag for tag, _ in results) == sorted(f"tag {i}" for i in range(50))
+    for tag, completion in results:
+        assert completion.text == tag.replace("tag", "question")
+        assert completion.batch_occupancy <= 6
+    assert backend.in_flight == 0
+
+
+def test_stream_chat_stopped_early_cancels_the_requests_in_flight(stub, backends):
+    backend = backends(stub(latency=0.05), max_concurrency=16)
+    stream = backend.stream_chat(((i, prompt(i)) for i in range(100)), SAMPLING, max_in_flight=8)
+    tag, completion = next(stream)
+    assert completion.text == f"question {tag}"
+    stream.close()
+    assert backend.in_flight == 0
+    assert len(backend.latencies) < 100
+
+
+def test_stream_chat_failure_cancels_the_requests_in_flight(stub, backends):
+    backend = backends(stub(latency=0.02, failure_rate=0.3, seed=5), max_concurrency=16, max_retries=0)
+    with pytest.raises(HTTPRequestError):
+        for _ in backend.stream_chat(((i, prompt(i)) for i in range(100)), SAMPLING, max_in_flight=8):
+            pass
+    assert backend.in_flight == 0
@@ -0,0 +1,77 @@
+import response_cache
+from inference_backends import Completion, MockBackend
+from response_cache import ResponseCache, CachedBackend
+
+##########################
+######### RESPONSE CACHE
+##########################
+# Shards running in parallel share one cache file, so no connection may keep the write lock
+# between two calls. The lock timeout is cut to a second, a held lock fails the test at once.
+# Run with: python -m pytest -q test_response_cache.py
+
+SAMPLING = {"temperature": 0.0, "max_tokens": 16}
+
+
+def completion(text):
+    return Completion(text, 3, len(text.split()))
+
+
+def test_two_caches_on_one_file_interleave(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, "LOCK_TIMEOUT", 1)
+    path = str(tmp_path / "responses.sqlite")
+    shard_a, shard_b = ResponseCache(path), ResponseCache(path)
+
+    shard_a.put("a1", "m", completion("answer a1"))
+    assert shard_b.get("a1").text == "answer a1"
+    shard_b.put("b1", "m", completion("answer b1"))
+    assert shard_a.get("b1").text == "answer b1"
+    # Both hold unflushed hits, each can still write
+    assert shard_a.get("a1").cached
+    shard_b.put_many([("b2", "m", completion("answer b2")), ("b3", "m", completion("answer b3"))])
+    shard_a.put("a2", "m", completion("answer a2"))
+    assert shard_b.get("a2").text == "answer a2"
+    assert shard_a.get("missing") is None
+
+    assert shard_a.close() == 0
+    assert shard_b.close() == 0
+    reopened = ResponseCache(path)
+    assert sorted(row[0] for row in reopened.db.execute("SELECT key FROM responses")) == ["a1", "a2", "b1", "b2", "b3"]
+    reopened.close()
+
+
+def test_hits_refresh_last_used_for_eviction(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path)
+    for key in ["old", "new"]:
+        cache.put(key, "m", completion("x" * 1000))
+    cache.db.execute("UPDATE responses SET last_used = 0 WHERE key = 'new'")
+    cache.db.commit()
+    # The hit on "new" is only in memory until evict flushes it, "old" is then the least recent
+    cache.get("new")
+    cache.max_size_bytes = 1500
+    assert cache.evict() == 1
+    assert cache.get("new") is not None and cache.get("old") is None
+    cache.close()
+
+
+def test_cached_backend_answers_hits_without_the_engine(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    built = []
+
+    def factory():
+        built.append(True)
+        return MockBackend(response="from engine")
+
+    prompts = [[{"role": "user", "content": f"Question: q{i}"}] for i in range(4)]
+    first = CachedBackend(factory, ResponseCache(path), "m")
+    assert [c.text for c in first.chat(prompts, SAMPLING)] == ["from engine"] * 4
+    first.cache.close()
+
+    second = CachedBackend(factory, ResponseCache(path), "m")
+    completions = second.chat(prompts, SAMPLING)
+    assert [c.text for c in completions] == ["from engine"] * 4 and all(c.cached for c in completions)
+    assert len(built) == 1
+    # Another backend does not see the vllm entries
+    other = CachedBackend(factory, second.cache, "m", backend_name="openai")
+    assert not any(c.cached for c in other.chat(prompts, SAMPLING))
+    second.cache.close()
@@ -0,0 +1,126 @@
+import json
+import os
+import zlib
+
+import pytest
+
+from sharding import shard_index_of, shard_output_file, check_shard_args, merge_shards
+
+##########################
+######### SHARD ASSIGNMENT AND MERGE
+##########################
+# Shards of one run may be started on different nodes and days, so the assignment must not
+# depend on the process (no hash()), and a merge that finds anything wrong must leave the
+# canonical results file as it was.
+# Run with: python -m pytest -q test_sharding.py
+
+NUM_SHARDS = 3
+CANONICAL = "canonical results of an earlier run"
+
+
+def question_ids(num_tables=20):
+    return [f"{dataset}--1--{table}--M{i}" for table in range(num_tables) for dataset in ["arxiv", "psa"] for i in range(3)]
+
+
+def test_assignment_is_the_crc32_of_the_table_id():
+    # Fixed values, a change of the hash would move questions between shards of a running job
+    assert zlib.crc32(b"arxiv--1--1118") == 4136803000
+    assert [shard_index_of(q, 8) for q in ["arxiv--1--1118--M0", "psa--8--259--A2", "statcan--3--77--M1", "census--2--5--M0"]] == [0, 6, 1, 4]
+    for question_id in question_ids():
+        table_id = question_id.rsplit("--", 1)[0]
+        assert shard_index_of(question_id, NUM_SHARDS) == zlib.crc32(table_id.encode("utf-8")) % NUM_SHARDS
+        assert shard_index_of(question_id, 1) == 0
+
+
+def test_questions_of_a_table_share_a_shard_and_every_shard_gets_some():
+    shards = {}
+    for question_id in question_ids():
+        shards.setdefault(question_id.rsplit("--", 1)[0], set()).add(shard_index_of(question_id, NUM_SHARDS))
+    assert all(len(indices) == 1 for indices in shards.values())
+    assert set().union(*shards.values()) == set(range(NUM_SHARDS))
+
+
+def test_shard_file_names_and_arguments():
+    assert shard_output_file(os.path.join("out", "m--realHCTs--results.json"), 3, 8) == os.path.join("out", "shards", "m--realHCTs--results.shard-3-of-8.json")
+    check_shard_args(4, None)
+    check_shard_args(4, 3)
+    for num_shards, shard_index in [(0, None), (4, 4), (4, -1)]:
+        with pytest.raises(ValueError):
+            check_shard_args(num_shards, shard_index)
+
+
+def write_shards(output_file, records_by_shard):
+    os.makedirs(os.path.join(os.path.dirname(output_file), "shards"), exist_ok=True)
+    for shard_index, records in records_by_shard.items():
+        shard_file = shard_output_file(output_file, shard_index, NUM_SHARDS)
+        with open(shard_file, "w") as f:
+            if shard_file.endswith(".jsonl"):
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+            else:
+                json.dump(records, f)
+
+
+def sharded_records(ids):
+    records_by_shard = {i: [] for i in range(NUM_SHARDS)}
+    # Each shard in its own order, the merge restores the order of the question set
+    for question_id in reversed(ids):
+        records_by_shard[shard_index_of(question_id, NUM_SHARDS)].append({"id": question_id, "response": f"answer {question_id}"})
+    return records_by_shard
+
+
+@pytest.mark.parametrize("ext", [".json", ".jsonl"])
+def test_clean_merge_writes_the_question_order(tmp_path, ext):
+    ids = question_ids()
+    output_file = str(tmp_path / f"m--realHCTs--results{ext}")
+    write_shards(output_file, sharded_records(ids))
+    assert merge_shards(output_file, NUM_SHARDS, ids) == output_file
+    with open(output_file) as f:
+        merged = [json.loads(line) for line in f] if ext == ".jsonl" else json.load(f)
+    assert [record["id"] for record in merged] == ids
+    assert all(record["response"] == f"answer {record['id']}" for record in merged)
+    assert not os.path.exists(f"{output_file}.tmp")
+
+
+def duplicate_across_shards(records_by_shard):
+    records_by_shard[1].append(dict(records_by_shard[0][0]))
+
+
+def rerun_vlm_shard(records_by_shard):
+    # vlm_inf.py appends, a shard run again after a crash answers its questions twice
+    records_by_shard[2] = records_by_shard[2] + records_by_shard[2]
+
+
+def missing_shard(records_by_shard):
+    del records_by_shard[1]
+
+
+def unknown_id(records_by_shard):
+    records_by_shard[0].append({"id": "arxiv--1--999--M0", "response": "not asked"})
+
+
+def missing_id(records_by_shard):
+    records_by_shard[0].pop()
+
+
+@pytest.mark.parametrize("ext", [".json", ".jsonl"])
+@pytest.mark.parametrize("break_shards, error", [
+    (duplicate_across_shards, "duplicate ids"),
+    (rerun_vlm_shard, "duplicate ids"),
+    (missing_shard, "Missing shard files"),
+    (unknown_id, "not in the question set"),
+    (missing_id, "missing ids"),
+])
+def test_bad_shards_leave_the_canonical_file_untouched(tmp_path, ext, break_shards, error):
+    ids = question_ids()
+    output_file = str(tmp_path / f"m--realHCTs--results{ext}")
+    with open(output_file, "w") as f:
+        f.write(CANONICAL)
+    records_by_shard = sharded_records(ids)
+    break_shards(records_by_shard)
+    write_shards(output_file, records_by_shard)
+
+    with pytest.raises(ValueError, match=error):
+        merge_shards(output_file, NUM_SHARDS, ids)
+    with open(output_file) as f:
+        assert f.read() == CANONICAL
+    assert not os.path.exists(f"{output_file}.tmp")
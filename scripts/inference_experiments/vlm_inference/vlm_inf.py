@@ -1,7 +1,6 @@
 
-import sys, os, torch, argparse, json, math, time, gzip
-from vllm.utils import cuda_device_count_stateless
-import PIL, vllm, base64
+import sys, os, argparse, json, math, time, gzip
+import base64
 from tqdm import tqdm
 os.environ["VLLM_WORKER_MULTIPROC_METHOD"] = "spawn"
 
@@ -9,19 +8,39 @@ os.environ["VLLM_WORKER_MULTIPROC_METHOD"] = "spawn"
 from dotenv import load_dotenv
 load_dotenv()
 
-from huggingface_hub import login
-login(token=os.getenv("HUGGINGFACE_TOKEN"))
-
-print('CUDA:', torch.cuda.is_available(), torch.cuda.device_count())
-
-# Set torch multiprocessing to spawn
-import torch.multiprocessing as mp
-mp.set_start_method('spawn', force=True)
-
 # Disable warnings
 import warnings
 warnings.filterwarnings("ignore")
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from inference_backends import build_backend, add_backend_arguments, backend_options_from_args, huggingface_login
+from sharding import shard_index_of, shard_output_file, check_shard_args, merge_shards, add_shard_arguments
+from response_cache import ResponseCache, with_response_cache, add_response_cache_arguments
+from telemetry import MetricsRecorder, format_summary, add_metrics_arguments
+from inline_scoring import InlineScorer, score_results_file, add_scoring_arguments
+
+# Responses are appended to the results file once this many are buffered
+WRITE_EVERY = 50
+
+# Models sharing the plain "USER: <image>" prompt
+GENERAL_MODELS = [
+    "HuggingFaceM4/Idefics3-8B-Llama3",
+    "OpenGVLab/InternVL2_5-8B-MPO",
+    "OpenGVLab/InternVL2-4B",
+    "llava-hf/llava-1.5-7b-hf",
+    "llava-hf/llava-v1.6-mistral-7b-hf",
+    "llava-hf/llava-v1.6-vicuna-7b-hf",
+    "allenai/Molmo-7B-D-0924",
+    "google/paligemma2-10b-ft-docci-448"
+]
+# Models do_inference has a prompt format for
+PROMPT_FORMAT_MODELS = [
+    "Qwen/Qwen2-VL-7B-Instruct",
+    "microsoft/Phi-3-vision-128k-instruct",
+    "microsoft/Phi-3.5-vision-instruct",
+    "mistralai/Pixtral-12B-2409",
+] + GENERAL_MODELS
+
 
 ####################################################################################################################
 ############################################# HELPER FUNCTIONS #####################################################
@@ -71,15 +90,33 @@ def make_image_prompt_dict(qaps_file):
     return all_qaps_dict
 
 
-def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
+def iter_batches(items, batch_size=32):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    # Ensure output_folder exists
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
 
+def prepare_engine_process():
+    """
+    torch and CUDA setup for an in process engine. Done only once an engine is built, so --help,
+    argument errors and the mock / openai backends do not pay for it.
+    """
+    import torch
+    print('CUDA:', torch.cuda.is_available(), torch.cuda.device_count())
+
+    # Set torch multiprocessing to spawn
+    import torch.multiprocessing as mp
+    mp.set_start_method('spawn', force=True)
+
+
+def engine_kwargs_for_model(model_t, num_gpus=1):
     if model_t == "meta-llama/Llama-3.2-11B-Vision-Instruct": # Requires specific CUDA version to run with VLLM
-        llm = vllm.LLM(model=model_t, 
-                    tensor_parallel_size = num_gpus,
+        return dict(tensor_parallel_size = num_gpus,
                     max_model_len=4096,
                     gpu_memory_utilization=0.8,
                     trust_remote_code=True,
@@ -87,19 +124,57 @@ def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
                     enforce_eager=True
                     )
     elif model_t == "mistralai/Pixtral-12B-2409":
-        llm = vllm.LLM(model=model_t, 
-                    trust_remote_code=True, 
+        return dict(trust_remote_code=True, 
                     tokenizer_mode="mistral", 
                     gpu_memory_utilization=0.9,
                     tensor_parallel_size = num_gpus
                     )
-
     else:
-        llm = vllm.LLM(model=model_t, 
-                    trust_remote_code=True, 
+        return dict(trust_remote_code=True, 
                     gpu_memory_utilization=0.9,
                     tensor_parallel_size = num_gpus
                     )
+
+
+def results_file_name(output_folder, model_t):
+    return os.path.join(output_folder, f"{model_t.split('/')[-1]}--vision--results.jsonl")
+
+
+def merge_vision_shards(model_t, output_folder, qaps_file, num_shards=1, score=False):
+    expected_ids = list(make_image_prompt_dict(qaps_file))
+    output_file = merge_shards(results_file_name(output_folder, model_t), num_shards, expected_ids)
+    if score:
+        print(score_results_file(output_file, "vision"))
+    return output_file
+
+
+def do_inference(model_t, output_folder, qaps_file, num_gpus=1, batch_size=32, backend_name="vllm", backend_options=None, num_shards=1, shard_index=None, response_cache=None, model_revision=None, metrics_file=None, score=False):
+    check_shard_args(num_shards, shard_index)
+    # Checked before the engine is built, loading one just to skip the model takes minutes
+    if model_t not in PROMPT_FORMAT_MODELS:
+        print(f"No prompt format for {model_t}, skipping it")
+        return False
+
+    # Ensure output_folder exists
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    engine_kwargs = engine_kwargs_for_model(model_t, num_gpus)
+    if model_revision is not None:
+        engine_kwargs["revision"] = model_revision
+    # Batches larger than the max_num_seqs of the engine only queue in it, with all their images
+    # held in memory
+    if engine_kwargs.get("max_num_seqs") is not None:
+        batch_size = min(batch_size, engine_kwargs["max_num_seqs"])
+
+    def make_backend():
+        if backend_name == "vllm":
+            prepare_engine_process()
+            huggingface_login()
+        return build_backend(backend_name, model_t, engine_kwargs, **(backend_options or {}))
+
+    # With a response cache the engine is only built if some request is not cached
+    llm = with_response_cache(make_backend, response_cache, model_t, model_revision, backend_name)
     
     ### INFERENCE 
     
@@ -108,7 +183,21 @@ def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
     ############################################################################################
     ### Load all question and image paths 
     all_qap_info_dict = make_image_prompt_dict(qaps_file)
-    output_file_name = os.path.join(output_folder, f"{model_t.split('/')[-1]}--vision--results.jsonl")
+    output_file_name = results_file_name(output_folder, model_t)
+    if shard_index is not None:
+        all_qap_info_dict = {qap_id: qap_info for qap_id, qap_info in all_qap_info_dict.items() if shard_index_of(qap_id, num_shards) == shard_index}
+        output_file_name = shard_output_file(output_file_name, shard_index, num_shards)
+        os.makedirs(os.path.dirname(output_file_name), exist_ok=True)
+        print(f"*** SHARD {shard_index} OF {num_shards}: ***", len(all_qap_info_dict))
+
+    metrics = None
+    if metrics_file is not None:
+        if shard_index is not None:
+            metrics_file = shard_output_file(metrics_file, shard_index, num_shards)
+        metrics = MetricsRecorder(metrics_file, model_t, dict(engine_kwargs, backend=backend_name, batch_size=batch_size))
+
+    # Responses are scored as they are generated, against the vision reference GTs of the scorer
+    scorer = InlineScorer("vision") if score else None
 
     if model_t == "Qwen/Qwen2-VL-7B-Instruct":
 
@@ -116,15 +205,14 @@ def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
         from qwen_vl_utils import process_vision_info
 
         # Qwen does better with higher temperature and less max tokens
-        sampling_params = vllm.SamplingParams(temperature=0.5, max_tokens=128)
+        sampling_params = {"temperature": 0.5, "max_tokens": 128}
+        send = llm.generate
 
         # Load the tokenizer
+        huggingface_login()
         processor = AutoProcessor.from_pretrained(model_t, trust_remote_code=True)
 
-        #  Loop over all images and questions
-        count = 0
-        all_outputs_buffer = []
-        for qap_id, qap_info in tqdm(all_qap_info_dict.items()):
+        def make_request(qap_info):
             image_path_t = qap_info["image_path"]
             question_t = qap_info["question"]
 
@@ -159,23 +247,7 @@ def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
                 return_tensors="pt",
             )
             inputs = inputs.to("cuda")
-
-            # Inference
-            output = llm.generate(vllm.inputs.TokensPrompt(prompt_token_ids = inputs["input_ids"].flatten().tolist()), sampling_params=sampling_params)
-            all_outputs_buffer.append({
-                "id": qap_id,
-                "response": output[0].outputs[0].text
-            })
-
-            # if buffer is size 50, write to file
-            if count % 50 == 0:
-                with open(output_file_name, "a") as f:
-                    for o in all_outputs_buffer:
-                        f.write(json.dumps(o) + "\n")
-                all_outputs_buffer = []
-                print(f"COMPLETED: {count} out of {len(all_qap_info_dict)} prompts - {(count*100)/len(all_qap_info_dict)}")
-
-            count += 1
+            return {"prompt_token_ids": inputs["input_ids"].flatten().tolist()}
 
 
     ############################################################################################
@@ -185,43 +257,17 @@ def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
     ### Special Processing for microsoft/Phi-3-vision-128k-instruct | microsoft/Phi-3.5-vision-instruct
     elif model_t == "microsoft/Phi-3-vision-128k-instruct" or model_t == "microsoft/Phi-3.5-vision-instruct":
 
-        all_outputs_buffer = []
-        sampling_params = vllm.SamplingParams(temperature=0.01, max_tokens=128)
-        
-        count = 0
-        for qap_id, qap_info in tqdm(all_qap_info_dict.items()): 
-            image_path_t = qap_info["image_path"]
-            question_t = qap_info["question"]
+        import PIL.Image
+        sampling_params = {"temperature": 0.01, "max_tokens": 128}
+        send = llm.generate
 
+        def make_request(qap_info):
             ## PROMPTS
-            prompt = f"USER: <|image_1|>\ Answer the following question given the information provided in the image. Do not return any explanation or steps, just return the final answer to the question. Question: {question_t} \nASSISTANT:"
-            
-            image = PIL.Image.open(image_path_t)
-
-            # Single prompt inference
-            outputs = llm.generate({
-                    "prompt": prompt,
-                    "multi_modal_data": {"image": image},
-                },
-                sampling_params=sampling_params
-            )
-
-            for o in outputs:
-                generated_text = o.outputs[0].text
-                all_outputs_buffer.append({
-                    "id": qap_id,
-                    "response": generated_text
-                })
-
-            # if buffer is size 50, write to file
-            if count % 50 == 0:
-                with open(output_file_name, "a") as f:
-                    for o in all_outputs_buffer:
-                        f.write(json.dumps(o) + "\n")
-                all_outputs_buffer = []
-                print(f"COMPLETED: {count} out of {len(all_qap_info_dict)} prompts - {(count*100)/len(all_qap_info_dict)}")
-
-            count += 1
+            prompt = f"USER: <|image_1|>\ Answer the following question given the information provided in the image. Do not return any explanation or steps, just return the final answer to the question. Question: {qap_info['question']} \nASSISTANT:"
+            return {
+                "prompt": prompt,
+                "multi_modal_data": {"image": PIL.Image.open(qap_info["image_path"])},
+            }
 
     ############################################################################################
     ############################################ PIXTRAL
@@ -231,97 +277,83 @@ def do_inference(model_t, output_folder, qaps_file, num_gpus=1):
 
     elif model_t == "mistralai/Pixtral-12B-2409":
 
-        all_outputs_buffer = []
-
-        sampling_params = vllm.SamplingParams(temperature=0.01, max_tokens=128)
-        count = 0
-
-        for qap_id, qap_info in tqdm(all_qap_info_dict.items()):
-            image_path_t = qap_info["image_path"]
-            question_t = qap_info["question"]
+        sampling_params = {"temperature": 0.01, "max_tokens": 128}
+        send = llm.chat
 
-            image_source = file_to_data_url(image_path_t)
-            messages = [
+        def make_request(qap_info):
+            image_source = file_to_data_url(qap_info["image_path"])
+            return [
                 {
                     "role": "user",
-                    "content": [{"type": "text", "text": f"Answer the following question given the information provided in the image. Do not return any explanation or steps, just return the final answer to the question. Question: {question_t}"}, {"type": "image_url", "image_url": {"url": image_source}}]
+                    "content": [{"type": "text", "text": f"Answer the following question given the information provided in the image. Do not return any explanation or steps, just return the final answer to the question. Question: {qap_info['question']}"}, {"type": "image_url", "image_url": {"url": image_source}}]
                 },
             ]
-
-            outputs = llm.chat(messages, sampling_params=sampling_params)
-            all_outputs_buffer.append({
-                "id": qap_id,
-                "response": outputs[0].outputs[0].text
-            })
-            
-            # if buffer is size 50, write to file
-            if count % 50 == 0:
-                with open(output_file_name, "a") as f:
-                    for o in all_outputs_buffer:
-                        f.write(json.dumps(o) + "\n")
-                all_outputs_buffer = []
-                print(f"COMPLETED: {count} out of {len(all_qap_info_dict)} prompts - {(count*100)/len(all_qap_info_dict)}")
-
-            count += 1
     
     ############################################################################################
     ############################################ GENERAL MODELS
     ############################################################################################
 
-    elif model_t in [
-            "HuggingFaceM4/Idefics3-8B-Llama3",
-            "OpenGVLab/InternVL2_5-8B-MPO",
-            "OpenGVLab/InternVL2-4B",
-            "llava-hf/llava-1.5-7b-hf",
-            "llava-hf/llava-v1.6-mistral-7b-hf",
-            "llava-hf/llava-v1.6-vicuna-7b-hf",
-            "allenai/Molmo-7B-D-0924",
-            "google/paligemma2-10b-ft-docci-448"
-        ]:
-        sampling_params = vllm.SamplingParams(temperature=0.01, max_tokens=128)
-        # sampling_params = vllm.SamplingParams(temperature=0.1, max_tokens=128)
-
-        all_outputs_buffer = []
-        count = 0
-
-        for qap_id, qap_info in tqdm(all_qap_info_dict.items()):
-            image_path_t = qap_info["image_path"]
-            question_t = qap_info["question"]
+    elif model_t in GENERAL_MODELS:
+        import PIL.Image
+        sampling_params = {"temperature": 0.01, "max_tokens": 128}
+        # sampling_params = {"temperature": 0.1, "max_tokens": 128}
+        send = llm.generate
 
-            prompt = f"USER: <image>\n Answer the following question given the information provided in the image. Do not return any explanation or steps, just return the final answer to the question. Question: {question_t} \nASSISTANT:"
-            
-            image = PIL.Image.open(image_path_t)
+        def make_request(qap_info):
+            prompt = f"USER: <image>\n Answer the following question given the information provided in the image. Do not return any explanation or steps, just return the final answer to the question. Question: {qap_info['question']} \nASSISTANT:"
+            return {
+                "prompt": prompt,
+                "multi_modal_data": {"image": PIL.Image.open(qap_info["image_path"])},
+            }
 
-            # Single prompt inference
-            outputs = llm.generate({
-                    "prompt": prompt,
-                    "multi_modal_data": {"image": image},
-                },
-                sampling_params=sampling_params
-            )
-
-            for o in outputs:
-                generated_text = o.outputs[0].text
-                all_outputs_buffer.append({
-                    "id": qap_id,
-                    "response": generated_text
-                })
-
-            # if buffer is size 50, write to file
-            if count % 50 == 0:
-                with open(output_file_name, "a") as f:
-                    for o in all_outputs_buffer:
-                        f.write(json.dumps(o) + "\n")
-                all_outputs_buffer = []
-                print("COMPLETED:", count)
+    ############################################################################################
+    ############################################ BATCHED GENERATION
+    ############################################################################################
+    # batch_size requests per generate / chat call, so the engine batches them. Images are opened
+    # batch by batch.
+    print(f"*** BATCH SIZE: {batch_size} ***")
 
-            count += 1
+    all_outputs_buffer = []
+    count = 0
+
+    def flush_outputs():
+        with open(output_file_name, "a") as f:
+            for o in all_outputs_buffer:
+                f.write(json.dumps(o) + "\n")
+        all_outputs_buffer.clear()
+
+    progress_bar = tqdm(total=len(all_qap_info_dict))
+    for batch in iter_batches(all_qap_info_dict.items(), batch_size):
+        outputs = send([make_request(qap_info) for _, qap_info in batch], sampling_params)
+        for (qap_id, _), o in zip(batch, outputs):
+            if metrics is not None:
+                metrics.record(qap_id, o)
+            all_outputs_buffer.append({
+                "id": qap_id,
+                "response": o.text
+            })
+            if scorer is not None:
+                scorer.score(all_outputs_buffer[-1])
+        count += len(batch)
+        progress_bar.update(len(batch))
+
+        # if buffer has 50 responses, write to file
+        if len(all_outputs_buffer) >= WRITE_EVERY:
+            flush_outputs()
+            print(f"COMPLETED: {count} out of {len(all_qap_info_dict)} prompts - {(count*100)/len(all_qap_info_dict)}")
+            if scorer is not None:
+                print(scorer.progress())
+    progress_bar.close()
 
     # Write remaining outputs to file
-    with open(output_file_name, "a") as f:
-        for o in all_outputs_buffer:
-            f.write(json.dumps(o) + "\n")
-    all_outputs_buffer = []
+    flush_outputs()
+    if llm.stats() is not None:
+        print(llm.stats())
+    llm.close()
+    if metrics is not None:
+        print(format_summary(metrics.close()))
+    if scorer is not None:
+        print(scorer.write(output_file_name))
 
     return True
 
@@ -346,28 +378,51 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", type=str, required=True, help="Model name to run inference on")
-    if not parser.parse_args().model in all_models:
-        print("Model not supported. Please choose from the following models:")
-        for model in all_models:
-            print(model)
-        print("or choose 'all' to run all models.")
-        sys.exit(1)
     parser.add_argument("--output_folder", type=str, default="../../results/model_responses/vlm/", help="Output folder to save results")
     parser.add_argument("--qaps_file", type=str, default = "../../datasets/realWorld_datasets/qaps/realWorld_HCT_qaps.json", help="Path to QAPS file")
     parser.add_argument("--num_gpus", type=int, default=1, help="Number of GPUs to use for inference. Most models require atleast 1 A100's to run.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Questions sent to the engine per call, capped at the max_num_seqs of the model's engine settings. 1 sends one question at a time.")
+    add_backend_arguments(parser)
+    add_shard_arguments(parser)
+    add_response_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_scoring_arguments(parser)
 
     args = parser.parse_args()
+    if args.model != "all" and not args.model in all_models:
+        print("Model not supported. Please choose from the following models:")
+        for model in all_models:
+            print(model)
+        print("or choose 'all' to run all models.")
+        sys.exit(1)
+    backend_options = backend_options_from_args(args)
 
     # Check if qaps file exists
     if not os.path.exists(args.qaps_file):
         print("QAPS file not found. Please provide a valid path to the QAPS JSON file that is normally in the `datasets/realWorld_datasets/qaps` folder.")
         sys.exit(1)
     
-    if args.model == "all":
-        for model in all_models:
-            do_inference(model, args.output_folder, args.qaps_file, args.num_gpus)
-    else:
-        do_inference(args.model, args.output_folder, args.qaps_file, args.num_gpus)
+    if args.shard_index is not None and args.merge_shards:
+        parser.error("--merge_shards is run once after all shards are done, without --shard_index")
+    if args.num_shards > 1 and args.shard_index is None and not args.merge_shards:
+        parser.error("--num_shards needs --shard_index (or --merge_shards)")
+    models = all_models if args.model == "all" else [args.model]
+    response_cache = None if args.response_cache is None else ResponseCache(args.response_cache, args.response_cache_max_mb)
+
+    for model in models:
+        if args.merge_shards:
+            merge_vision_shards(model, args.output_folder, args.qaps_file, args.num_shards, args.score)
+        else:
+            do_inference(model, args.output_folder, args.qaps_file, args.num_gpus, args.batch_size, args.backend, backend_options, args.num_shards, args.shard_index,
+                         response_cache, args.model_revision, args.metrics_file, args.score)
+
+    if response_cache is not None:
+        evicted = response_cache.close()
+        print(f"{response_cache.stats()}, {evicted} entries evicted")
 
 # Example command to run this script with a specific model
-# python vllm_inference.py --model "meta-llama/Llama-3.2-11B-Vision-Instruct" --num_gpus 2 
\ No newline at end of file
+# python vllm_inference.py --model "meta-llama/Llama-3.2-11B-Vision-Instruct" --num_gpus 2
+# Data parallel run with one replica per GPU, then merge:
+# for i in 0 1 2 3; do CUDA_VISIBLE_DEVICES=$i python vlm_inf.py --model "OpenGVLab/InternVL2-4B" --num_shards 4 --shard_index $i & done; wait
+# python vlm_inf.py --model "OpenGVLab/InternVL2-4B" --num_shards 4 --merge_shards
+# A shard appends to its file in shards/, remove the file of a crashed shard before running it again
@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+from score_responses import (
+    SCORER_VERSION,
+    clean_gt_val,
+    post_process_response,
+    post_process_response_vision_models_only,
+    post_process_response_format_variation,
+    get_prec_rec_f1_cc,
+    get_rec_cc_vision,
+    VISION_GT_REFERENCE_FILE,
+)
+from normalization import normalize_gts, normalize_responses
+import matching
+from matching import GTMatcher, AUTOMATON_MIN_VALUES
+from streaming import iter_result_records
+
+##########################
+######### SYNTHETIC CORPUS
+##########################
+# Responses and GTs in the benchmark format ("{a | b} || {c}"), with thousands separators,
+# trailing zeros, long lists and the junk tokens models emit, so every normalization branch runs.
+# Corpora are generated and benchmarked chunk_rows rows at a time with the timings summed, so a
+# 10M row run needs the memory of one chunk instead of 10+ GB. It still takes over an hour, pass
+# --sizes for quick runs.
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+CHUNK_ROWS = 100_000
+DATASETS = ["arxiv", "psa", "census", "pak", "statcan"]
+JUNK_TOKENS = ["# explanation:", "note:", "#solution", "table:", "<eos_token>", "# input"]
+WORDS = ["psychology", "linguistics", "ODS", "GFCS", "Vehicles", "Shops", "Residential premises", "Others", "ChiMera (Ours)"]
+
+
+def random_value(rng):
+    kind = rng.random()
+    if kind < 0.35:
+        return f"{rng.randint(1000, 99_999_999):,}"
+    if kind < 0.55:
+        return f"{rng.randint(0, 999)}.{rng.choice(['0', '00', '50', '25', '10'])}"
+    if kind < 0.75:
+        return str(rng.randint(0, 9999))
+    return rng.choice(WORDS)
+
+
+def random_gt(rng):
+    rows = [" | ".join(random_value(rng) for _ in range(rng.choice([1, 1, 2, 3]))) for _ in range(rng.choice([1, 1, 2, 3, 5]))]
+    return " || ".join("{" + row + "}" for row in rows)
+
+
+def random_response(rng, gt):
+    values = gt.replace("{", "").replace("}", "").replace("||", "|").split("|")
+    values = [v.strip() for v in values if rng.random() < 0.7] or [random_value(rng)]
+    response = " || ".join(values)
+    if rng.random() < 0.2:
+        response += "\n\n" + rng.choice(JUNK_TOKENS) + " the answer is in the table."
+    elif rng.random() < 0.1:
+        response = "`" + response + "`\n"
+    return response
+
+
+def iter_corpus_chunks(num_rows, chunk_rows=CHUNK_ROWS, seed=0):
+    """
+    Yields the corpus of num_rows rows as lists of at most chunk_rows rows. The rows are the same
+    whatever the chunk size.
+    """
+    rng = random.Random(seed)
+    results = []
+    for i in range(num_rows):
+        gt = random_gt(rng)
+        results.append({
+            "id": f"{DATASETS[i % len(DATASETS)]}--1--{i}--M{i % 3}",
+            "gt": gt,
+            "response": random_response(rng, gt),
+        })
+        if len(results) == chunk_rows:
+            yield results
+            results = []
+    if results:
+        yield results
+
+
+def make_corpus(num_rows, seed=0):
+    return [row for chunk in iter_corpus_chunks(num_rows, max(num_rows, 1), seed) for row in chunk]
+
+
+##########################
+######### BENCHMARKS
+##########################
+
+def benchmark_targets(results):
+    gts = [x["gt"] for x in results]
+    responses = [x["response"] for x in results]
+    # get_rec_cc_vision expects GTs that are already cleaned, as in get_recall_cc_vision_results
+    vision_results = [{"id": x["id"], "gt": gt, "response": x["response"]} for x, gt in zip(results, normalize_gts(gts))]
+    return [
+        ("clean_gt_val", lambda: [clean_gt_val(x) for x in gts]),
+        ("post_process_response", lambda: [post_process_response(x) for x in responses]),
+        ("post_process_response_vision_models_only", lambda: [post_process_response_vision_models_only(x) for x in responses]),
+        ("post_process_response_format_variation", lambda: [post_process_response_format_variation(x) for x in responses]),
+        ("normalize_gts", lambda: normalize_gts(gts)),
+        ("normalize_responses", lambda: normalize_responses(responses, "default")),
+        ("get_prec_rec_f1_cc", lambda: get_prec_rec_f1_cc(results)),
+        ("get_rec_cc_vision", lambda: get_rec_cc_vision(vision_results)),
+    ]
+
+
+def run_benchmark(fn, measure_memory=True):
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if measure_memory:
+        # Separate run, tracemalloc slows allocation heavy code down too much to time it at once
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mb = peak / (1024 * 1024)
+    return seconds, peak_mb
+
+
+def run_suite(sizes, output_file=None, measure_memory=True, only=None, seed=0, chunk_rows=CHUNK_ROWS):
+    records = []
+    for num_rows in sizes:
+        # {benchmark: [seconds, peak MB]}, summed seconds and largest chunk peak over the chunks
+        totals = {}
+        for results in iter_corpus_chunks(num_rows, chunk_rows, seed):
+            for name, fn in benchmark_targets(results):
+                if only and name not in only:
+                    continue
+                seconds, peak_mb = run_benchmark(fn, measure_memory)
+                total = totals.setdefault(name, [0.0, None])
+                total[0] += seconds
+                if peak_mb is not None:
+                    total[1] = max(total[1] or 0.0, peak_mb)
+            del results
+
+        for name, (seconds, peak_mb) in totals.items():
+            record = {
+                "benchmark": name,
+                "rows": num_rows,
+                "seconds": round(seconds, 4),
+                "rows_per_sec": round(num_rows / seconds, 1) if seconds > 0 else None,
+                "peak_mem_mb": None if peak_mb is None else round(peak_mb, 2),
+                "chunk_rows": min(chunk_rows, num_rows),
+                "scorer_version": SCORER_VERSION,
+                "python": platform.python_version(),
+            }
+            records.append(record)
+            print(f"{name:<42} {num_rows:>10,} rows {seconds:>9.3f}s {record['rows_per_sec'] or 0:>14,.0f} rows/s"
+                  + ("" if peak_mb is None else f" {peak_mb:>9.1f} MB"))
+
+    # One JSON object per line, appended, so results can be tracked across commits
+    if output_file:
+        with open(output_file, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        print(f"Benchmark results appended to {output_file}")
+    return records
+
+
+##########################
+######### GT MATCHING
+##########################
+# Picks AUTOMATON_MIN_VALUES. Real vision GT sets rarely pass a few dozen values and the random
+# corpus above stays under 16, so the vlms example is scaled instead: each of its responses is
+# checked against a GT set grown to num_values with the GT values of other questions, and its
+# response is joined with theirs and repeated response_scale times, the long answer checked
+# against many cells case. The plain set loop is timed against the automaton built from scratch
+# (one model file) and reused (every further model file of the same questions).
+
+VLM_EXAMPLE_RESULTS = "../../results/model_responses/vlms/example_results--InternVL2-4B--vision--results.jsonl"
+MATCHING_VALUES = [1, 2, 4, 8, 12, 16, 24, 32, 48, 64, 96, 128]
+MATCHING_RESPONSE_SCALES = [1, 10]
+
+
+def load_vlm_example(results_file=VLM_EXAMPLE_RESULTS, gt_file=VISION_GT_REFERENCE_FILE):
+    """
+    Returns [(cleaned GT values, processed response)] of the example rows that have a reference GT.
+    """
+    with open(gt_file) as f:
+        reference = json.load(f)
+    ids_to_gts = dict(zip([x["id"] for x in reference], normalize_gts([x["gt"] for x in reference])))
+    rows = [x for x in iter_result_records(results_file) if x["id"] in ids_to_gts]
+    responses = normalize_responses([x["response"] for x in rows], "vision")
+    return [(ids_to_gts[x["id"]], response) for x, response in zip(rows, responses)]
+
+
+def scale_matching_rows(rows, num_values, response_scale, seed=0):
+    rng = random.Random(seed)
+    scaled = []
+    for gt, response in rows:
+        gt_set, responses = set(gt), [response]
+        while len(gt_set) < num_values:
+            other_gt, other_response = rng.choice(rows)
+            gt_set.update(other_gt)
+            responses.append(other_response)
+        # Trimmed to num_values, sorted so the trim does not depend on set order
+        gt_set = set(sorted(gt_set)[:num_values]) if len(gt_set) > num_values else gt_set
+        scaled.append((gt_set, " ".join(responses * response_scale)))
+    return scaled
+
+
+def time_matching(rows):
+    """
+    Returns {path: seconds} for one pass over rows, and checks every path gives the same counts.
+    """
+    def set_path():
+        return [sum(1 for x in gt_set if x in response) for gt_set, response in rows]
+
+    def automaton_path(matcher):
+        return [matcher.count_contained(gt_set, response) for gt_set, response in rows]
+
+    seconds = {}
+    start = time.perf_counter()
+    expected = set_path()
+    seconds["set"] = time.perf_counter() - start
+
+    matcher = GTMatcher(min_values=0, max_cached=len(rows) + 1)
+    for path in ["automaton_build", "automaton_cached"]:
+        start = time.perf_counter()
+        counts = automaton_path(matcher)
+        seconds[path] = time.perf_counter() - start
+        if counts != expected:
+            raise AssertionError(f"{path} counts differ from the set loop")
+    return seconds
+
+
+def suggest_min_values(records, response_scale):
+    """
+    Smallest num_values from which the freshly built automaton beats the set loop at every
+    measured size, or None if it never does.
+    """
+    timings = sorted((x["num_values"], x["automaton_build"] < x["set"]) for x in records if x["response_scale"] == response_scale)
+    suggested = None
+    for num_values, faster in reversed(timings):
+        if not faster:
+            break
+        suggested = num_values
+    return suggested
+
+
+def run_matching_suite(values=MATCHING_VALUES, response_scales=MATCHING_RESPONSE_SCALES, output_file=None, seed=0):
+    if matching.ahocorasick is None:
+        raise SystemExit("The matching benchmark needs pyahocorasick: pip install pyahocorasick")
+    rows = load_vlm_example()
+    records = []
+    for response_scale in response_scales:
+        for num_values in values:
+            seconds = time_matching(scale_matching_rows(rows, num_values, response_scale, seed))
+            record = {
+                "benchmark": "gt_matching",
+                "rows": len(rows),
+                "num_values": num_values,
+                "response_scale": response_scale,
+                **{path: round(value, 4) for path, value in seconds.items()},
+                "scorer_version": SCORER_VERSION,
+                "python": platform.python_version(),
+            }
+            records.append(record)
+            print(f"{num_values:>4} values x{response_scale:<4} set {seconds['set']:>8.3f}s"
+                  f"  automaton {seconds['automaton_build']:>8.3f}s built {seconds['automaton_cached']:>8.3f}s cached")
+        suggested = suggest_min_values(records, response_scale)
+        faster_from = f"from {suggested} values" if suggested else f"at no size up to {max(values)} values"
+        print(f"Response scale {response_scale}: automaton faster {faster_from} (AUTOMATON_MIN_VALUES is {AUTOMATON_MIN_VALUES})")
+
+    if output_file:
+        with open(output_file, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        print(f"Benchmark results appended to {output_file}")
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scoring throughput on synthetic response corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Corpus sizes (rows) to benchmark")
+    parser.add_argument("--output_file", type=str, default=None, help="JSONL file to append the results to")
+    parser.add_argument("--only", type=str, nargs="+", default=None, help="Only run these benchmarks")
+    parser.add_argument("--no_memory", action="store_true", help="Skip the peak memory runs")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument("--matching", action="store_true", help="Benchmark GT substring matching on the scaled vlms example instead, the set loop against the automaton, and print the GT set size from which the automaton is faster")
+    parser.add_argument("--matching_values", type=int, nargs="+", default=MATCHING_VALUES, help="GT set sizes of the matching benchmark")
+    parser.add_argument("--matching_response_scales", type=int, nargs="+", default=MATCHING_RESPONSE_SCALES, help="Times each joined response is repeated in the matching benchmark")
+    parser.add_argument("--chunk_rows", type=int, default=CHUNK_ROWS, help="Rows generated and benchmarked at a time. Timings are summed over the chunks and the peak memory is that of the largest chunk, so memory does not grow with the corpus size")
+    args = parser.parse_args()
+
+    # The scorer reads its reference files relative to its own folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.matching:
+        run_matching_suite(args.matching_values, args.matching_response_scales, args.output_file, args.seed)
+    else:
+        run_suite(args.sizes, args.output_file, not args.no_memory, args.only, args.seed, args.chunk_rows)
+
+# Example usage:
+# python benchmark_scoring.py --sizes 10000 100000 --output_file ./benchmark_results.jsonl
+# python benchmark_scoring.py --matching --output_file ./benchmark_results.jsonl
@@ -0,0 +1,127 @@
+import gzip
+import json
+import os
+import re
+
+from score_tables import QUESTION_TABLE_COLUMNS
+
+##########################
+######### SCORE BREAKDOWNS
+##########################
+# Per-question metrics are computed once (the questions table of score_tables.ScoreTables), then
+# any combination of keys is a single group-by reduction over all models at once instead of
+# regrouping and rescoring the results of every model for every slice.
+
+ID_KEYS = ["dataset", "table_id", "question_template", "synthetic_set"]
+TABLE_PROPERTY_PREFIX = "prop_"
+DEFAULT_QAPS_FILE = "../../datasets/realWorld_datasets/qaps/realWorld_HCT_qaps.json"
+
+SYNTHETIC_SET_RE = re.compile(r"set(\d+)")
+
+
+def property_column_name(property_name):
+    # "Multi Level Column" -> "prop_multi_level_column"
+    return TABLE_PROPERTY_PREFIX + re.sub(r"[^0-9a-z]+", "_", property_name.lower()).strip("_")
+
+
+def add_id_keys(question_table):
+    """
+    Adds the keys that can be read from question ids like `arxiv--1--1118--M0`:
+    table_id (`arxiv--1--1118`), question_template (`M0`) and synthetic_set (the N of `setN`).
+    """
+    import pandas as pd
+    ids = question_table["question_id"].astype(str)
+    parts = ids.str.rsplit("--", n=1)
+    question_table = question_table.copy()
+    question_table["table_id"] = parts.str[0].astype("category")
+    question_table["question_template"] = parts.str[-1].where(parts.str.len() > 1).astype("category")
+    question_table["synthetic_set"] = pd.to_numeric(ids.str.extract(SYNTHETIC_SET_RE, expand=False), errors="coerce").astype("Int64")
+    return question_table
+
+
+def find_qaps_file(qaps_file=DEFAULT_QAPS_FILE):
+    # The repo ships the QAPS file as .json.gz and format_files.sh inflates it next to itself,
+    # either one will do
+    for candidate in (qaps_file, qaps_file[:-len(".gz")] if qaps_file.endswith(".gz") else qaps_file + ".gz"):
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"QAPS file {qaps_file} (or .gz) not found, pass the one with the table properties with --qaps_file.")
+
+
+def read_qaps(qaps_file=DEFAULT_QAPS_FILE):
+    qaps_file = find_qaps_file(qaps_file)
+    opener = gzip.open if qaps_file.endswith(".gz") else open
+    with opener(qaps_file, "rt") as f:
+        return json.load(f)
+
+
+def load_table_properties(qaps_file=DEFAULT_QAPS_FILE):
+    """
+    One row per table_id with a boolean column per table property of the QAPS file.
+    """
+    import pandas as pd
+    qaps_list = read_qaps(qaps_file)
+
+    records = []
+    for table_entry in qaps_list:
+        record = {"table_id": table_entry["table_id"]}
+        for property_name, value in table_entry["table_info"].get("table_properties", {}).items():
+            record[property_column_name(property_name)] = value
+        records.append(record)
+    return pd.DataFrame(records).drop_duplicates("table_id")
+
+
+def add_table_properties(question_table, table_properties):
+    merged = question_table.assign(table_id=question_table["table_id"].astype(str)).merge(table_properties, on="table_id", how="left")
+    merged["table_id"] = merged["table_id"].astype("category")
+    return merged
+
+
+def breakdown_table(question_table, keys, metrics):
+    """
+    Mean of every metric and number of questions per (model, mode, *keys) in one group-by pass.
+    """
+    metrics = [m for m in metrics if m in question_table.columns]
+    group_keys = ["model", "mode"] + list(keys)
+    grouped = question_table.groupby(group_keys, observed=True, sort=True, dropna=False)
+    table = grouped[metrics].mean()
+    table.insert(0, "num_questions", grouped.size())
+    return table.reset_index()
+
+
+def parse_breakdowns(breakdown_args):
+    # "dataset,question_template" -> ["dataset", "question_template"]
+    return [[key.strip() for key in arg.split(",") if key.strip()] for arg in breakdown_args]
+
+
+def check_breakdowns(breakdowns, qaps_file=DEFAULT_QAPS_FILE):
+    """
+    Checks every key of `breakdowns` before any file is scored, so a typo or a missing QAPS file
+    stops the run at once instead of after all the scoring. prop_* keys are checked against the
+    table properties of the QAPS file, which is only read when a key asks for one.
+    """
+    known_keys = set(QUESTION_TABLE_COLUMNS + ID_KEYS)
+    if any(key.startswith(TABLE_PROPERTY_PREFIX) for keys in breakdowns for key in keys):
+        for table_entry in read_qaps(qaps_file):
+            known_keys.update(property_column_name(name) for name in table_entry["table_info"].get("table_properties", {}))
+    unknown = sorted({key for keys in breakdowns for key in keys if key not in known_keys})
+    if unknown:
+        raise ValueError(f"Unknown breakdown keys {unknown}. Choose from {ID_KEYS} or the {TABLE_PROPERTY_PREFIX}* table properties.")
+
+
+def compute_breakdowns(question_table, breakdowns, metrics, qaps_file=DEFAULT_QAPS_FILE):
+    """
+    Returns {name: table} for every list of keys in `breakdowns`. Table properties are only
+    loaded from `qaps_file` when a key asks for one.
+    """
+    question_table = add_id_keys(question_table)
+    if any(key.startswith(TABLE_PROPERTY_PREFIX) for keys in breakdowns for key in keys):
+        question_table = add_table_properties(question_table, load_table_properties(qaps_file))
+
+    tables = {}
+    for keys in breakdowns:
+        unknown = [key for key in keys if key not in question_table.columns]
+        if unknown:
+            raise ValueError(f"Unknown breakdown keys {unknown}. Choose from {ID_KEYS} or the {TABLE_PROPERTY_PREFIX}* table properties.")
+        tables["breakdown--" + "_".join(keys)] = breakdown_table(question_table, keys, metrics)
+    return tables
@@ -0,0 +1,70 @@
+import json
+import os
+
+from normalization import normalize_gts
+from score_cache import file_sha256
+
+##########################
+######### GT REFERENCE INDEX
+##########################
+# Cleaned GTs of a reference file (helper_for_vision_scoring.json), built once per scoring run.
+# The index is persisted next to the reference file, tagged with the reference content hash and
+# the scorer version, so later runs and worker processes load it without cleaning every GT again.
+
+LOADED_INDEXES = {}
+
+
+def cleaned_index_path(reference_file):
+    root, ext = os.path.splitext(reference_file)
+    return f"{root}--cleaned_gts{ext or '.json'}"
+
+
+def build_gt_index(reference_file):
+    with open(reference_file) as f:
+        helper_lines = json.load(f)
+
+    cleaned_helper_gts = normalize_gts([x['gt'] for x in helper_lines])
+    return {x["id"]: gt for x, gt in zip(helper_lines, cleaned_helper_gts)}
+
+
+def _read_persisted_index(index_path, reference_sha, scorer_version):
+    try:
+        with open(index_path) as f:
+            persisted = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if persisted.get("reference_sha256") != reference_sha or persisted.get("scorer_version") != scorer_version:
+        return None
+    return persisted["gts"]
+
+
+def _write_persisted_index(index_path, reference_sha, scorer_version, index):
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({"reference_sha256": reference_sha, "scorer_version": scorer_version, "gts": index}, f, separators=(",", ":"))
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # A read-only dataset folder only means the index is rebuilt next time
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_gt_index(reference_file, scorer_version, persist=True):
+    """
+    Returns {question id: cleaned GT values} for `reference_file`, loaded at most once per process.
+    """
+    key = (os.path.abspath(reference_file), scorer_version)
+    if key in LOADED_INDEXES:
+        return LOADED_INDEXES[key]
+
+    reference_sha = file_sha256(reference_file)
+    index_path = cleaned_index_path(reference_file)
+    index = _read_persisted_index(index_path, reference_sha, scorer_version)
+    if index is None:
+        index = build_gt_index(reference_file)
+        if persist:
+            _write_persisted_index(index_path, reference_sha, scorer_version, index)
+
+    LOADED_INDEXES[key] = index
+    return index
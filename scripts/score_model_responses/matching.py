@@ -0,0 +1,56 @@
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+##########################
+######### GT SUBSTRING MATCHING
+##########################
+# Vision recall counts a GT value as found if it is a substring of the response. Checking
+# `x in response` rescans the response once per GT value, which is fast in C for a handful of
+# values but grows with long responses checked against many GT cells. For those questions an
+# Aho-Corasick automaton (pyahocorasick, optional) finds every GT value in one scan.
+
+# Below this many distinct GT values plain `in` checks are faster than one automaton scan.
+# From `benchmark_scoring.py --matching`: with the short responses of the vlms example the set
+# loop wins at every size up to 128 values, with responses 10x longer the built automaton catches
+# up around 64 values and with 100x from 48. Only a handful of real vision questions have
+# this many values, so the automaton is kept for the long answer case.
+AUTOMATON_MIN_VALUES = 64
+MAX_CACHED_AUTOMATA = 4096
+
+
+class GTMatcher:
+    """
+    Counts the distinct GT values contained in a response, with the exact semantics of
+    `sum(1 for x in set(gt) if x in response)`. Automata are cached per GT set so scoring
+    many models on the same questions builds each one only once per process.
+    """
+
+    def __init__(self, min_values=AUTOMATON_MIN_VALUES, max_cached=MAX_CACHED_AUTOMATA):
+        self.min_values = min_values
+        self.max_cached = max_cached
+        self.automata = {}
+
+    def _automaton(self, gt_set):
+        key = frozenset(gt_set)
+        automaton = self.automata.get(key)
+        if automaton is None:
+            if len(self.automata) >= self.max_cached:
+                self.automata.clear()
+            automaton = ahocorasick.Automaton()
+            for value in key:
+                # The empty string is in every response, it is counted separately
+                if value:
+                    automaton.add_word(value, value)
+            automaton.make_automaton()
+            self.automata[key] = automaton
+        return automaton
+
+    def count_contained(self, gt_set, response):
+        if ahocorasick is None or len(gt_set) < self.min_values:
+            return sum(1 for x in gt_set if x in response)
+        automaton = self._automaton(gt_set)
+        # An automaton without words (no GT values, or only "") cannot be searched
+        found = {value for _, value in automaton.iter(response)} if len(automaton) else ()
+        return len(found) + ("" in gt_set)
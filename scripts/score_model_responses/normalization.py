@@ -0,0 +1,127 @@
+import re
+
+##########################
+######### NORMALIZATION ENGINE
+##########################
+# Shared text normalization for ground truths and model responses. All patterns are
+# compiled once at import time and the batch helpers de-duplicate identical inputs,
+# so scoring many models against the same GTs only normalizes each string once.
+
+# Junk tokens models emit before they start explaining themselves
+JUNK_TOKENS_RE = re.compile(r"(?:<eos_token>|#input|# input|# solution:|#solution|# explanation:|#explanation|note:|table:)")
+
+# Comma between two digits (example: 1,000 -> 1000)
+DIGIT_COMMA_RE = re.compile(r"(?<=\d),(?=\d)")
+
+# A maximal run of digit groups separated by single commas (example: 1,000,000)
+DIGIT_GROUP_CHAIN_RE = re.compile(r"\d+(?:,\d+)+")
+
+# Pattern used by the original scorer, applied 5 times in a row
+LEGACY_DIGIT_GROUP_RE = re.compile(r"(\d+),(\d+)")
+
+# Remove trailing .0, .00, .000, etc. and trailing zeros after a decimal (1.50 -> 1.5)
+TRAILING_ZERO_INT_RE = re.compile(r"(\d+)\.0+\b")
+TRAILING_ZERO_DECIMAL_RE = re.compile(r"(\d*\.\d*?[1-9])0+\b")
+
+# Each pass of the original 5-pass loop removes every other comma of a digit chain,
+# so chains with up to 2**5 - 1 commas end up with no commas at all.
+LEGACY_PASSES = 5
+MAX_FULLY_REMOVED_COMMAS = 2 ** LEGACY_PASSES - 1
+
+RESPONSE_VARIANTS = ["default", "vision", "format_variation"]
+
+
+def _remove_chain_commas(match):
+    chain = match.group(0)
+    if chain.count(",") <= MAX_FULLY_REMOVED_COMMAS:
+        return chain.replace(",", "")
+    # Very long chains (lists of 32+ numbers) keep the exact historic behaviour
+    for _ in range(LEGACY_PASSES):
+        chain = LEGACY_DIGIT_GROUP_RE.sub(r"\1\2", chain)
+    return chain
+
+
+def remove_digit_grouping(text):
+    """
+    Single scan equivalent of applying `re.sub(r'(\\d+),(\\d+)', r'\\1\\2', text)` 5 times.
+    """
+    if "," not in text:
+        return text
+    return DIGIT_GROUP_CHAIN_RE.sub(_remove_chain_commas, text)
+
+
+def strip_trailing_zeros(text):
+    if "." not in text:
+        return text
+    text = TRAILING_ZERO_INT_RE.sub(r"\1", text)
+    return TRAILING_ZERO_DECIMAL_RE.sub(r"\1", text)
+
+
+def normalize_gt(ground_truth):
+    ground_truth = DIGIT_COMMA_RE.sub("", ground_truth) if "," in ground_truth else ground_truth
+    ground_truth = ground_truth.lower().strip()
+    values = ground_truth.replace("{", "").replace("}", "").replace("||", "|").split("|")
+    # Dropping the braces can bring digits next to a comma again (example: {1},{2})
+    return [strip_trailing_zeros(remove_digit_grouping(x.strip())) for x in values]
+
+
+def _clean_response_text(response):
+    response = response.lower().strip()
+
+    # If a junk token is found, truncate the response before it
+    match = JUNK_TOKENS_RE.search(response)
+    if match:
+        response = response[:match.start()]
+
+    ### Check for double new line (we see this trend quite often before models start yapping)
+    # NOTE: the original scorer also meant to cut at "\n```\n" but assigned the result to a
+    # typo'd variable, so it never applied. It stays off to keep historic scores unchanged.
+    response = response.split("\n\n")[0]
+
+    # Remove '`' characters
+    response = response.replace("`", "").replace("\n", "")
+
+    # Replace "," in numbers with "" (example: 1,000 -> 1000 & 1,232.23 -> 1232.23 & |1,000,000 -> |1000000)
+    return remove_digit_grouping(response)
+
+
+def normalize_response(response, variant="default"):
+    response = _clean_response_text(response)
+
+    if variant == "default":
+        response = strip_trailing_zeros(response)
+        return [x.strip() for x in response.strip().split("||")]
+    elif variant == "vision":
+        return strip_trailing_zeros(response).strip()
+    elif variant == "format_variation":
+        return [strip_trailing_zeros(x.strip()) for x in response.strip().split("||")]
+    else:
+        raise ValueError(f"Invalid response variant '{variant}'. Choose from {RESPONSE_VARIANTS}.")
+
+
+##########################
+######### BATCH API
+##########################
+
+def normalize_gts(ground_truths):
+    cache = {}
+    cleaned = []
+    for gt in ground_truths:
+        if gt not in cache:
+            cache[gt] = normalize_gt(gt)
+        # Hand out copies so callers can mutate their lists without touching the cache
+        cleaned.append(list(cache[gt]))
+    return cleaned
+
+
+def normalize_responses(responses, variant="default"):
+    if variant not in RESPONSE_VARIANTS:
+        raise ValueError(f"Invalid response variant '{variant}'. Choose from {RESPONSE_VARIANTS}.")
+    cache = {}
+    cleaned = []
+    for response in responses:
+        if response not in cache:
+            cache[response] = normalize_response(response, variant)
+        value = cache[response]
+        cleaned.append(list(value) if isinstance(value, list) else value)
+    return cleaned
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+
+##########################
+######### SCORE CACHE
+##########################
+# Persistent per-file score cache. An entry is keyed by the content hash of the response
+# file, the scorer version, the content hash of the GT reference file (if any) and the
+# scoring context, so only new or modified response files get rescored.
+
+HASH_CHUNK_SIZE = 1 << 20
+INDEX_FILE_NAME = "index.json"
+ENTRY_SUFFIX = ".json"
+
+
+def file_sha256(fname):
+    sha = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ScoreCache:
+    """
+    On-disk cache of per-file scoring results with least-recently-used eviction.
+    """
+
+    def __init__(self, cache_dir, scorer_version, max_size_mb=512):
+        self.cache_dir = cache_dir
+        self.scorer_version = scorer_version
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Fast path: absolute path -> size, mtime and content hash seen last time
+        self.index_path = os.path.join(self.cache_dir, INDEX_FILE_NAME)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+        self.index_dirty = False
+
+    def content_hash(self, fname):
+        full_path = os.path.abspath(fname)
+        stat = os.stat(full_path)
+        entry = self.index.get(full_path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
+
+        sha = file_sha256(full_path)
+        self.index[full_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha}
+        self.index_dirty = True
+        return sha
+
+    def key_for(self, fname, context=None, reference_file=None):
+        key_parts = {
+            "response_file": self.content_hash(fname),
+            "scorer_version": self.scorer_version,
+            "reference_file": self.content_hash(reference_file) if reference_file else None,
+            "context": context,
+        }
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # Touch the entry so eviction drops the least recently used ones first
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(ENTRY_SUFFIX) or fname == INDEX_FILE_NAME:
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, fname))
+            entries.append((stat.st_mtime_ns, stat.st_size, fname))
+            total_size += stat.st_size
+
+        entries.sort()
+        removed = 0
+        for _, size, fname in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, fname))
+            total_size -= size
+            removed += 1
+        return removed
+
+    def close(self):
+        # Forget index entries for files that no longer exist, then persist the fast path index
+        for full_path in [p for p in self.index if not os.path.exists(p)]:
+            del self.index[full_path]
+            self.index_dirty = True
+        if self.index_dirty:
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+            self.index_dirty = False
+        return self.evict()
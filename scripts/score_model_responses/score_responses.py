@@ -1,146 +1,73 @@
-import json
-import re, os
+import os
+import time
 import argparse
-import pandas as pd
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from normalization import normalize_gt, normalize_gts, normalize_response, normalize_responses
+from streaming import iter_result_records, peek_first_record, DatasetMetricsAccumulator, JsonlTail
+from score_cache import ScoreCache
+from score_tables import ScoreTables, TABLE_FORMATS, ALL_METRICS, new_question_scores, add_question_scores, write_table
+from significance import bootstrap_ci_table, paired_tests_table, DEFAULT_ALPHA
+from matching import GTMatcher
+from gt_index import load_gt_index
+from breakdowns import compute_breakdowns, check_breakdowns, parse_breakdowns, DEFAULT_QAPS_FILE
+
+# Bump whenever a change to normalization, metrics or the per-file result layout can change
+# what is cached, this invalidates the score cache and the persisted cleaned GT index
+SCORER_VERSION = "3"
+
+VISION_GT_REFERENCE_FILE = "./helper_for_vision_scoring.json"
+DEFAULT_CACHE_DIR = "./.score_cache"
 
 ##########################
 ######### HELPER FUNCTIONS
 ##########################
 
 def clean_gt_val(ground_truth_t):
-    ground_truth = re.sub(r"(?<=\d),(?=\d)", "", ground_truth_t)
-    ground_truth = ground_truth.lower().strip()
-    ground_truth = [x.lower().strip() for x in ground_truth.replace("{", "").replace("}", "").replace("||", "|").split("|")]
-    for j in range(len(ground_truth)):
-        temp_val = ground_truth[j]
-        for _ in range(5):
-            temp_val = re.sub(r'(\d+),(\d+)', r'\1\2', temp_val)
-
-        # Remove trailing .0, .00, .000, etc.
-        temp_val = re.sub(r'(\d+)\.0+\b', r'\1', temp_val)
-        temp_val = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', temp_val)
-
-        ground_truth[j] = temp_val
-
-    return ground_truth
+    return normalize_gt(ground_truth_t)
 
 def post_process_response(response: str) -> str:
+    return normalize_response(response, "default")
 
-    response = response.lower().strip()
-    
-    # Define the regex pattern to match any of the junk tokens
-    junk_tokens = r"(?:<eos_token>|#input|# input|# solution:|#solution|# explanation:|#explanation|note:|table:)"
-    
-    # Find the position of the first junk token
-    match = re.search(junk_tokens, response)
-    
-    # If a junk token is found, truncate the response before it
-    if match:
-        response = response[:match.start()]
-    
-    ### Check for double new line (we see this trend quite often before models start yapping)
-    response = response.split("\n\n")[0]
-    reponse = response.split("\n```\n")[0]
-
-    # Remove '`' characters
-    response = response.replace("`", "").replace("\n","")
+def post_process_response_vision_models_only(response: str) -> str:
+    return normalize_response(response, "vision")
 
-    # Replace "," in numbers with "" (example: 1,000 -> 1000 & 1,232.23 -> 1232.23 & |1,000,000 -> |1000000)
-    for i in range(5):
-        response = re.sub(r'(\d+),(\d+)', r'\1\2', response)
-    
-    # Remove trailing .0, .00, .000, etc.
-    response = re.sub(r'(\d+)\.0+\b', r'\1', response)
-    response = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', response)
+def post_process_response_format_variation(response: str) -> str:
+    return normalize_response(response, "format_variation")
 
-    return [x.strip() for x in response.lower().strip().split("||")]
+TEXT_METRICS = ["precision", "recall", "f1", "cc"]
+VISION_METRICS = ["recall", "cc"]
 
-def post_process_response_vision_models_only(response: str) -> str:
-
-    response = response.lower().strip()
-    
-    # Define the regex pattern to match any of the junk tokens
-    junk_tokens = r"(?:<eos_token>|#input|# input|# solution:|#solution|# explanation:|#explanation|note:|table:)"
-    
-    # Find the position of the first junk token
-    match = re.search(junk_tokens, response)
+# For each response and GT pair calculate precision and recall
+def calculate_precision_recall(gt, response):
+    gt_set = set(gt)
+    response_set = set(response)
     
-    # If a junk token is found, truncate the response before it
-    if match:
-        response = response[:match.start()]
+    # Calculate precision and recall
+    precision = sum(1 for x in response_set if x in gt_set) / max(len(response_set), 1)
+    recall = sum(1 for x in gt_set if x in response_set) / max(len(gt_set), 1)
     
-    ### Check for double new line (we see this trend quite often before models start yapping)
-    response = response.split("\n\n")[0]
-    reponse = response.split("\n```\n")[0]
+    return precision, recall
 
-    # Remove '`' characters
-    response = response.replace("`", "").replace("\n","")
-
-    # Replace "," in numbers with "" (example: 1,000 -> 1000 & 1,232.23 -> 1232.23 & |1,000,000 -> |1000000)
-    for i in range(5):
-        response = re.sub(r'(\d+),(\d+)', r'\1\2', response)
+def calculate_f1(precision, recall):
+    if precision + recall == 0:
+        return 0
+    else:
+        return (2 * precision * recall) / (precision + recall)
 
-    # Remove trailing .0, .00, .000, etc.
-    response = re.sub(r'(\d+)\.0+\b', r'\1', response)
-    response = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', response)
-    
-    return response.lower().strip()
+VISION_GT_MATCHER = GTMatcher()
 
-def post_process_response_format_variation(response: str) -> str:
+def calculate_recall_vision(gt, response):
+    gt_set = set(gt)
+    # For vision models a GT value counts as recalled if it appears anywhere in the response
+    recall = VISION_GT_MATCHER.count_contained(gt_set, response) / max(len(gt_set), 1)
+    return recall
 
-    response = response.lower().strip()
-    
-    # Define the regex pattern to match any of the junk tokens
-    junk_tokens = r"(?:<eos_token>|#input|# input|# solution:|#solution|# explanation:|#explanation|note:|table:)"
-    
-    # Find the position of the first junk token
-    match = re.search(junk_tokens, response)
-    
-    # If a junk token is found, truncate the response before it
-    if match:
-        response = response[:match.start()]
-    
-    ### Check for double new line (we see this trend quite often before models start yapping)
-    response = response.split("\n\n")[0]
-    reponse = response.split("\n```\n")[0]
-
-    # Remove '`' characters
-    response = response.replace("`", "").replace("\n","")
-
-    # Replace "," in numbers with "" (example: 1,000 -> 1000 & 1,232.23 -> 1232.23 & |1,000,000 -> |1000000)
-    for i in range(5):
-        response = re.sub(r'(\d+),(\d+)', r'\1\2', response)
-
-    values = [x.strip() for x in response.lower().strip().split("||")]
-    new_values = []
-    for value in values:
-        # Remove trailing .0, .00, .000, etc.
-        new_value = re.sub(r'(\d+)\.0+\b', r'\1', value)
-        new_value = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', new_value)
-        new_values.append(new_value)
-        
-    return new_values
-    
 def get_prec_rec_f1_cc(results):
-    cleaned_gts = [clean_gt_val(x['gt']) for x in results]
-    cleaned_responses = [post_process_response(x['response']) for x in results]
-
-    # For each response and GT pair calculate precision and recall
-    def calculate_precision_recall(gt, response):
-        gt_set = set(gt)
-        response_set = set(response)
-        
-        # Calculate precision and recall
-        precision = sum(1 for x in response_set if x in gt_set) / max(len(response_set), 1)
-        recall = sum(1 for x in gt_set if x in response_set) / max(len(gt_set), 1)
-        
-        return precision, recall
-
-    def calculate_f1(precision, recall):
-        if precision + recall == 0:
-            return 0
-        else:
-            return (2 * precision * recall) / (precision + recall)
+    cleaned_gts = normalize_gts([x['gt'] for x in results])
+    cleaned_responses = normalize_responses([x['response'] for x in results], "default")
 
     # Calculate precision, recall, and F1 score for each response
     precision_list = []
@@ -183,23 +110,16 @@ def results_to_per_dataset_results(results):
 
 
 def get_rec_cc_vision(results):
-    
-    # For each response and GT pair calculate precision and recall
-    def calculate_recall(gt, response):
-        gt_set = set(gt)
-        # Calculate precision and recall
-        recall = sum(1 for x in gt_set if x in response) / max(len(gt_set), 1)
-        return recall
-    
+
     # Calculate Recall and CC score for each response
     cleaned_gts = [x['gt'] for x in results]
-    cleaned_responses = [post_process_response_vision_models_only(x['response']) for x in results]
+    cleaned_responses = normalize_responses([x['response'] for x in results], "vision")
     
     recall_list = []
     cc_list = []
 
     for i in range(len(results)):
-        recall = calculate_recall(cleaned_gts[i], cleaned_responses[i])
+        recall = calculate_recall_vision(cleaned_gts[i], cleaned_responses[i])
         recall_list.append(recall)
         if recall == 1:
             cc_list.append(1)
@@ -212,39 +132,33 @@ def get_rec_cc_vision(results):
 
     return avg_recall, avg_cc
 
-def results_to_per_dataset_results_vision(results):
-    # Create a dictionary to hold the results for each dataset
-    dataset_results = {}
-    # Iterate through the results and group them by dataset
-    for result in results:
-        dataset = result['id'].split("--")[0]
-        if dataset not in dataset_results:
-            dataset_results[dataset] = [result]
-        else:
-            dataset_results[dataset].append(result)
-    return dataset_results
+# Vision results are grouped exactly like text results, other breakdowns live in breakdowns.py
+results_to_per_dataset_results_vision = results_to_per_dataset_results
 
-def get_recall_cc_vision_results(fname):
+def get_vision_gt_index():
+    # Cleaned once per process (or loaded from the persisted index) and shared by every file
+    return load_gt_index(VISION_GT_REFERENCE_FILE, SCORER_VERSION)
+
+def get_recall_cc_vision_results(fname, stats=None):
     all_results = {}
-    ### Load File 
-    with open(fname) as f:
-        lines = f.readlines()
-        lines = [json.loads(x) for x in lines]
+    ### Load File (JSONL or JSON array)
+    lines = list(iter_result_records(fname))
 
     ### Reference GTs
-    with open("./helper_for_vision_scoring.json") as f:
-        helper_lines = json.load(f)
-
-    ids_to_gts = {x["id"]: clean_gt_val(x['gt']) for x in helper_lines}
+    ids_to_gts = get_vision_gt_index()
 
     # Do this filtering because these results include ones with bad ground truths and bad questions as well
     final_lines = []
+    missing_ids = 0
     for line in lines:
-        try:
-            line["gt"] = ids_to_gts[line["id"]]
-            final_lines.append(line)
-        except:
+        gt = ids_to_gts.get(line["id"])
+        if gt is None:
+            missing_ids += 1
             continue
+        line["gt"] = gt
+        final_lines.append(line)
+    if stats is not None:
+        stats["missing_ids"] = missing_ids
     
     all_recall, all_cc = get_rec_cc_vision(final_lines)
     all_results["ALL"] = {}
@@ -262,26 +176,183 @@ def get_recall_cc_vision_results(fname):
     return all_results
 
 
+def get_prec_rec_f1_cc_results(results):
+    all_results = {}
+    mean_precision, mean_recall, mean_f1, mean_cc = get_prec_rec_f1_cc(results)
+    all_results["ALL"] = {"precision": mean_precision, "recall": mean_recall, "f1": mean_f1, "cc": mean_cc}
+
+    dataset_results = results_to_per_dataset_results(results)
+
+    for dataset, results_d in dataset_results.items():
+        mean_precision, mean_recall, mean_f1, mean_cc = get_prec_rec_f1_cc(results_d)
+        all_results[dataset] = {"precision": mean_precision, "recall": mean_recall, "f1": mean_f1, "cc": mean_cc}
+
+    return all_results
+
+
+############################
+######### STREAMING SCORING
+############################
+# Same scores as the list based functions above, but the response file is read one record
+# at a time and only running sums are kept, so memory does not grow with the file size.
+
+def score_text_record(result):
+    gt = normalize_gt(result['gt'])
+    response = normalize_response(result['response'], "default")
+    precision, recall = calculate_precision_recall(gt, response)
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": calculate_f1(precision, recall),
+        "cc": 1 if recall == 1 else 0
+    }
+
+def score_vision_record(line, ids_to_gts):
+    # None for results with bad ground truths and bad questions, they are not in the reference GTs
+    gt = ids_to_gts.get(line["id"])
+    if gt is None:
+        return None
+    recall = calculate_recall_vision(gt, normalize_response(line['response'], "vision"))
+    return {"recall": recall, "cc": 1 if recall == 1 else 0}
+
+def stream_prec_rec_f1_cc_results(fname, question_scores=None):
+    accumulator = DatasetMetricsAccumulator(TEXT_METRICS)
+    for result in iter_result_records(fname):
+        values = score_text_record(result)
+        accumulator.add(result['id'], values)
+        if question_scores is not None:
+            add_question_scores(question_scores, result['id'], values)
+    return accumulator.results()
+
+def stream_recall_cc_vision_results(fname, question_scores=None, stats=None):
+    ### Reference GTs
+    ids_to_gts = get_vision_gt_index()
+
+    accumulator = DatasetMetricsAccumulator(VISION_METRICS)
+    missing_ids = 0
+    for line in iter_result_records(fname):
+        values = score_vision_record(line, ids_to_gts)
+        if values is None:
+            missing_ids += 1
+            continue
+        accumulator.add(line["id"], values)
+        if question_scores is not None:
+            add_question_scores(question_scores, line["id"], values)
+    if stats is not None:
+        stats["missing_ids"] = missing_ids
+    return accumulator.results()
+
+
 ############################
 ######### MAIN SCORING FUNCS
 ############################
 
-def score_vision_only_results(folder_name, output_file, print_results=False):
+# Per-file results are {"datasets": {dataset: {metric: mean}}, "questions": per-question columns or None},
+# plus "missing_ids" for vision files. Per-question scores come from the streaming path, whose means
+# match the list based path exactly.
+
+def score_vision_file(full_fname, stream=False, with_questions=False):
+    stats = {}
+    if with_questions:
+        question_scores = new_question_scores(VISION_METRICS)
+        all_results = stream_recall_cc_vision_results(full_fname, question_scores, stats)
+        return {"datasets": all_results, "questions": question_scores, "missing_ids": stats["missing_ids"]}
+    if stream:
+        all_results = stream_recall_cc_vision_results(full_fname, stats=stats)
+    else:
+        all_results = get_recall_cc_vision_results(full_fname, stats)
+    return {"datasets": all_results, "questions": None, "missing_ids": stats["missing_ids"]}
+
+def score_text_file(full_fname, stream=False, per_dataset=True, with_questions=False):
+    if stream or with_questions:
+        question_scores = new_question_scores(TEXT_METRICS) if with_questions else None
+        all_results = stream_prec_rec_f1_cc_results(full_fname, question_scores)
+        if not per_dataset:
+            all_results = {"ALL": all_results["ALL"]}
+        return {"datasets": all_results, "questions": question_scores}
+
+    # Text results are JSON arrays or, from checkpoints and other engines, JSONL
+    results = list(iter_result_records(full_fname))
+    if per_dataset:
+        return {"datasets": get_prec_rec_f1_cc_results(results), "questions": None}
+    mean_precision, mean_recall, mean_f1, mean_cc = get_prec_rec_f1_cc(results)
+    return {"datasets": {"ALL": {"precision": mean_precision, "recall": mean_recall, "f1": mean_f1, "cc": mean_cc}}, "questions": None}
+
+def score_text_file_or_none(full_fname, stream=False, per_dataset=True, with_questions=False):
+    # Synthetic scoring reports broken files as "Error" instead of stopping the run
+    try:
+        return score_text_file(full_fname, stream, per_dataset, with_questions)
+    except Exception:
+        return None
+
+def score_files(score_file_fn, full_fnames, workers=1, cache=None, cache_context=None, reference_file=None):
+    # Results come back in the order of full_fnames whatever the number of workers,
+    # so the output file is the same as a serial run
+    file_results = [None] * len(full_fnames)
+    cache_keys = [None] * len(full_fnames)
+    to_score = []
+    for i, full_fname in enumerate(full_fnames):
+        if cache is not None:
+            cache_keys[i] = cache.key_for(full_fname, cache_context, reference_file)
+            file_results[i] = cache.get(cache_keys[i])
+        if file_results[i] is None:
+            to_score.append(i)
+
+    fnames_to_score = [full_fnames[i] for i in to_score]
+    if workers <= 1 or len(fnames_to_score) <= 1:
+        new_results = [score_file_fn(full_fname) for full_fname in fnames_to_score]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(fnames_to_score))) as executor:
+            new_results = list(executor.map(score_file_fn, fnames_to_score))
+
+    for i, results in zip(to_score, new_results):
+        file_results[i] = results
+        # Files that failed to score are retried on the next run
+        if cache is not None and results is not None:
+            cache.put(cache_keys[i], results)
+
+    return file_results
+
+def format_vision_results(model_name, all_results):
     output_string = ""
+    for dataset, results in all_results.items():
+        output_string += f"Model: {model_name} on {dataset}\n"
+        output_string += f"Mean Recall: {results['recall']:.4f}\n"
+        output_string += f"Mean CC Score: {results['cc']:.4f}\n"
+        output_string += "*" * 50
+    return output_string
 
-    for fname in os.listdir(folder_name):
-        if "vision" not in fname:
-            continue
-        full_fname = os.path.join(folder_name, fname)
-        all_results = get_recall_cc_vision_results(full_fname)
-
-        for dataset, results in all_results.items():
-            model_name = fname.split("--")[0]
-            output_string += f"Model: {model_name} on {dataset}\n"
-            output_string += f"Mean Recall: {results['recall']:.4f}\n"
-            output_string += f"Mean CC Score: {results['cc']:.4f}\n"
-            output_string += "*" * 50
-        
+def format_text_results(model_name, data_mode, all_results):
+    output_string = ""
+    for dataset, results_d in all_results.items():
+        output_string += f"Model: {model_name} on {data_mode} on dataset {dataset}\n"
+        output_string += f"Mean Precision: {results_d['precision']:.4f}\n"
+        output_string += f"Mean Recall: {results_d['recall']:.4f}\n"
+        output_string += f"Mean F1 Score: {results_d['f1']:.4f}\n"
+        output_string += f"Mean CC Score: {results_d['cc']:.4f}\n"
+        output_string += "*" * 50
+    return output_string
+
+def format_synthetic_results(fname, all_results):
+    output_string = f"{fname}\n"
+    try:
+        mean_results = all_results["ALL"]
+        model_name = fname.split("--")[0]
+        data_mode = fname.split("--")[1]
+
+        output_string += f"Model: {model_name} on {data_mode}\n"
+        output_string += f"Mean Precision: {mean_results['precision']:.4f}\n"
+        output_string += f"Mean Recall: {mean_results['recall']:.4f}\n"
+        output_string += f"Mean F1 Score: {mean_results['f1']:.4f}\n"
+        output_string += f"Mean CC Score: {mean_results['cc']:.4f}\n"
+        output_string += "*" * 50
+
+    except Exception:
+        output_string += "Error\n"
+        output_string += "*" * 50
+    return output_string
+
+def write_output(output_string, output_file, print_results=False):
     with open(output_file, "w") as f:
         f.write(output_string)
 
@@ -289,85 +360,234 @@ def score_vision_only_results(folder_name, output_file, print_results=False):
         print(output_string)
 
     print(f"Results saved to {output_file}")
-    return
 
-def score_realHCT_text_only_results(folder_name, output_file, print_results=False):
+
+def vision_results_report(folder_name, fnames, stream=False, workers=1, cache=None, tables=None):
     output_string = ""
 
-    for fname in os.listdir(folder_name):
-        if "real"  not in fname:
-            continue
-        with open(os.path.join(folder_name, fname)) as f:
-            results = json.load(f)
+    with_questions = tables is not None
+    full_fnames = [os.path.join(folder_name, fname) for fname in fnames]
+    # Build the cleaned GT index before any worker starts, forked workers then share it
+    get_vision_gt_index()
+    file_results = score_files(partial(score_vision_file, stream=stream, with_questions=with_questions), full_fnames, workers,
+                               cache, {"scorer": "vision", "with_questions": with_questions}, VISION_GT_REFERENCE_FILE)
+
+    for fname, file_result in zip(fnames, file_results):
+        all_results = file_result["datasets"]
+        if file_result["missing_ids"]:
+            print(f"{fname}: skipped {file_result['missing_ids']} responses whose id is not in {VISION_GT_REFERENCE_FILE}")
+        if tables is not None:
+            tables.add_file(fname.split("--")[0], "vision", all_results, file_result["questions"])
+        output_string += format_vision_results(fname.split("--")[0], all_results)
+
+    return output_string
+
+def realHCT_text_results_report(folder_name, fnames, stream=False, workers=1, cache=None, tables=None):
+    output_string = ""
+
+    with_questions = tables is not None
+    full_fnames = [os.path.join(folder_name, fname) for fname in fnames]
+    file_results = score_files(partial(score_text_file, stream=stream, with_questions=with_questions), full_fnames, workers,
+                               cache, {"scorer": "text_per_dataset", "with_questions": with_questions})
 
+    for fname, file_result in zip(fnames, file_results):
+        all_results = file_result["datasets"]
         model_name = fname.split("--")[0]
         data_mode = fname.split("--")[1]
-        mean_precision, mean_recall, mean_f1, mean_cc = get_prec_rec_f1_cc(results)
+        if tables is not None:
+            tables.add_file(model_name, data_mode, all_results, file_result["questions"])
+        output_string += format_text_results(model_name, data_mode, all_results)
 
-        output_string += f"Model: {model_name} on {data_mode} on dataset ALL\n"
-        output_string += f"Mean Precision: {mean_precision:.4f}\n"
-        output_string += f"Mean Recall: {mean_recall:.4f}\n"
-        output_string += f"Mean F1 Score: {mean_f1:.4f}\n"
-        output_string += f"Mean CC Score: {mean_cc:.4f}\n"
-        output_string += "*" * 50
+    return output_string
 
-        dataset_results = results_to_per_dataset_results(results)
+def syntheticHCT_text_results_report(folder_name, fnames, stream=False, workers=1, cache=None, tables=None):
+    output_string = ""
 
-        for dataset, results_d in dataset_results.items():
-            model_name = fname.split("--")[0]
-            data_mode = fname.split("--")[1]
-            mean_precision, mean_recall, mean_f1, mean_cc = get_prec_rec_f1_cc(results_d)
+    with_questions = tables is not None
+    full_fnames = [os.path.join(folder_name, fname) for fname in fnames]
+    file_results = score_files(partial(score_text_file_or_none, stream=stream, per_dataset=False, with_questions=with_questions), full_fnames, workers,
+                               cache, {"scorer": "text_all", "with_questions": with_questions})
 
-            output_string += f"Model: {model_name} on {data_mode} on dataset {dataset}\n"
-            output_string += f"Mean Precision: {mean_precision:.4f}\n"
-            output_string += f"Mean Recall: {mean_recall:.4f}\n"
-            output_string += f"Mean F1 Score: {mean_f1:.4f}\n"
-            output_string += f"Mean CC Score: {mean_cc:.4f}\n"
-            output_string += "*" * 50
+    for fname, file_result in zip(fnames, file_results):
+        all_results = None if file_result is None else file_result["datasets"]
+        if tables is not None and file_result is not None:
+            tables.add_file(fname.split("--")[0], fname.split("--")[1], all_results, file_result["questions"])
+        output_string += format_synthetic_results(fname, all_results)
 
-    with open(output_file, "w") as f:
-        f.write(output_string)
+    return output_string
 
-    if print_results:
-        print(output_string)
+def score_vision_only_results(folder_name, output_file, print_results=False, stream=False, workers=1, cache=None, tables=None):
+    fnames = [fname for fname in os.listdir(folder_name) if "vision" in fname]
+    output_string = vision_results_report(folder_name, fnames, stream, workers, cache, tables)
+    write_output(output_string, output_file, print_results)
+    return
 
-    print(f"Results saved to {output_file}")
+def score_realHCT_text_only_results(folder_name, output_file, print_results=False, stream=False, workers=1, cache=None, tables=None):
+    fnames = [fname for fname in os.listdir(folder_name) if "real" in fname]
+    output_string = realHCT_text_results_report(folder_name, fnames, stream, workers, cache, tables)
+    write_output(output_string, output_file, print_results)
     return
 
 
-def score_syntheticHCT_text_only_results(folder_name, output_file, print_results=False):
-    output_string = ""
+def score_syntheticHCT_text_only_results(folder_name, output_file, print_results=False, stream=False, workers=1, cache=None, tables=None):
+    fnames = [fname for fname in os.listdir(folder_name) if "synthetic" in fname]
+    output_string = syntheticHCT_text_results_report(folder_name, fnames, stream, workers, cache, tables)
+    write_output(output_string, output_file, print_results)
+    return
+
+############################
+######### MIXED FOLDERS
+############################
+# One scan of the folder, each file is classified once from its first record and its name
+# tag, so a file is never scored by two scorers and a whole experiment folder gives one report.
+
+RESULT_FILE_KINDS = ["vision", "real", "synthetic"]
+
+def classify_result_file(full_fname):
+    """
+    Returns "vision", "real" or "synthetic" for a results file, or None if it is not one.
+    Vision results have no GT (it comes from the reference file), text results carry their GT.
+    Text results are per dataset unless the name tag (`model--syntheticHCTs--results.json`) is synthetic.
+    """
+    if not os.path.isfile(full_fname):
+        return None
+    first_record = peek_first_record(full_fname)
+    if not isinstance(first_record, dict) or "id" not in first_record or "response" not in first_record:
+        return None
+    if "gt" not in first_record:
+        return "vision"
+    name_parts = os.path.basename(full_fname).split("--")
+    if len(name_parts) > 1 and "synthetic" in name_parts[1].lower():
+        return "synthetic"
+    return "real"
+
+def classify_result_files(folder_name):
+    files_by_kind = {kind: [] for kind in RESULT_FILE_KINDS}
+    skipped = []
+    # Subfolders (checkpoints/, shards/, scores/) are not results files, nor worth listing as skipped
+    fnames = [fname for fname in sorted(os.listdir(folder_name)) if os.path.isfile(os.path.join(folder_name, fname))]
+    for fname in fnames:
+        kind = classify_result_file(os.path.join(folder_name, fname))
+        if kind is None:
+            skipped.append(fname)
+        else:
+            files_by_kind[kind].append(fname)
+    return files_by_kind, skipped
 
-    for fname in os.listdir(folder_name):
-        if "synthetic" not in fname:
+def score_all_results(folder_name, output_file, print_results=False, stream=False, workers=1, cache=None, tables=None):
+    files_by_kind, skipped = classify_result_files(folder_name)
+    report_builders = {
+        "vision": vision_results_report,
+        "real": realHCT_text_results_report,
+        "synthetic": syntheticHCT_text_results_report,
+    }
+
+    output_string = ""
+    for kind in RESULT_FILE_KINDS:
+        fnames = files_by_kind[kind]
+        if not fnames:
             continue
-        output_string += f"{fname}\n"
-        try:
-            with open(os.path.join(folder_name, fname)) as f:
-                results = json.load(f)
-            model_name = fname.split("--")[0]
-            data_mode = fname.split("--")[1]
-            mean_precision, mean_recall, mean_f1, mean_cc = get_prec_rec_f1_cc(results)
-
-            output_string += f"Model: {model_name} on {data_mode}\n"
-            output_string += f"Mean Precision: {mean_precision:.4f}\n"
-            output_string += f"Mean Recall: {mean_recall:.4f}\n"
-            output_string += f"Mean F1 Score: {mean_f1:.4f}\n"
-            output_string += f"Mean CC Score: {mean_cc:.4f}\n"
-            output_string += "*" * 50
-
-        except Exception as e:
-            output_string += "Error\n"
-            output_string += "*" * 50
+        output_string += ("\n\n" if output_string else "") + f"########## {kind.upper()} RESULTS ({len(fnames)} files)\n\n"
+        output_string += report_builders[kind](folder_name, fnames, stream, workers, cache, tables)
+    if skipped:
+        output_string += ("\n\n" if output_string else "") + "########## SKIPPED (not a results file)\n\n" + "".join(f"{fname}\n" for fname in skipped)
 
-    with open(output_file, "w") as f:
-        f.write(output_string)
+    write_output(output_string, output_file, print_results)
+    return files_by_kind
 
-    if print_results:
-        print(output_string)
+############################
+######### WATCH MODE
+############################
+# Scores JSONL response files while inference is still appending to them (vlm_inf.py writes
+# every 50 prompts), so a bad model or a broken prompt shows up in the scores early. Runs in
+# progress write to subfolders of the results folder: llm_inf.py checkpoints to
+# checkpoints/*.partial.jsonl and sharded runs write to shards/ (and shards/checkpoints/).
+
+WATCH_MODE_FILTERS = {"vision": "vision", "real": "real", "synthetic": "synthetic"}
+WATCH_SUBFOLDERS = ["checkpoints", "shards", os.path.join("shards", "checkpoints")]
+
+def list_watch_files(folder_name, mode):
+    """
+    Returns the JSONL response files of the mode in the folder and its WATCH_SUBFOLDERS,
+    as paths relative to the folder.
+    """
+    fnames = []
+    for subfolder in [""] + WATCH_SUBFOLDERS:
+        folder = os.path.join(folder_name, subfolder)
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(os.listdir(folder)):
+            if WATCH_MODE_FILTERS[mode] in fname and fname.endswith(".jsonl") and os.path.isfile(os.path.join(folder, fname)):
+                fnames.append(os.path.join(subfolder, fname))
+    return fnames
+
+def format_watch_results(mode, fname, accumulator):
+    all_results = accumulator.results()
+    fname = os.path.basename(fname)
+    if mode == "vision":
+        return format_vision_results(fname.split("--")[0], all_results)
+    if mode == "synthetic":
+        return format_synthetic_results(fname, {"ALL": all_results["ALL"]})
+    return format_text_results(fname.split("--")[0], fname.split("--")[1], all_results)
+
+def watch_results(folder_name, output_file, mode, interval=30, print_results=True, max_updates=None):
+    metric_names = VISION_METRICS if mode == "vision" else TEXT_METRICS
+    ids_to_gts = get_vision_gt_index() if mode == "vision" else None
+    tails = {}
+    accumulators = {}
+    missing_ids = {}
+    updates = 0
+
+    try:
+        while True:
+            for fname in list_watch_files(folder_name, mode):
+                if fname not in tails:
+                    tails[fname] = JsonlTail(os.path.join(folder_name, fname))
+                    accumulators[fname] = DatasetMetricsAccumulator(metric_names)
+                    missing_ids[fname] = 0
+
+                try:
+                    records, restarted = tails[fname].read_new_records()
+                except FileNotFoundError:
+                    # A finished run removes its checkpoint, its last scores stay in the report
+                    continue
+                if restarted:
+                    accumulators[fname] = DatasetMetricsAccumulator(metric_names)
+                    missing_ids[fname] = 0
+                for record in records:
+                    if mode == "vision":
+                        values = score_vision_record(record, ids_to_gts)
+                    else:
+                        values = score_text_record(record)
+                    if values is None:
+                        missing_ids[fname] += 1
+                        continue
+                    accumulators[fname].add(record["id"], values)
+
+            output_string = ""
+            for fname, accumulator in accumulators.items():
+                if accumulator.all.count == 0:
+                    continue
+                output_string += f"{fname}: {accumulator.all.count} responses scored, {missing_ids[fname]} skipped\n"
+                output_string += format_watch_results(mode, fname, accumulator) + "\n"
+
+            # Replace the output file in one step so readers never see a half written update
+            tmp_output_file = f"{output_file}.tmp"
+            with open(tmp_output_file, "w") as f:
+                f.write(output_string)
+            os.replace(tmp_output_file, output_file)
+            if print_results:
+                print(time.strftime("%H:%M:%S"), "\n" + output_string)
+
+            updates += 1
+            if max_updates is not None and updates >= max_updates:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Watch stopped")
 
     print(f"Results saved to {output_file}")
-    return
+    return accumulators
 
 ############ MAIN
 
@@ -376,23 +596,74 @@ if __name__ == "__main__":
     parser.add_argument("--folder_name", type=str, required=True, help="Folder containing the model response files")
     parser.add_argument("--output_file", type=str, required=True, help="Output file to save the results")
     parser.add_argument("--print_results", action="store_true", help="Print results to console")
-    parser.add_argument("--mode", type=str, required=True, choices=["vision", "real", "synthetic"], help="Mode to run the scoring for")
+    parser.add_argument("--mode", type=str, required=True, choices=["vision", "real", "synthetic", "all"], help="Mode to run the scoring for, all classifies every file of the folder by its content and writes one report")
+    parser.add_argument("--stream", action="store_true", help="Read response files (JSON array or JSONL) record by record with constant memory")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to score response files in parallel")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="Rescore every file instead of reusing cached scores of unchanged files")
+    parser.add_argument("--cache_dir", type=str, default=DEFAULT_CACHE_DIR, help="Folder of the persistent score cache")
+    parser.add_argument("--cache_max_mb", type=float, default=512, help="Size limit of the score cache, least recently used entries are evicted first")
+    parser.add_argument("--tables_prefix", type=str, default=None, help="Also write per-question and aggregate score tables to <prefix>--questions.<format> and <prefix>--aggregates.<format>")
+    parser.add_argument("--tables_format", type=str, default="parquet", choices=TABLE_FORMATS, help="File format of the score tables")
+    parser.add_argument("--bootstrap_resamples", type=int, default=0, help="If > 0, also write bootstrap confidence intervals and paired model tests with this many resamples (needs --tables_prefix)")
+    parser.add_argument("--bootstrap_alpha", type=float, default=DEFAULT_ALPHA, help="Confidence intervals cover 1 - alpha")
+    parser.add_argument("--breakdowns", type=str, nargs="+", default=None, help="Also write score tables grouped by these comma separated keys, e.g. dataset,question_template prop_multi_level_column (needs --tables_prefix)")
+    parser.add_argument("--qaps_file", type=str, default=DEFAULT_QAPS_FILE, help="QAPS file (.json or .json.gz, either one is found from the other) with the table properties used by prop_* breakdown keys")
+    parser.add_argument("--watch", action="store_true", help="Keep tailing the JSONL response files in the folder, its checkpoints/ and shards/ subfolders, and rescore new lines until interrupted")
+    parser.add_argument("--watch_interval", type=float, default=30, help="Seconds between two updates in --watch mode")
     args = parser.parse_args()
+    if args.bootstrap_resamples > 0 and args.tables_prefix is None:
+        parser.error("--bootstrap_resamples needs --tables_prefix to know where to write the tables")
+    if args.breakdowns and args.tables_prefix is None:
+        parser.error("--breakdowns needs --tables_prefix to know where to write the tables")
+    if args.watch and args.mode == "all":
+        parser.error("--watch scores one mode at a time, choose vision, real or synthetic")
+    breakdowns = parse_breakdowns(args.breakdowns) if args.breakdowns else None
+    if breakdowns:
+        try:
+            check_breakdowns(breakdowns, args.qaps_file)
+        except (ValueError, FileNotFoundError) as e:
+            parser.error(str(e))
     folder_name = args.folder_name
     output_file = args.output_file
     print_results = args.print_results
     mode = args.mode
+    stream = args.stream
+    workers = args.workers
+    if args.watch:
+        watch_results(folder_name, output_file, mode, args.watch_interval, print_results=True)
+        sys.exit(0)
+    cache = None if args.no_cache else ScoreCache(args.cache_dir, SCORER_VERSION, args.cache_max_mb)
+    tables = None if args.tables_prefix is None else ScoreTables()
     if mode == "vision":
-        score_vision_only_results(folder_name, output_file, print_results)
+        score_vision_only_results(folder_name, output_file, print_results, stream, workers, cache, tables)
     elif mode == "real":
-        score_realHCT_text_only_results(folder_name, output_file, print_results)
+        score_realHCT_text_only_results(folder_name, output_file, print_results, stream, workers, cache, tables)
     elif mode == "synthetic":
-        score_syntheticHCT_text_only_results(folder_name, output_file, print_results)
+        score_syntheticHCT_text_only_results(folder_name, output_file, print_results, stream, workers, cache, tables)
+    elif mode == "all":
+        score_all_results(folder_name, output_file, print_results, stream, workers, cache, tables)
     else:
-        raise ValueError("Invalid mode. Choose from 'vision', 'real', or 'synthetic'.")
+        raise ValueError("Invalid mode. Choose from 'vision', 'real', 'synthetic' or 'all'.")
+    if tables is not None:
+        saved_tables = tables.write(args.tables_prefix, args.tables_format)
+        question_table = tables.question_table()
+        if breakdowns:
+            breakdown_tables = compute_breakdowns(question_table, breakdowns, ALL_METRICS, args.qaps_file)
+            for name, breakdown in breakdown_tables.items():
+                saved_tables.append(write_table(breakdown, args.tables_prefix, name, args.tables_format))
+        if args.bootstrap_resamples > 0:
+            ci_table = bootstrap_ci_table(question_table, ALL_METRICS, args.bootstrap_resamples, args.bootstrap_alpha)
+            paired_table = paired_tests_table(question_table, ALL_METRICS, args.bootstrap_resamples, args.bootstrap_alpha)
+            saved_tables.append(write_table(ci_table, args.tables_prefix, "bootstrap_ci", args.tables_format))
+            saved_tables.append(write_table(paired_table, args.tables_prefix, "paired_tests", args.tables_format))
+        for path in saved_tables:
+            print(f"Score table saved to {path}")
+    if cache is not None:
+        evicted = cache.close()
+        print(f"Score cache: {cache.hits} hits, {cache.misses} misses, {evicted} entries evicted")
     print(f"Results saved to {output_file}")
-    return
 
 # Example usage:
 # python score_responses.py --folder_name /path/to/folder --output_file /path/to/output.txt --print_results --mode vision
+# python score_responses.py --folder_name /path/to/experiment_folder --output_file /path/to/output.txt --mode all --workers 4
 
@@ -0,0 +1,99 @@
+import os
+from collections import Counter
+
+##########################
+######### SCORE TABLES
+##########################
+# Columnar per-question and aggregate score tables, written next to the text report so
+# dashboards can load scores directly instead of parsing "Mean Precision: ..." blocks.
+# pandas is only imported once tables are built, scoring without tables does not load it.
+
+ALL_METRICS = ["precision", "recall", "f1", "cc"]
+QUESTION_TABLE_COLUMNS = ["model", "mode", "dataset", "question_id"] + ALL_METRICS
+AGGREGATE_TABLE_COLUMNS = ["model", "mode", "dataset", "num_questions"] + ALL_METRICS
+CATEGORY_COLUMNS = ["model", "mode", "dataset"]
+TABLE_FORMATS = ["parquet", "csv", "json"]
+
+
+def new_question_scores(metric_names):
+    # Column lists instead of one dict per question keeps the per-file payload small
+    question_scores = {"question_id": [], "dataset": []}
+    for m in metric_names:
+        question_scores[m] = []
+    return question_scores
+
+
+def add_question_scores(question_scores, question_id, values):
+    question_scores["question_id"].append(question_id)
+    question_scores["dataset"].append(question_id.split("--")[0])
+    for m, value in values.items():
+        question_scores[m].append(value)
+
+
+class ScoreTables:
+    """
+    Collects per-question and aggregate scores of every scored file and writes them as two tables.
+    Metrics a mode does not compute (precision and F1 for vision) are left empty.
+    """
+
+    def __init__(self):
+        self.question_frames = []
+        self.aggregate_rows = []
+
+    def add_file(self, model_name, data_mode, datasets_results, question_scores):
+        import pandas as pd
+        num_questions = len(question_scores["question_id"])
+        frame = pd.DataFrame(question_scores)
+        frame.insert(0, "model", model_name)
+        frame.insert(1, "mode", data_mode)
+        self.question_frames.append(frame.reindex(columns=QUESTION_TABLE_COLUMNS))
+
+        dataset_counts = Counter(question_scores["dataset"])
+        for dataset, results in datasets_results.items():
+            row = {
+                "model": model_name,
+                "mode": data_mode,
+                "dataset": dataset,
+                "num_questions": num_questions if dataset == "ALL" else dataset_counts[dataset],
+            }
+            for m in ALL_METRICS:
+                row[m] = results.get(m)
+            self.aggregate_rows.append(row)
+
+    def question_table(self):
+        import pandas as pd
+        if not self.question_frames:
+            return pd.DataFrame(columns=QUESTION_TABLE_COLUMNS)
+        table = pd.concat(self.question_frames, ignore_index=True)
+        for column in CATEGORY_COLUMNS:
+            table[column] = table[column].astype("category")
+        return table
+
+    def aggregate_table(self):
+        import pandas as pd
+        table = pd.DataFrame(self.aggregate_rows, columns=AGGREGATE_TABLE_COLUMNS)
+        return table.astype({m: "float64" for m in ALL_METRICS})
+
+    def write(self, tables_prefix, tables_format="parquet"):
+        return [
+            write_table(self.question_table(), tables_prefix, "questions", tables_format),
+            write_table(self.aggregate_table(), tables_prefix, "aggregates", tables_format),
+        ]
+
+
+def write_table(table, tables_prefix, name, tables_format="parquet"):
+    if tables_format not in TABLE_FORMATS:
+        raise ValueError(f"Invalid table format '{tables_format}'. Choose from {TABLE_FORMATS}.")
+
+    output_folder = os.path.dirname(tables_prefix)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+
+    path = f"{tables_prefix}--{name}.{tables_format}"
+    if tables_format == "parquet":
+        table.to_parquet(path, index=False)
+    elif tables_format == "csv":
+        table.to_csv(path, index=False)
+    else:
+        table.to_json(path, orient="records", lines=True)
+    return path
@@ -0,0 +1,143 @@
+import numpy as np
+
+##########################
+######### BOOTSTRAP CONFIDENCE INTERVALS AND PAIRED TESTS
+##########################
+# All resampling is done as matrix products: a (resamples x questions) matrix of resample
+# counts (or random signs) times a (questions x columns) matrix of per-question scores gives
+# every resample mean of every column at once. Resamples are drawn in chunks so memory stays
+# bounded on large splits.
+
+DEFAULT_RESAMPLES = 10000
+DEFAULT_ALPHA = 0.05
+MAX_CHUNK_CELLS = 1 << 22  # resamples x questions drawn at once
+
+CI_TABLE_COLUMNS = ["model", "mode", "dataset", "metric", "num_questions", "mean", "ci_low", "ci_high"]
+PAIRED_TABLE_COLUMNS = ["mode", "dataset", "metric", "model_a", "model_b", "num_questions",
+                        "mean_a", "mean_b", "diff", "diff_ci_low", "diff_ci_high", "p_bootstrap", "p_permutation"]
+
+
+def _chunks(num_resamples, num_questions):
+    chunk_size = max(1, MAX_CHUNK_CELLS // max(num_questions, 1))
+    for start in range(0, num_resamples, chunk_size):
+        yield start, min(start + chunk_size, num_resamples)
+
+
+def bootstrap_means(values, num_resamples, rng):
+    """
+    Means of `num_resamples` bootstrap resamples of the rows of `values` (questions x columns).
+    Returns a (num_resamples x columns) array.
+    """
+    num_questions = values.shape[0]
+    means = np.empty((num_resamples, values.shape[1]))
+    for start, stop in _chunks(num_resamples, num_questions):
+        rows = stop - start
+        # Turn sampled indices into per-resample counts with one bincount over flat offsets
+        idx = rng.integers(0, num_questions, size=(rows, num_questions))
+        idx += (np.arange(rows) * num_questions)[:, None]
+        counts = np.bincount(idx.ravel(), minlength=rows * num_questions).reshape(rows, num_questions)
+        means[start:stop] = counts @ values / num_questions
+    return means
+
+
+def sign_flip_means(diffs, num_resamples, rng):
+    """
+    Means of paired differences under random sign flips (the null of no difference).
+    Returns a (num_resamples x columns) array.
+    """
+    num_questions = diffs.shape[0]
+    means = np.empty((num_resamples, diffs.shape[1]))
+    for start, stop in _chunks(num_resamples, num_questions):
+        signs = rng.integers(0, 2, size=(stop - start, num_questions)) * 2.0 - 1.0
+        means[start:stop] = signs @ diffs / num_questions
+    return means
+
+
+def _percentile_ci(means, alpha):
+    low, high = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return low, high
+
+
+def _groups(question_table):
+    # (mode, dataset, rows) for ALL and every dataset prefix within each mode
+    for mode, mode_rows in question_table.groupby("mode", observed=True, sort=True):
+        yield mode, "ALL", mode_rows
+        for dataset, dataset_rows in mode_rows.groupby("dataset", observed=True, sort=True):
+            yield mode, dataset, dataset_rows
+
+
+def _metrics_present(rows, metrics):
+    return [m for m in metrics if rows[m].notna().any()]
+
+
+def bootstrap_ci_table(question_table, metrics, num_resamples=DEFAULT_RESAMPLES, alpha=DEFAULT_ALPHA, seed=0):
+    import pandas as pd
+    records = []
+    for mode, dataset, rows in _groups(question_table):
+        group_metrics = _metrics_present(rows, metrics)
+        for model, model_rows in rows.groupby("model", observed=True, sort=True):
+            values = model_rows[group_metrics].to_numpy(dtype=np.float64)
+            rng = np.random.default_rng(seed)
+            low, high = _percentile_ci(bootstrap_means(values, num_resamples, rng), alpha)
+            observed = values.mean(axis=0)
+            for j, metric in enumerate(group_metrics):
+                records.append({
+                    "model": model, "mode": mode, "dataset": dataset, "metric": metric,
+                    "num_questions": len(values), "mean": observed[j], "ci_low": low[j], "ci_high": high[j],
+                })
+    return pd.DataFrame(records, columns=CI_TABLE_COLUMNS)
+
+
+def paired_tests_table(question_table, metrics, num_resamples=DEFAULT_RESAMPLES, alpha=DEFAULT_ALPHA, seed=0):
+    """
+    Paired bootstrap and sign-flip permutation tests for every pair of models of the same mode,
+    on the questions both models answered. Pairs sharing the same questions are tested with the
+    same resamples in one matrix product.
+    """
+    import pandas as pd
+    records = []
+    for mode, dataset, rows in _groups(question_table):
+        group_metrics = _metrics_present(rows, metrics)
+        models = sorted(rows["model"].astype(str).unique())
+        if len(models) < 2:
+            continue
+        pairs = [(a, b) for i, a in enumerate(models) for b in models[i + 1:]]
+
+        for metric in group_metrics:
+            wide = rows.assign(model=rows["model"].astype(str)).pivot_table(
+                index="question_id", columns="model", values=metric, aggfunc="mean", observed=True
+            ).reindex(columns=models)
+            scores = wide.to_numpy(dtype=np.float64)
+            answered = ~np.isnan(scores)
+            model_pos = {m: i for i, m in enumerate(models)}
+
+            # Pairs answering the same questions are tested together, usually that is all of them
+            pairs_by_questions = {}
+            for a, b in pairs:
+                mask = answered[:, model_pos[a]] & answered[:, model_pos[b]]
+                pairs_by_questions.setdefault(mask.tobytes(), (mask, []))[1].append((a, b))
+
+            for mask, mask_pairs in pairs_by_questions.values():
+                if not mask.any():
+                    continue
+                pair_scores = scores[mask]
+                diffs = np.stack([pair_scores[:, model_pos[a]] - pair_scores[:, model_pos[b]] for a, b in mask_pairs], axis=1)
+                observed = diffs.mean(axis=0)
+
+                rng = np.random.default_rng(seed)
+                boot = bootstrap_means(diffs, num_resamples, rng)
+                low, high = _percentile_ci(boot, alpha)
+                # Two-sided: how often the resampled difference lands on the other side of zero
+                p_bootstrap = np.minimum(1.0, 2 * np.minimum((boot <= 0).mean(axis=0), (boot >= 0).mean(axis=0)))
+                flips = sign_flip_means(diffs, num_resamples, rng)
+                p_permutation = ((np.abs(flips) >= np.abs(observed) - 1e-12).sum(axis=0) + 1) / (num_resamples + 1)
+
+                for j, (a, b) in enumerate(mask_pairs):
+                    records.append({
+                        "mode": mode, "dataset": dataset, "metric": metric, "model_a": a, "model_b": b,
+                        "num_questions": int(mask.sum()),
+                        "mean_a": pair_scores[:, model_pos[a]].mean(), "mean_b": pair_scores[:, model_pos[b]].mean(),
+                        "diff": observed[j], "diff_ci_low": low[j], "diff_ci_high": high[j],
+                        "p_bootstrap": p_bootstrap[j], "p_permutation": p_permutation[j],
+                    })
+    return pd.DataFrame(records, columns=PAIRED_TABLE_COLUMNS)
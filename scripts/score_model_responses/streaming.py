@@ -0,0 +1,188 @@
+import json
+import os
+
+##########################
+######### STREAMING READERS
+##########################
+# Response dumps from sampled multi-run evaluations can be several GB, so these helpers
+# yield one record at a time instead of loading the whole file, and the accumulators
+# below keep only running sums per dataset.
+
+READ_CHUNK_SIZE = 1 << 20
+
+
+def _iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    eof = not buffer
+    pos = 0
+
+    def fill(buffer, pos):
+        chunk = f.read(chunk_size)
+        return buffer[pos:] + chunk, 0, not chunk
+
+    # Skip the opening bracket
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos < len(buffer) or eof:
+            break
+        buffer, pos, eof = fill(buffer, pos)
+    if pos >= len(buffer) or buffer[pos] != "[":
+        raise ValueError("Expected a JSON array of result objects")
+    pos += 1
+
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError("Unterminated JSON array")
+            buffer, pos, eof = fill(buffer, pos)
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The record is cut by the end of the chunk, read more and try again
+            if eof:
+                raise
+            buffer, pos, eof = fill(buffer, pos)
+            continue
+        # A number or literal cut by the chunk boundary still decodes ("12345" read as "12"), so a
+        # record only counts once the "," or "]" after it is in the buffer
+        after = end
+        while after < len(buffer) and buffer[after].isspace():
+            after += 1
+        if after >= len(buffer) or buffer[after] not in ",]":
+            if not eof:
+                buffer, pos, eof = fill(buffer, pos)
+                continue
+            if after < len(buffer):
+                raise ValueError(f"Expected ',' or ']' after a record, found {buffer[after]!r}")
+        yield record
+        pos = end
+
+
+def _iter_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_result_records(fname, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yields result records one by one from either a JSON array file or a JSONL file.
+    """
+    with open(fname) as f:
+        first_char = ""
+        while True:
+            first_char = f.read(1)
+            if not first_char or not first_char.isspace():
+                break
+        f.seek(0)
+        if first_char == "[":
+            yield from _iter_json_array(f, chunk_size)
+        else:
+            yield from _iter_json_lines(f)
+
+
+def peek_first_record(fname, chunk_size=1 << 16):
+    """
+    Returns the first record of a JSON array or JSONL file, reading only as much as it needs.
+    Returns None if the file is empty or not a readable results file.
+    """
+    records = iter_result_records(fname, chunk_size)
+    try:
+        return next(records, None)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    finally:
+        records.close()
+
+
+class JsonlTail:
+    """
+    Follows a JSONL file that is still being written and returns only the complete lines
+    added since the last call. A line without its trailing newline is kept for the next call.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.offset = 0
+        self.partial = b""
+
+    def read_new_records(self):
+        """
+        Returns (records, restarted). restarted is True when the file shrank (it was rewritten),
+        in which case reading starts over from the beginning and earlier records should be dropped.
+        """
+        restarted = False
+        size = os.path.getsize(self.fname)
+        if size < self.offset:
+            self.offset = 0
+            self.partial = b""
+            restarted = True
+        if size == self.offset:
+            return [], restarted
+
+        with open(self.fname, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        records = [json.loads(line) for line in lines if line.strip()]
+        return records, restarted
+
+
+##########################
+######### RUNNING METRICS
+##########################
+
+class MetricsAccumulator:
+    """
+    Running sums of per-question metrics, so means can be reported without keeping the results.
+    """
+
+    def __init__(self, metric_names):
+        self.metric_names = list(metric_names)
+        self.count = 0
+        self.sums = {m: 0 for m in self.metric_names}
+
+    def add(self, values):
+        self.count += 1
+        for m in self.metric_names:
+            self.sums[m] += values[m]
+
+    def means(self):
+        # Raises ZeroDivisionError on an empty set, like the list based scorers
+        return {m: self.sums[m] / self.count for m in self.metric_names}
+
+
+class DatasetMetricsAccumulator:
+    """
+    One MetricsAccumulator for ALL results plus one per dataset prefix (`id.split("--")[0]`).
+    Datasets are kept in order of first appearance, matching `results_to_per_dataset_results`.
+    """
+
+    def __init__(self, metric_names):
+        self.metric_names = list(metric_names)
+        self.all = MetricsAccumulator(self.metric_names)
+        self.per_dataset = {}
+
+    def add(self, result_id, values):
+        dataset = result_id.split("--")[0]
+        if dataset not in self.per_dataset:
+            self.per_dataset[dataset] = MetricsAccumulator(self.metric_names)
+        self.all.add(values)
+        self.per_dataset[dataset].add(values)
+
+    def results(self):
+        all_results = {"ALL": self.all.means()}
+        for dataset, accumulator in self.per_dataset.items():
+            all_results[dataset] = accumulator.means()
+        return all_results
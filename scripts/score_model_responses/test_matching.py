@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+import matching
+from matching import GTMatcher
+
+##########################
+######### AUTOMATON PARITY
+##########################
+# Real GT sets rarely reach AUTOMATON_MIN_VALUES, so the automaton path is forced here
+# (min_values=0) on large sets of overlapping values, values that are substrings of each other,
+# repeated and empty values, and compared with the plain `x in response` loop.
+# Run with: python -m pytest -q test_matching.py
+
+pytestmark = pytest.mark.skipif(matching.ahocorasick is None, reason="pyahocorasick is not installed")
+
+SEED = 2024
+PIECES = ["1", "12", "123", "1234", "0", "00", ".5", "a", "ab", "aba", "bab", " ", "||", "é", "ods", "gfcs"]
+
+
+def plain_count(gt_set, response):
+    return sum(1 for x in gt_set if x in response)
+
+
+def random_value(rng):
+    return "".join(rng.choice(PIECES) for _ in range(rng.randint(1, 4)))
+
+
+def test_forced_automaton_matches_plain_loop():
+    rng = random.Random(SEED)
+    matcher = GTMatcher(min_values=0)
+    for _ in range(500):
+        gt_set = {random_value(rng) for _ in range(rng.randint(20, 200))}
+        if rng.random() < 0.2:
+            gt_set.add("")
+        # Responses built from GT values and pieces, so values overlap and nest inside them
+        response = "".join(rng.choice([rng.choice(sorted(gt_set)), rng.choice(PIECES)]) for _ in range(rng.randint(0, 60)))
+        assert matcher.count_contained(gt_set, response) == plain_count(gt_set, response), (sorted(gt_set), response)
+
+
+def test_overlapping_and_nested_values_count_once():
+    matcher = GTMatcher(min_values=0)
+    gt_set = {"aba", "bab", "ab", "b", "abab", "1", "12", "123", "23", "9"}
+    for response in ["ababab", "123", "1 2 3", "", "9ab", "abab123"]:
+        assert matcher.count_contained(gt_set, response) == plain_count(gt_set, response), response
+
+
+def test_empty_gt_values():
+    matcher = GTMatcher(min_values=0)
+    for gt_set in [set(), {""}, {"", "x"}]:
+        for response in ["", "x", "yx"]:
+            assert matcher.count_contained(gt_set, response) == plain_count(gt_set, response), (gt_set, response)
+
+
+def test_automata_are_cached_per_gt_set():
+    matcher = GTMatcher(min_values=0, max_cached=2)
+    matcher.count_contained({"a", "b"}, "ab")
+    matcher.count_contained({"b", "a"}, "b")
+    assert len(matcher.automata) == 1
+    matcher.count_contained({"c"}, "c")
+    matcher.count_contained({"d"}, "d")
+    # The cache is cleared when full instead of growing with every question
+    assert len(matcher.automata) == 1
@@ -0,0 +1,159 @@
+import json
+import os
+import random
+import re
+
+from normalization import normalize_gt, normalize_gts, normalize_response, normalize_responses
+
+##########################
+######### PARITY WITH THE ORIGINAL SCORER
+##########################
+# normalization.py must give exactly the values of the functions score_responses.py used
+# before it, or published scores move. The originals are kept below, as they were, and compared
+# on seeded fuzz strings and on the example response files of the repo.
+# Run with: python -m pytest -q test_normalization.py
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+EXAMPLE_TEXT_RESULTS = os.path.join(REPO_ROOT, "results", "model_responses", "llms", "example_results--gemma-2-9b-it--realHCTs.jsonl")
+EXAMPLE_VISION_RESULTS = os.path.join(REPO_ROOT, "results", "model_responses", "vlms", "example_results--InternVL2-4B--vision--results.jsonl")
+VISION_GT_REFERENCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helper_for_vision_scoring.json")
+
+FUZZ_SEED = 20240
+FUZZ_CASES = 3000
+
+
+def legacy_clean_gt_val(ground_truth_t):
+    ground_truth = re.sub(r"(?<=\d),(?=\d)", "", ground_truth_t)
+    ground_truth = ground_truth.lower().strip()
+    ground_truth = [x.lower().strip() for x in ground_truth.replace("{", "").replace("}", "").replace("||", "|").split("|")]
+    for j in range(len(ground_truth)):
+        temp_val = ground_truth[j]
+        for _ in range(5):
+            temp_val = re.sub(r'(\d+),(\d+)', r'\1\2', temp_val)
+
+        # Remove trailing .0, .00, .000, etc.
+        temp_val = re.sub(r'(\d+)\.0+\b', r'\1', temp_val)
+        temp_val = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', temp_val)
+
+        ground_truth[j] = temp_val
+
+    return ground_truth
+
+
+def legacy_clean_response_text(response):
+    # Common head of the three original post_process_response* functions
+    response = response.lower().strip()
+    junk_tokens = r"(?:<eos_token>|#input|# input|# solution:|#solution|# explanation:|#explanation|note:|table:)"
+    match = re.search(junk_tokens, response)
+    if match:
+        response = response[:match.start()]
+    response = response.split("\n\n")[0]
+    reponse = response.split("\n```\n")[0]
+    response = response.replace("`", "").replace("\n","")
+    for i in range(5):
+        response = re.sub(r'(\d+),(\d+)', r'\1\2', response)
+    return response
+
+
+def legacy_post_process_response(response):
+    response = legacy_clean_response_text(response)
+    response = re.sub(r'(\d+)\.0+\b', r'\1', response)
+    response = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', response)
+    return [x.strip() for x in response.lower().strip().split("||")]
+
+
+def legacy_post_process_response_vision_models_only(response):
+    response = legacy_clean_response_text(response)
+    response = re.sub(r'(\d+)\.0+\b', r'\1', response)
+    response = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', response)
+    return response.lower().strip()
+
+
+def legacy_post_process_response_format_variation(response):
+    response = legacy_clean_response_text(response)
+    values = [x.strip() for x in response.lower().strip().split("||")]
+    new_values = []
+    for value in values:
+        new_value = re.sub(r'(\d+)\.0+\b', r'\1', value)
+        new_value = re.sub(r'(\d*\.\d*?[1-9])0+\b', r'\1', new_value)
+        new_values.append(new_value)
+    return new_values
+
+
+LEGACY_RESPONSE_FUNCTIONS = {
+    "default": legacy_post_process_response,
+    "vision": legacy_post_process_response_vision_models_only,
+    "format_variation": legacy_post_process_response_format_variation,
+}
+
+# Pieces the fuzz strings are made of: digit groups, separators of the GT format, decimals with
+# trailing zeros, junk tokens, blank lines and code fences
+FUZZ_FRAGMENTS = [
+    "0", "1", "7", "12", "000", "305", "1,000", ",", ", ", ".", ".0", ".00", ".50", "0.0", "10.100",
+    "|", "||", " | ", " || ", "{", "}", "},{", " ", "  ", "\n", "\n\n", "\n```\n", "`", "-", "%", "$",
+    "abc", "Yes", "N/A", "Total", "é", "<eos_token>", "# Explanation:", "#input", "Note:", "table:",
+]
+
+
+def random_text(rng):
+    return "".join(rng.choice(FUZZ_FRAGMENTS) for _ in range(rng.randint(0, 25)))
+
+
+def comma_chain(rng, length):
+    return ",".join(str(rng.randint(0, 999)) for _ in range(length))
+
+
+def fuzz_strings():
+    rng = random.Random(FUZZ_SEED)
+    strings = [random_text(rng) for _ in range(FUZZ_CASES)]
+    # Digit chains around 2**5 commas, where the original 5 pass loop stops removing them all
+    for length in [2, 3, 31, 32, 33, 34, 40, 63, 64, 65, 100, 257]:
+        chain = comma_chain(rng, length)
+        strings += [chain, f"{{{chain}}} || {random_text(rng)}", f"{random_text(rng)}{chain}.00{random_text(rng)}", chain.replace(",", ",,", 1)]
+    return strings
+
+
+def read_jsonl(fname):
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_gts(gts):
+    for gt in gts:
+        assert normalize_gt(gt) == legacy_clean_gt_val(gt), repr(gt)
+    assert normalize_gts(gts) == [legacy_clean_gt_val(gt) for gt in gts]
+
+
+def check_responses(responses):
+    for variant, legacy_function in LEGACY_RESPONSE_FUNCTIONS.items():
+        expected = [legacy_function(response) for response in responses]
+        for response, value in zip(responses, expected):
+            assert normalize_response(response, variant) == value, (variant, repr(response))
+        assert normalize_responses(responses, variant) == expected
+
+
+def test_gt_parity_on_fuzz_strings():
+    check_gts(fuzz_strings())
+
+
+def test_response_parity_on_fuzz_strings():
+    check_responses(fuzz_strings())
+
+
+def test_long_comma_chains_keep_legacy_commas():
+    # 33 numbers are the first chain the original loop leaves a comma in
+    chain = ",".join(["1"] * 33)
+    assert "," in legacy_post_process_response(chain)[0]
+    assert normalize_response(chain) == legacy_post_process_response(chain)
+
+
+def test_parity_on_example_text_results():
+    records = read_jsonl(EXAMPLE_TEXT_RESULTS)
+    check_gts([record["gt"] for record in records])
+    check_responses([record["response"] for record in records])
+
+
+def test_parity_on_example_vision_results():
+    check_responses([record["response"] for record in read_jsonl(EXAMPLE_VISION_RESULTS)])
+    with open(VISION_GT_REFERENCE_FILE) as f:
+        check_gts([record["gt"] for record in json.load(f)])
@@ -0,0 +1,29 @@
+import json
+
+from score_responses import classify_result_files
+
+##########################
+######### MIXED FOLDERS
+##########################
+# --mode all classifies every entry of the folder. Subfolders the inference scripts write next to
+# the results (checkpoints/, shards/, scores/) must neither be scored nor listed as skipped.
+# Run with: python -m pytest -q test_result_files.py
+
+
+def test_subfolders_are_neither_classified_nor_skipped(tmp_path):
+    text_record = {"id": "arxiv--1--1--M0", "gt": "{1}", "response": "1"}
+    (tmp_path / "m--realHCTs--results.json").write_text(json.dumps([text_record]))
+    (tmp_path / "m--syntheticHCTs--results.json").write_text(json.dumps([text_record]))
+    (tmp_path / "m--vision--results.jsonl").write_text(json.dumps({"id": "arxiv--1--1--M0", "response": "1"}) + "\n")
+    (tmp_path / "notes.txt").write_text("not a results file\n")
+    for subfolder in ["checkpoints", "shards", "scores"]:
+        (tmp_path / subfolder).mkdir()
+        (tmp_path / subfolder / "m--realHCTs--results.json.partial.jsonl").write_text(json.dumps(text_record) + "\n")
+
+    files_by_kind, skipped = classify_result_files(str(tmp_path))
+    assert files_by_kind == {
+        "vision": ["m--vision--results.jsonl"],
+        "real": ["m--realHCTs--results.json"],
+        "synthetic": ["m--syntheticHCTs--results.json"],
+    }
+    assert skipped == ["notes.txt"]
@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from streaming import _iter_json_array, iter_result_records
+
+##########################
+######### CHUNKED JSON ARRAYS
+##########################
+# The array reader sees the file through a fixed size window, so every value has to come out
+# the same whatever chunk boundary falls inside it. Each document is read with every chunk size
+# from 1 to past its length and compared with json.load.
+# Run with: python -m pytest -q test_streaming.py
+
+DOCUMENTS = {
+    "scalars": '[12345, 678, -0.5, 1.25e-3, 1E+2, true, false, null, 0]',
+    "objects": '[{"question_id": "q1", "response": "12345", "gt": "{1,000}"}, {"question_id": "q2", "score": 0.75}]',
+    "nested_strings": '[{"response": "a ] b, c", "gt": "[x, y]"}, ["]", ",", "\\"]"], "\\u00e9 ]"]',
+    "whitespace": '  \n [ \n 1 ,\n\t{"a": [2, 3]} ,  "x"  \n ]  \n\n   ',
+    "empty": '[]',
+    "empty_with_tail": ' [ ]    \n',
+}
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+def test_chunk_size_sweep_matches_json_load(name):
+    text = DOCUMENTS[name]
+    expected = json.loads(text)
+    for chunk_size in range(1, len(text) + 2):
+        assert list(_iter_json_array(io.StringIO(text), chunk_size)) == expected, (name, chunk_size)
+
+
+def test_result_files_read_the_same_with_any_chunk(tmp_path):
+    records = [{"question_id": f"q{i}", "response": "1,000 ]" * i, "gt": str(10 ** i)} for i in range(12)]
+    array_file, jsonl_file = tmp_path / "results.json", tmp_path / "results.jsonl"
+    array_file.write_text(json.dumps(records, indent=2) + "\n  ")
+    jsonl_file.write_text("".join(json.dumps(record) + "\n" for record in records) + "\n")
+    for chunk_size in [1, 2, 3, 7, 64, 1 << 20]:
+        assert list(iter_result_records(str(array_file), chunk_size)) == records
+        assert list(iter_result_records(str(jsonl_file), chunk_size)) == records
+
+
+@pytest.mark.parametrize("text", ['[1 2]', '[12345', '[{"a": 1}', '["a", "b"'])
+def test_malformed_arrays_raise(text):
+    for chunk_size in range(1, len(text) + 2):
+        with pytest.raises(ValueError):
+            list(_iter_json_array(io.StringIO(text), chunk_size))
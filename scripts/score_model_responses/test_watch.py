@@ -0,0 +1,57 @@
+import json
+import os
+
+import score_responses
+from score_responses import realHCT_text_results_report, watch_results
+
+##########################
+######### WATCH MODE
+##########################
+# A checkpoint of llm_inf.py is tailed while lines are appended to it, some of them cut in two
+# between updates. Once everything is written the live report has to match the batch report of
+# the same file.
+# Run with: python -m pytest -q test_watch.py
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+EXAMPLE_TEXT_RESULTS = os.path.join(REPO_ROOT, "results", "model_responses", "llms", "example_results--gemma-2-9b-it--realHCTs.jsonl")
+CHECKPOINT_NAME = os.path.join("checkpoints", "gemma-2-9b-it--realHCTs--results.json.partial.jsonl")
+NUM_APPENDS = 5
+
+
+def test_live_report_of_a_checkpoint_matches_the_batch_report(tmp_path, monkeypatch):
+    # Checkpoint records as llm_inf.py writes them, the example file names the id qap_id
+    with open(EXAMPLE_TEXT_RESULTS) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = [{"id": record["qap_id"], "gt": record["gt"], "response": record["response"]} for record in records]
+    data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+    folder = tmp_path / "llms"
+    (folder / "checkpoints").mkdir(parents=True)
+    checkpoint_file = str(folder / CHECKPOINT_NAME)
+    # A finished results file next to it is not JSONL and is left to the batch scorer
+    (folder / "gemma-2-9b-it--realHCTs--results.json").write_text(json.dumps(records))
+    open(checkpoint_file, "wb").close()
+
+    # Cut points fall inside lines, the tail must hold the partial line until its newline comes
+    cuts = [len(data) * (i + 1) // NUM_APPENDS - 7 for i in range(NUM_APPENDS - 1)] + [len(data)]
+    reports = []
+
+    def append_next_part(seconds):
+        reports.append((tmp_path / "watch.txt").read_text())
+        start = os.path.getsize(checkpoint_file)
+        with open(checkpoint_file, "ab") as f:
+            f.write(data[start:cuts[len(reports) - 1]])
+
+    monkeypatch.setattr(score_responses.time, "sleep", append_next_part)
+    accumulators = watch_results(str(folder), str(tmp_path / "watch.txt"), "real", interval=0, print_results=False, max_updates=NUM_APPENDS + 1)
+
+    num_records = len(records)
+    assert list(accumulators) == [CHECKPOINT_NAME]
+    assert accumulators[CHECKPOINT_NAME].all.count == num_records
+    # Nothing scored before the first append, then a growing number of responses
+    assert reports[0] == ""
+    counts = [int(report.split(": ")[1].split()[0]) for report in reports[1:]]
+    assert counts == sorted(counts) and 0 < counts[0] < num_records
+
+    batch_report = realHCT_text_results_report(str(folder / "checkpoints"), [os.path.basename(CHECKPOINT_NAME)])
+    live_report = (tmp_path / "watch.txt").read_text()
+    assert live_report == f"{CHECKPOINT_NAME}: {num_records} responses scored, 0 skipped\n{batch_report}\n"
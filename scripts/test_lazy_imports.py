@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+##########################
+######### STARTUP IMPORTS
+##########################
+# --help, argument errors and the mock / openai backends must not pay for the heavy libraries.
+# Each script is run with --help in a fresh interpreter, from its own folder like the README
+# does, and the modules it loaded on the way are checked. The time bound is loose, it only
+# catches an eager import of torch or vllm on a machine that has them.
+# Run with: python -m pytest -q test_lazy_imports.py
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ["torch", "vllm", "PIL", "pandas", "pyarrow", "huggingface_hub", "datasets"]
+MAX_HELP_SECONDS = 3.0
+
+HELP_SCRIPTS = [
+    os.path.join("score_model_responses", "score_responses.py"),
+    os.path.join("inference_experiments", "llm_inference", "llm_inf.py"),
+    os.path.join("inference_experiments", "vlm_inference", "vlm_inf.py"),
+    os.path.join("inference_experiments", "local_dataset.py"),
+]
+
+# Runs the script as __main__ with --help and prints the heavy modules it imported and the time
+PROBE = """
+import json, runpy, sys, time
+heavy, script = json.loads(sys.argv[1]), sys.argv[2]
+sys.argv = [script, "--help"]
+start = time.perf_counter()
+try:
+    runpy.run_path(script, run_name="__main__")
+except SystemExit:
+    pass
+seconds = time.perf_counter() - start
+loaded = sorted(name for name in heavy if name in sys.modules)
+print(json.dumps({"loaded": loaded, "seconds": seconds}))
+"""
+
+
+@pytest.mark.parametrize("script", HELP_SCRIPTS)
+def test_help_skips_heavy_imports(script):
+    folder, fname = os.path.split(os.path.join(SCRIPTS_DIR, script))
+    process = subprocess.run([sys.executable, "-c", PROBE, json.dumps(HEAVY_MODULES), fname],
+                             cwd=folder, capture_output=True, text=True, timeout=60)
+    assert process.returncode == 0, process.stderr
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    assert result["loaded"] == [], f"{script} --help imported {result['loaded']}"
+    assert result["seconds"] < MAX_HELP_SECONDS, f"{script} --help took {result['seconds']:.2f}s"